@@ -44,9 +44,15 @@ def deleteInstance(channel, processes):
 
 
 channels_file = open("channels.txt", "r")
-for channel in channels_file.readlines():
-    time.sleep(1)
-    addInstance(channel.strip("\n"), processes)
+channels = [channel.strip("\n") for channel in channels_file.readlines() if channel.strip()]
+
+# '--multi' runs every channel in a single process (and connection) instead of one process per channel
+if "--multi" in sys.argv:
+    addInstance(",".join(channels), processes)
+else:
+    for channel in channels:
+        time.sleep(1)
+        addInstance(channel, processes)
 
 user_input = None
 
@@ -14,35 +14,355 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
 import logging
 import logging.handlers
 import os
+import random
 import time
-import socket
-import sqlite3 as sql
 import sys
 
 import default_commands
 from default_commands.constants import ConfigDefaults
+import _archive
+import _database
 import _functions
+import _logfiles
+import _network
+import _patterns
 import _reloadbot
+import _search
 import unpackconfig
 
-cfg = unpackconfig.configUnpacker()
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+log = logging.getLogger("StrongLegsBot")
 
+# Channels joined over a single connection before another one is opened
+channels_per_connection = 50
 
-class IRC:
-    def __init__(self):
-        # Initializes all class variables
-        self.config = cfg.unpackcfg()
-        self.CHANNEL = sys.argv[1] if len(sys.argv) > 1 else "#floppydisk_"
+# Twitch counts every channel named in a JOIN, normal accounts may attempt 20 per 10 seconds
+join_batch = 20
+join_period = 10
+
+# Reconnect attempts wait a random time up to reconnect_delay * 2 ** attempt seconds (at most reconnect_maxdelay)
+reconnect_delay = 1
+reconnect_maxdelay = 120
+
+# A standby connection gets standby_timeout seconds (plus the JOIN pacing) to confirm every channel,
+# message ids stay remembered for dedupe_window seconds after switching over to it
+standby_timeout = 30
+dedupe_window = 10
+
+
+class Connection:
+    # One socket to Twitch shared by any number of channels. Lines are read and parsed once here and
+    # routed to the Bot of the channel they belong to, connection level messages (PING, CAP, GLOBALUSERSTATE,
+    # numerics without a channel) are dealt with here.
+    def __init__(self, channels):
+        self.config = unpackconfig.registry.snapshot().config
         self.USERNAME = self.config['settings_username']
         self.PASSWORD = self.config['settings_password']
         self.HOST = self.config['settings_host']
         self.PORT = int(self.config['settings_port'])
+        # Seconds between planned switchovers to a fresh connection, 0 only switches on RECONNECT
+        self.STANDBYINTERVAL = int(self.config.get('settings_standbyinterval') or 0)
+
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self.outwriter = None
+        self.jointask = None
+        self.framer = None
+        self.parser = _functions.Parse(self)
+        self.mainloopbreak = False
+
+        # Failed connections since the last successful JOIN and the reason a reconnect was requested
+        self.attempts = 0
+        self.restartreason = None
+
+        # Hot standby: the task opening the second connection, the scheduled switchover and the
+        # ids of messages already dealt with while both connections are read (None otherwise)
+        self.standbytask = None
+        self.standbytimer = None
+        self.seenids = None
+
+        # Shared by every channel's outbound queue, these limits apply to the whole account
+        self.chatbucket = _network.TokenBucket(20, 30)
+        self.modbucket = _network.TokenBucket(100, 30)
+        self.whisperbuckets = (_network.TokenBucket(3, 1), _network.TokenBucket(100, 60))
+
+        self.channels = {}
+        for channel in channels:
+            self.channels[channel] = Bot(IRC(channel, self))
+
+    async def init(self):
+        self.loop = asyncio.get_running_loop()
+        for bot in self.channels.values():
+            bot.init()
+
+        await self.connect()
+
+    async def open(self):
+        # Opens and authenticates a socket, JOINs are sent separately
+        reader, writer = await asyncio.open_connection(self.HOST, self.PORT)
+        outwriter = _network.OutboundWriter(writer)
+        for output in ('CAP REQ :twitch.tv/membership\r\n', 'CAP REQ :twitch.tv/tags\r\n',
+                       'CAP REQ :twitch.tv/commands\r\n', 'PASS %s\r\n' % self.PASSWORD,
+                       'NICK %s\r\n' % self.USERNAME):
+            outwriter.write(output.encode("UTF-8"))
+
+        return reader, writer, outwriter, _network.LineFramer()
+
+    def use(self, reader, writer, outwriter, framer, jointask):
+        # Makes the given socket the one every channel reads from and sends to
+        self.reader, self.writer, self.outwriter, self.framer = reader, writer, outwriter, framer
+
+        if self.jointask is not None:
+            self.jointask.cancel()
+        self.jointask = jointask
+
+        for bot in self.channels.values():
+            bot.irc.outbound.start(self.outwriter)
+
+        if self.standbytimer is not None:
+            self.standbytimer.cancel()
+        if self.STANDBYINTERVAL:
+            self.standbytimer = self.loop.call_later(self.STANDBYINTERVAL, self.switchover,
+                                                     "Scheduled switchover")
+
+    async def connect(self):
+        # Only the socket is rebuilt, channels keep their DB handles, caches and queued messages
+        while not self.mainloopbreak:
+            if self.attempts:
+                delay = random.uniform(0, min(reconnect_maxdelay, reconnect_delay * 2 ** self.attempts))
+                log.warning("[_BOTCOM] :| [RECN] Connecting again in %.1f seconds (attempt %d)",
+                            delay, self.attempts + 1)
+                await asyncio.sleep(delay)
+
+            self.attempts += 1
+            try:
+                reader, writer, outwriter, framer = await self.open()
+            except OSError as ERR_exception:
+                log.critical(ERR_exception)
+                continue
+
+            self.use(reader, writer, outwriter, framer,
+                     self.loop.create_task(self.join(outwriter, list(self.channels))))
+            return
+
+    async def close(self, writer, outwriter):
+        # Whatever is still buffered is written before the socket is closed
+        outwriter.flush()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def reconnect(self, reason):
+        log.warning("[_BOTCOM] :| [RECN] Reconnecting to Twitch: %s", reason)
+        self.restartreason = None
+
+        # Queued chat messages wait for the new socket
+        for bot in self.channels.values():
+            bot.irc.outbound.cancel()
+        await self.close(self.writer, self.outwriter)
+
+        await self.connect()
+
+    def restart(self, reason):
+        # Reconnects once the current chunk of lines has been dealt with
+        self.restartreason = reason
+
+    def switchover(self, reason):
+        # Moves to a new connection without a gap, falls back to reconnecting if that fails
+        if self.standbytask is None and not self.mainloopbreak:
+            self.standbytask = self.loop.create_task(self.standby(reason))
+
+    async def standby(self, reason):
+        # Opens and JOINs a second connection while this one keeps being read. Chat messages from
+        # the new connection are dealt with right away (each id only once), everything is switched
+        # over once it has seen the end of NAMES (366) for every channel. Returns True once switched.
+        log.warning("[_BOTCOM] :| [RECN] Opening standby connection: %s", reason)
+        self.seenids = {}
+        writer = outwriter = jointask = None
+        try:
+            reader, writer, outwriter, framer = await self.open()
+            jointask = self.loop.create_task(self.join(outwriter, list(self.channels)))
+            waiting = set(self.channels)
+            deadline = self.loop.time() + standby_timeout + join_period * (len(waiting) // join_batch)
+
+            while waiting.intersection(self.channels):
+                data = await asyncio.wait_for(reader.read(framer.readsize), deadline - self.loop.time())
+                if not data:
+                    raise ConnectionError("Standby connection closed")
+
+                messages = []
+                for line in framer.feed(data):
+                    info = self.parser.parse(line)
+                    if info.identifier == "PING":
+                        outwriter.write(("PONG :%s\r\n" % info["pingstring"]).encode("UTF-8", "replace"))
+                    elif info.identifier == "366":
+                        waiting.discard(info.channel)
+                    elif "id" in info.tags:
+                        messages.append(info)
+
+                if messages:
+                    self.handle_messages(messages)
+
+        except (OSError, asyncio.TimeoutError) as ERR_exception:
+            log.error("[_BOTCOM] :| [RECN] Standby connection failed: %r", ERR_exception)
+            if jointask is not None:
+                jointask.cancel()
+            if writer is not None:
+                await self.close(writer, outwriter)
+            self.seenids = None
+            self.standbytask = None
+            self.restart(reason)
+            return False
+
+        # Nothing is awaited between here and the new socket being used, reads switch over atomically
+        for bot in self.channels.values():
+            bot.irc.outbound.cancel()
+        oldwriter, oldoutwriter = self.writer, self.outwriter
+        self.use(reader, writer, outwriter, framer, jointask)
+        self.attempts = 0
+        self.standbytask = None
+        log.warning("[_BOTCOM] :| [RECN] Switched over to the standby connection")
+
+        self.loop.call_later(dedupe_window, self.forgetids)
+        await self.close(oldwriter, oldoutwriter)
+        return True
+
+    def forgetids(self):
+        if self.standbytask is None:
+            self.seenids = None
+
+    async def join(self, outwriter, channels):
+        for index in range(0, len(channels), join_batch):
+            if index:
+                await asyncio.sleep(join_period)
+            outwriter.write(('JOIN %s\r\n' % ",".join(channels[index:index + join_batch])).encode("UTF-8"))
+
+    def part(self, channel):
+        bot = self.channels.pop(channel)
+        bot.close()
+        self.send_raw('PART %s\r\n' % channel)
+        log.critical("Bot running in channel %s stopped." % channel)
+
+        if not self.channels:
+            self.mainloopbreak = True
+
+    # Send raw message to Twitch, skipping the outbound queues (PONG, CAP, JOIN...)
+    def send_raw(self, output):
+        self.outwriter.write(output.encode("UTF-8", "replace"))
+
+    async def main(self):
+        while not self.mainloopbreak:
+            # Waits on the connection without polling, idle channels cost no CPU here
+            reader, framer = self.reader, self.framer
+            try:
+                data = await reader.read(framer.readsize)
+            except OSError as ERR_exception:
+                log.error(ERR_exception)
+                data = b""
+
+            # Switched over to the standby connection while waiting, the rest of the old one is deduped
+            if reader is not self.reader:
+                if data:
+                    self.handle_lines(framer.feed(data))
+                continue
+
+            # Checks if socket conn closed, then reconnects (unless a standby connection is about to take over)
+            if not data:
+                standbytask = self.standbytask
+                if standbytask is None or not await standbytask:
+                    await self.reconnect("Lost connection with Twitch IRC server")
+                continue
+
+            lines = framer.feed(data)
+            if lines:
+                self.handle_lines(lines)
+
+            if self.restartreason is not None and not self.mainloopbreak:
+                await self.reconnect(self.restartreason)
+
+        if self.standbytimer is not None:
+            self.standbytimer.cancel()
+        await self.outwriter.drain()
+
+    def handle_lines(self, lines):
+        # Parse lines, fields and the display string are only decoded when first used
+        self.handle_messages([self.parser.parse(line) for line in lines])
+
+    def handle_messages(self, messages):
+        active = []
+        for info in messages:
+            log.debug("%r", info.raw)
+
+            # Messages arriving on both connections while switching over are only dealt with once
+            if self.seenids is not None:
+                msgid = info.tags.get("id")
+                if msgid:
+                    if msgid in self.seenids:
+                        continue
+                    self.seenids[msgid] = None
+
+            # Whispers aren't sent to a channel, every channel checks whether it is addressed
+            if info.identifier == "whisper":
+                targets = list(self.channels.values())
+            else:
+                bot = self.channels.get(info.channel)
+                targets = [bot] if bot is not None else []
+
+            # Chat messages are displayed by their channel once the sender's userlevel is known
+            if info.identifier != "privmsg" and info.display:
+                (targets[0].log if len(targets) == 1 else log).info("[%s] :| %s", info.parsetype.upper(), info)
+
+            # Find and deal with periodic ping request (approx. every 5 minutes,
+            # socket disconnect after 11 minutes)
+            if info.identifier == "PING":
+                self.send_raw("PONG :%s\r\n" % info["pingstring"])
+
+            # Twitch is about to restart this server, a standby connection takes over without a gap
+            if info.identifier == "RECONNECT":
+                self.switchover("Twitch sent RECONNECT")
+
+            # A confirmed JOIN resets the reconnect backoff
+            if info.identifier == "366":
+                self.attempts = 0
+
+            # A fault in one channel's handlers is logged there and doesn't reach the other channels
+            for bot in targets:
+                try:
+                    if bot not in active:
+                        active.append(bot)
+                        bot.start_chunk()
+                    bot.handle_line(info)
+                except Exception:
+                    bot.log.exception("Handling %r failed", info.raw)
+
+        for bot in active:
+            try:
+                bot.end_chunk()
+            except Exception:
+                bot.log.exception("Finishing a chunk of messages failed")
+            if bot.mainloopbreak:
+                self.part(bot.irc.CHANNEL)
+
+
+class IRC:
+    # A single joined channel, everything sent to it is paced by its own outbound queue
+    def __init__(self, channel, connection):
+        # Initializes all class variables
+        self.connection = connection
+        self.CHANNEL = channel
+        # Records of this channel also go to its own raw log, the parent logger prints them all
+        self.log = log.getChild(channel)
 
         self.privmsg_str = u"PRIVMSG {channel} :".format(channel=self.CHANNEL)
+        self.privmsg_bytes = self.privmsg_str.encode("UTF-8")
+        self.outbound = _network.OutboundQueue(connection.chatbucket, connection.whisperbuckets,
+                                               connection.modbucket)
         self.custom = False
         self.silence = False
 
@@ -51,392 +371,311 @@ class IRC:
             self.custom = fileread.readline().strip("\n")
             self.silence = fileread.readline().strip("\n")
 
-    def init(self):
-        try:
-            sock.connect((self.HOST, self.PORT))
-            sock.settimeout(0.01)
-            self.send_raw('CAP REQ :twitch.tv/membership\r\n')
-            self.send_raw('CAP REQ :twitch.tv/tags\r\n')
-            self.send_raw('CAP REQ :twitch.tv/commands\r\n')
-            self.send_raw('PASS %s\r\n' % self.PASSWORD)
-            self.send_raw('NICK %s\r\n' % self.USERNAME)
-            self.send_raw('JOIN %s\r\n' % self.CHANNEL)
-        except Exception as ERR_exception:
-            log.critical(ERR_exception)
-
-    # Send raw message to Twitch
     def send_raw(self, output):
-        try:
-            sock.send(output.format(channel=self.CHANNEL).encode("UTF-8"))
-        except UnicodeEncodeError as UnicodeErr:
-            self.send_whisper(":: ".join(["Unicode Error in send_raw", str(UnicodeErr)]),
-                              "floppydisk_")
+        self.connection.send_raw(output)
+
+    # Queue a chat message, it is sent once Twitch's rate limits allow it. Only the message body is
+    # encoded here (never formatted), the "PRIVMSG #channel :" prefix is pre-encoded once.
+    def send_queued(self, output, lane):
+        self.outbound.put(b"".join((self.privmsg_bytes, output.encode("UTF-8", "replace"), b"\r\n")), lane)
 
     def send_privmsg(self, output, me=False):
         if not self.silence:
-            try:
-                me = '/me : ' if me else ''
-                custom = self.custom if self.custom else ''
-                formatted_output = u"%s%s{output}\r\n"\
-                                   .format(output=output) % (me, custom)
-
-                self.send_raw(self.privmsg_str + formatted_output)
-                log.info("[PRIVMSG] :| [SENT] %s: %s", self.CHANNEL, formatted_output.strip("\r\n"))
+            me = '/me : ' if me else ''
+            custom = self.custom if self.custom else ''
+            formatted_output = u"".join((me, custom, str(output)))
 
-            except UnicodeEncodeError as UnicodeErr:
-                self.send_whisper(":: ".join(["Unicode Error in send_privmsg", str(UnicodeErr)]),
-                                  "floppydisk_")
+            self.send_queued(formatted_output, "chat")
+            self.log.info("[PRIVMSG] :| [SENT] %s: %s", self.CHANNEL, formatted_output)
 
     def send_timeout(self, output, target, duration):
         if not self.silence:
-            try:
-                custom = self.custom if self.custom else ''
-                self.send_raw(self.privmsg_str + u'.timeout {target} {duration} %s{reason}\r\n'
-                              .format(target=target,
-                                      duration=duration,
-                                      reason=output)) % custom
-
-            except UnicodeEncodeError as UnicodeErr:
-                self.send_whisper(":: ".join(["Unicode Error in send_timeout", str(UnicodeErr)]),
-                                  "floppydisk_")
+            custom = self.custom if self.custom else ''
+            self.send_queued(u"".join((".timeout ", target, " ", str(duration), " ", custom, output)), "moderation")
 
     def send_ban(self, output, target):
         if not self.silence:
-            try:
-                custom = self.custom if self.custom else ''
-                self.send_raw(self.privmsg_str + u'.ban {target} %s{reason}\r\n'
-                              .format(target=target,
-                                      reason=output)) % custom
-
-            except UnicodeEncodeError as UnicodeErr:
-                self.send_whisper(":: ".join(["Unicode Error in send_ban", str(UnicodeErr)]),
-                                  "floppydisk_")
+            custom = self.custom if self.custom else ''
+            self.send_queued(u"".join((".ban ", target, " ", custom, output)), "moderation")
 
     def send_whisper(self, output, target):
         if not self.silence:
-            try:
-                custom = self.custom if self.custom else ''
-                formatted_output = u".w {target} %s{output}\r\n"\
-                                   .format(target=target, output=output) % custom
-                self.send_raw(self.privmsg_str + formatted_output)
-                log.info("[WHISPER] :| [SENT] %s: %s" % (self.CHANNEL, formatted_output.strip("\r\n")))
+            custom = self.custom if self.custom else ''
+            formatted_output = u"".join((".w ", target, " ", custom, str(output)))
+            self.send_queued(formatted_output, "whisper")
+            self.log.info("[WHISPER] :| [SENT] %s: %s", self.CHANNEL, formatted_output)
+
 
-            except UnicodeEncodeError as UnicodeErr:
-                self.send_whisper(u":: ".join(["Unicode Error in send_whisper", str(UnicodeErr)]),
-                                  "floppydisk_")
+def databasepath(filename):
+    if sys.platform == "linux2":
+        return 'SLB.sqlDatabase/{}'.format(filename)
+    return os.path.dirname(os.path.abspath(__file__)) + '\\SLB.sqlDatabase\\{}'.format(filename)
 
 
-# Class housing main loop for SLB
+# Class housing everything kept per channel: its SQLite handle, config defaults and log files
 class Bot:
-    def __init__(self):
-        sock.settimeout(0.01)
-        self.data = "."
-        self.databuffer = ''
-        self.temp = ''
+    def __init__(self, irc):
+        self.irc = irc
+        self.log = irc.log
         self.currentdatetime = 0
         self.currentdatetimelist = []
-        self.olddatetime = 0
-        self.olddatetimelist = []
         self.startmarkloop = 0
         self.endmarkloop = 0
         self.previous_line = None
         self.mainloopbreak = False
 
         self.logFile = None
-        self.logFileFormat = None
-        self.logDate = None
-        self.chatLogFile = None
+        self.chatlog = None
+        self.compactor = None
+        self.chatindex = None
 
+        self.sqlPath = None
         self.sqlConnectionChannel = None
         self.sqlCursorChannel = None
         self.sqlconn = None
 
         self.configdefaults = None
+        self.funcdiagnose = None
+        self.funcdata = None
 
         self.ignoredusersfile = None
         self.ignoredusersread = None
         self.ignoredusers = None
 
-        self.birthdayusers = {}
+        self.birthdays = None
 
     def init(self):
+        irc = self.irc
         self.currentdatetime = time.gmtime(time.time())
-        self.olddatetime = time.gmtime(time.time())
         self.ignoredusersfile = open('ignoredusers.txt', 'r')
         self.ignoredusersread = self.ignoredusersfile.readlines()
         self.ignoredusers = [username.strip('\n').strip('\r') for username in self.ignoredusersread]
 
-        if not os.path.exists("/".join([os.getcwd(), "logs", irc.CHANNEL, "chat"])):
-            os.makedirs("/".join([os.getcwd(), "logs", irc.CHANNEL, "chat"]))
-
-        if not os.path.exists("/".join([os.getcwd(), "logs", irc.CHANNEL, "raw"])):
-            os.makedirs("/".join([os.getcwd(), "logs", irc.CHANNEL, "raw"]))
-
-        self.logFileFormat = logging.Formatter("<%(asctime)s> %(message)s")
-        self.logFile = logging.FileHandler(encoding="utf-8", filename="/".join([os.getcwd(), "logs",
-                                                                               irc.CHANNEL, "raw",
-                                                                               "{}_rawlog.log".format(
-                                                                                   time.strftime("%Y-%m-%d"))]))
-        self.logFile.setFormatter(self.logFileFormat)
+        # Both stay open for the day and move on to a new file at UTC midnight
+        self.chatlog = _logfiles.ChatLog("/".join([os.getcwd(), "logs", irc.CHANNEL, "chat"]), irc.connection.loop)
+        self.logFile = _logfiles.DailyFileHandler("/".join([os.getcwd(), "logs", irc.CHANNEL, "raw"]),
+                                                  "{}_rawlog.log")
+        self.logFile.setFormatter(logging.Formatter("<%(asctime)s> %(message)s"))
         self.logFile.setLevel(logging.INFO)
-        log.addHandler(self.logFile)
+        _logfiles.router.add(self.log.name, self.logFile)
 
-        if sys.platform == "linux2":
-            self.sqlConnectionChannel = sql.connect('SLB.sqlDatabase/{}DB.db'
-                                                    .format(IRC().CHANNEL.strip("#")))
-        else:
-            self.sqlConnectionChannel = sql.connect(os.path.dirname(os.path.abspath(__file__)) +
-                                                    '\SLB.sqlDatabase\{}DB.db'
-                                                    .format(IRC().CHANNEL.strip("#").strip("\n")))
+        # Finished days are rolled into compressed segments, see _archive
+        self.compactor = _archive.Compactor(irc.CHANNEL, irc.connection.loop, "/".join([os.getcwd(), "logs"]),
+                                            (self.chatlog, self.logFile))
+        self.compactor.start()
 
+        self.sqlPath = databasepath("{}DB.db".format(irc.CHANNEL.strip("#").strip("\n")))
+
+        self.sqlConnectionChannel = _database.connect(self.sqlPath)
         self.sqlCursorChannel = self.sqlConnectionChannel.cursor()
         self.sqlconn = (self.sqlConnectionChannel, self.sqlCursorChannel)
 
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS birthdays(userid TEXT, username TEXT, displayname TEXT, date TEXT)'
-        )
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS commands(userlevel INTEGER, keyword TEXT, output TEXT, args INTEGER, '
-            'sendtype TEXT, syntaxerr TEXT)'
-        )
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS config(grouping TEXT, variable TEXT, value TEXT, args TEXT, userlevel INTEGER)'
-        )
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS faq(userlevel INTEGER, name TEXT, regex TEXT, output TEXT, sendtype TEXT)'
-        )
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS regulars(userid INTEGER, username TEXT)'
-        )
-
-        self.sqlConnectionChannel.commit()
+        _database.migrate(self.sqlconn)
+        # Writes made while handling chat go through this thread and its own connection
+        _database.openwriter(self.sqlconn, self.sqlPath)
+
+        # Chat history search of this channel, see default_commands.logs
+        self.chatindex = _search.openindex(
+            databasepath("{}_chatsearch.db".format(irc.CHANNEL.strip("#").strip("\n"))), irc.connection.loop)
+
+        # Faq and filter regexes run in this worker process, started now rather than on the first chat message
+        _patterns.sandbox.start()
 
         ConfigDefaults(self.sqlconn).all_(2)
 
         self.configdefaults = ConfigDefaults(self.sqlconn)
 
-        for command in default_commands.dispatch_naming.keys():
-            if command == "config":
-                continue
-            commandkeyword = self.sqlCursorChannel.execute(
-                "SELECT value FROM config WHERE grouping=? AND variable=?", (command, "keyword")
-            ).fetchone()[0]
-            default_commands.dispatch_naming[command] = commandkeyword
-
-        self.olddatetimelist = [int(self.olddatetime[index]) for index in range(0, 6)]
         self.currentdatetimelist = [int(self.currentdatetime[index]) for index in range(0, 6)]
 
-        self.birthdayusers = default_commands.birthdays.getbirthdayusers(self.sqlconn,
-                                                                         self.configdefaults,
-                                                                         self.currentdatetimelist)
+        # Today's birthdays, kept up to date by timers on the event loop
+        self.birthdays = default_commands.birthdays.BirthdaySchedule(irc, self.sqlconn, self.configdefaults)
+        self.birthdays.start()
+
+        # Shorten function calls and create instance
+        self.funcdiagnose = _functions.Diagnostic(irc, self.sqlconn)
+        self.funcdata = _functions.Data(irc, self.sqlconn)
 
         return
 
-    def main(self):
-        while not self.mainloopbreak:
-            try:
-                try:
-                    # Attempts a data grab from twitch
-                    self.data = sock.recv(1024).decode("UTF-8")
-                    self.databuffer = self.databuffer + self.data  # Appends data received to buffer
-                    self.temp = self.databuffer.rsplit('\n')  # Splits buffer into list
-                    self.databuffer = self.temp.pop()  # Grabs the last list item and assigns to buffer
-
-                except socket.timeout:
-                    self.temp = []  # Makes empty list if socket returns None
-
-                # Checks if socket conn closed, then restarts
-                if len(self.data) == 0:
-                    _funcdiagnose.bot_restart("Lost connection with Twitch IRC server", user_loggingchoice)
-
-                self.logDate = time.strftime("%Y-%m-%d")
-                if sys.platform == "linux2":
-                    self.chatLogFile = open('logs/{channel}/chat/{logDate}_log.log'
-                                            .format(channel=irc.CHANNEL, logDate=self.logDate),
-                                            'a+')
-                else:
-                    self.chatLogFile = open('logs/{channel}/chat/{logDate}_log.log'
-                                            .format(channel=irc.CHANNEL, logDate=self.logDate),
-                                            'a+', encoding="utf-8")
-
-                # Captures current time for response time measuring
-                if self.temp:
-                    self.olddatetime = self.currentdatetime
-                    self.olddatetimelist = list(map(int, self.olddatetime))
-                    self.currentdatetime = time.gmtime(time.time())
-                    self.currentdatetimelist = list(map(int, self.currentdatetime))
-
-                    self.startmarkloop = time.time()
-                    log.debug("START MARK")
-
-                    if self.currentdatetimelist[2] - self.olddatetimelist[2]:
-                        log.removeHandler(self.logFile)
-                        self.logFile = logging.FileHandler(filename="/".join([os.getcwd(), "logs",
-                                                                              irc.CHANNEL, "raw",
-                                                                              "{}_rawlog.log".format(
-                                                                                  time.strftime("%Y-%m-%d"))]))
-                        log.addHandler(self.logFile)
-
-                        self.birthdayusers = default_commands.birthdays.getbirthdayusers(self.sqlconn,
-                                                                                         self.configdefaults,
-                                                                                         self.currentdatetimelist)
-                        log.info("[_BOTCOM] :| [CVAR] {channel}: Birthday users: %s".format(channel=irc.CHANNEL) % list(self.birthdayusers.keys()))
-
-                else:
-                    continue
-
-                # Loop for dealing with each item separately
-                for line in self.temp:
-                    log.debug(repr(line))
-
-                    # Parse and extract data from line and display formatted string
-                    parsetype, identifier, info, display, parsed = _functions.Parse(irc, self.sqlconn, line).parse()
-
-                    if display:
-                        log.info("[%s] :| %s", parsetype.upper(), parsed)
-
-                    if "username" in list(info.keys()) and info["username"] in self.ignoredusers:
-                        if identifier == "privmsg":
-                            try:
-                                temp_log_output = "<%02d:%02d:%02d> {---} [%s]: %s\n" % (
-                                    self.currentdatetimelist[3], self.currentdatetimelist[4],
-                                    self.currentdatetimelist[5], info["username"], info["privmsg"])
-
-                                self.chatLogFile.write(temp_log_output)
-                            except UnicodeEncodeError as e:
-                                log.exception(str(e))
+    def close(self):
+        self.irc.outbound.stop(self.irc.connection.outwriter)
+        self.birthdays.stop()
+        self.funcdata.flush()
+        self.chatlog.close()
+        self.compactor.stop()
+        _logfiles.router.remove(self.log.name, self.logFile)
+        self.logFile.close()
+        default_commands.constants.dropcache(self.sqlconn)
+        default_commands.commands.droptable(self.sqlconn)
+        default_commands.faq.droptable(self.sqlconn)
+        _database.closewriter(self.sqlconn)
+        self.sqlCursorChannel.close()
+        self.sqlConnectionChannel.close()
+
+    def start_chunk(self):
+        # Captures current time for response time measuring
+        self.currentdatetime = time.gmtime(time.time())
+        self.currentdatetimelist = list(map(int, self.currentdatetime))
 
-                        continue
+        self.startmarkloop = time.time()
+        self.log.debug("START MARK")
 
-                    if identifier == "366":
-                        log.info("[_BOTCOM] :| [JOIN] Joined %s Successfully..." % irc.CHANNEL)
-
-                    # Find and deal with periodic ping request (approx. every 5 minutes,
-                    # socket disconnect after 11 minutes)
-                    if identifier == "PING":
-                        pingstring = info["pingstring"]
-                        pingstring = pingstring.replace(":", "").strip("\r")
-                        irc.send_raw("PONG%s\r\n" % pingstring)
-
-                    if identifier == "JOIN":
-                        default_commands.birthdays.joinevent(irc, self.configdefaults,
-                                                             self.birthdayusers, info["username"])
-
-                    if identifier == "PART":
-                        pass
-
-                    # Find and deal with user chat messages, majority of activity occurs here
-                    if identifier == "privmsg":
-                        handleuserlevel = (info["user-id"], info["username"], info["user-type"],
-                                           info["subscriber"], info["turbo"])
-
-                        # Determines user's status as an integer
-                        #   0 - Normal users
-                        #  50 - Turbo
-                        # 100 - Subscribers
-                        # 150 - Regulars
-                        # 250 - Moderators
-                        # 350 - Global Moderators
-                        # 400 - Broadcaster
-                        # 500 - Admin
-                        # 600 - Staff
-                        # 700 - FloppyDisk_
-
-                        userlevel = _funcdata.handleUserLevel(handleuserlevel)
-                        info["userlevel"] = userlevel
-
-                        try:
-                            temp_log_output = "<%02d:%02d:%02d> {%s} [%s]: %s\n" % (
-                                self.currentdatetimelist[3], self.currentdatetimelist[4],
-                                self.currentdatetimelist[5], info["userlevel"],
-                                info["username"], info["privmsg"])
-
-                            self.chatLogFile.write(temp_log_output)
-                        except UnicodeEncodeError as e:
-                            log.exception(str(e))
-
-                        # Passes user through filters if permission level is under 250
-                        # if userlevel < 250:
-                        #     if filters.filters(irc, self.sqlconn, info).linkprotection():
-                        #         continue  # If one of the filters return True, the user is omitted
-
-                        # -=-=-=-=-=-=-= Non-restricted users past this point =-=-=-=-=-=-=-
-
-                        default_commands.commands.customCommands(bot, irc, self.sqlconn, info)
-
-                        if info["userlevel"] >= 700 and info["privmsg"].startswith("$forcerestart"):
-                            _funcdiagnose.bot_restart("Forced restart by bot admin", user_loggingchoice)
-
-                    # Find and deal with whispers
-                    if identifier == "whisper":
-                        if irc.CHANNEL in info['privmsg']:
-                            log.info("[%s] :| %s", parsetype.upper(), parsed)
-
-                        handleuserlevel = (info["user-id"], info["username"], info["user-type"],
-                                           0, info["turbo"])
-                        userlevel = _funcdata.handleUserLevel(handleuserlevel, True)
-                        info["userlevel"] = userlevel
-
-                        temp_split_message = info["privmsg"].split(" ")
-                        if info["username"] == 'floppydisk_':
-                            if temp_split_message[0] == '!reload':
-                                log.warning("IMPORTANT: Reloading app resources")
-                                try:
-                                    _reloadbot.reloadall()
-                                except Exception as e:
-                                    log.error(e)
-
-                            if temp_split_message[0] == '$forcerestart':
-                                if len(temp_split_message) == 2:
-                                    if temp_split_message[1] in ('all', irc.CHANNEL):
-                                        _funcdiagnose.bot_restart("Forced restart by admin", user_loggingchoice)
-                                elif len(temp_split_message) > 2:
-                                    if temp_split_message[1] in ('all', irc.CHANNEL):
-                                        if temp_split_message[2] in ('/me', '.me'):
-                                            irc.send_privmsg(" ".join(temp_split_message[3:]), True)
-                                        else:
-                                            irc.send_privmsg(" ".join(temp_split_message[2:]))
-
-                                        _funcdiagnose.bot_restart("Forced restart by admin", user_loggingchoice)
-
-                            if temp_split_message[0] == '$stop':
-                                if len(temp_split_message) == 2:
-                                    if temp_split_message[1] in ('all', irc.CHANNEL):
-                                        self.mainloopbreak = True
-
-                                elif len(temp_split_message) > 2:
-                                    if temp_split_message[1] in ('all', irc.CHANNEL):
-                                        if temp_split_message[2] in ('/me', '.me'):
-                                            irc.send_privmsg(" ".join(temp_split_message[3:]), True)
-                                        else:
-                                            irc.send_privmsg(" ".join(temp_split_message[2:]))
-
-                                        self.mainloopbreak = True
-
-                            if temp_split_message[0] == '$send' and userlevel >= 400:
-                                if len(temp_split_message) <= 2:
-                                    irc.send_whisper("Error: Not enough arguments.", info["username"])
-
-                                if len(temp_split_message) > 2:
-                                    if temp_split_message[1] == irc.CHANNEL or \
-                                            (temp_split_message[1] == 'all' and userlevel >= 700):
-                                        if temp_split_message[2] in ('/me', '.me'):
-                                            irc.send_privmsg(" ".join(temp_split_message[3:]), True)
-                                        else:
-                                            irc.send_privmsg(" ".join(temp_split_message[2:]))
-
-                        if temp_split_message[0] == irc.CHANNEL:
-                            default_commands.commands.customCommands(bot, irc, self.sqlconn, info,
-                                                                     " ".join(temp_split_message[1:]), True)
-
-                    if self.temp.index(line) == len(self.temp) - 1:
-                        self.endmarkloop = time.time()
-                        log.debug("END MARK: Dealt with data chunk in %s milliseconds." %
-                                  ((self.endmarkloop - self.startmarkloop) * 1000))
-
-            except KeyboardInterrupt:
-                log.critical('Process Interrupted by KeyboardInterrupt')
-                self.mainloopbreak = True
+    def handle_line(self, info):
+        irc = self.irc
+        parsetype, identifier = info.parsetype, info.identifier
+
+        if "username" in info and info["username"] in self.ignoredusers:
+            if identifier == "privmsg":
+                self.log.info("[%s] :| %s", parsetype.upper(), info)
+                try:
+                    temp_log_output = "<%02d:%02d:%02d> {---} [%s]: %s\n" % (
+                        self.currentdatetimelist[3], self.currentdatetimelist[4],
+                        self.currentdatetimelist[5], info["username"], info["privmsg"])
+
+                    self.chatlog.write(temp_log_output)
+                    self.chatindex.add(irc.CHANNEL, time.time(), info["user-id"], info["username"], info["privmsg"])
+                except UnicodeEncodeError as e:
+                    self.log.exception(str(e))
+
+            return
+
+        if identifier == "366":
+            self.log.info("[_BOTCOM] :| [JOIN] Joined %s Successfully..." % irc.CHANNEL)
+
+        # Moderators get a higher chat limit and aren't affected by slow mode
+        if identifier == "USERSTATE":
+            irc.outbound.setmoderator(info.get("mod") == "1" or "broadcaster" in info.badges)
+
+        if identifier == "ROOMSTATE":
+            if "slowmode" in info:
+                irc.outbound.setslowmode(info["slowmode"])
+            elif info.get("updatetype") == "slow":
+                irc.outbound.setslowmode(info["updatevalue"])
+
+        if identifier == "JOIN":
+            default_commands.birthdays.joinevent(irc, self.configdefaults,
+                                                 self.birthdays, info["username"])
+
+        if identifier == "PART":
+            pass
+
+        # Find and deal with user chat messages, majority of activity occurs here
+        if identifier == "privmsg":
+            handleuserlevel = (info["user-id"], info["username"], info["user-type"],
+                               info["subscriber"], info["turbo"])
+
+            # Determines user's status as an integer
+            #   0 - Normal users
+            #  50 - Turbo
+            # 100 - Subscribers
+            # 150 - Regulars
+            # 250 - Moderators
+            # 350 - Global Moderators
+            # 400 - Broadcaster
+            # 500 - Admin
+            # 600 - Staff
+            # 700 - FloppyDisk_
+
+            userlevel = self.funcdata.handleUserLevel(handleuserlevel)
+            info["userlevel"] = userlevel
+            self.log.info("[%s] :| %s", parsetype.upper(), info)
+
+            try:
+                temp_log_output = "<%02d:%02d:%02d> {%s} [%s]: %s\n" % (
+                    self.currentdatetimelist[3], self.currentdatetimelist[4],
+                    self.currentdatetimelist[5], info["userlevel"],
+                    info["username"], info["privmsg"])
+
+                self.chatlog.write(temp_log_output)
+                self.chatindex.add(irc.CHANNEL, time.time(), info["user-id"], info["username"], info["privmsg"])
+            except UnicodeEncodeError as e:
+                self.log.exception(str(e))
+
+            # Passes user through filters if permission level is under 250
+            # if userlevel < 250:
+            #     irc.connection.loop.create_task(filters.filters(irc, self.sqlconn, info).linkprotection())
+
+            # -=-=-=-=-=-=-= Non-restricted users past this point =-=-=-=-=-=-=-
+
+            default_commands.commands.customCommands(self, irc, self.sqlconn, info)
+            default_commands.faq.matchFaq(self, irc, self.sqlconn, info)
+
+            if info["userlevel"] >= 700 and info["privmsg"].startswith("$forcerestart"):
+                self.funcdiagnose.bot_restart("Forced restart by bot admin")
+
+        # Find and deal with whispers
+        if identifier == "whisper":
+            if irc.CHANNEL in info['privmsg']:
+                self.log.info("[%s] :| %s", parsetype.upper(), info)
+
+            handleuserlevel = (info["user-id"], info["username"], info["user-type"],
+                               0, info["turbo"])
+            userlevel = self.funcdata.handleUserLevel(handleuserlevel, True)
+            info["userlevel"] = userlevel
+
+            temp_split_message = info["privmsg"].split(" ")
+            if info["username"] == 'floppydisk_':
+                if temp_split_message[0] == '!reload':
+                    self.log.warning("IMPORTANT: Reloading app resources")
+                    try:
+                        _reloadbot.reloadall()
+                    except Exception as e:
+                        self.log.error(e)
+
+                if temp_split_message[0] == '$forcerestart':
+                    if len(temp_split_message) == 2:
+                        if temp_split_message[1] in ('all', irc.CHANNEL):
+                            self.funcdiagnose.bot_restart("Forced restart by admin")
+                    elif len(temp_split_message) > 2:
+                        if temp_split_message[1] in ('all', irc.CHANNEL):
+                            if temp_split_message[2] in ('/me', '.me'):
+                                irc.send_privmsg(" ".join(temp_split_message[3:]), True)
+                            else:
+                                irc.send_privmsg(" ".join(temp_split_message[2:]))
+
+                            self.funcdiagnose.bot_restart("Forced restart by admin")
+
+                if temp_split_message[0] == '$stop':
+                    if len(temp_split_message) == 2:
+                        if temp_split_message[1] in ('all', irc.CHANNEL):
+                            self.mainloopbreak = True
+
+                    elif len(temp_split_message) > 2:
+                        if temp_split_message[1] in ('all', irc.CHANNEL):
+                            if temp_split_message[2] in ('/me', '.me'):
+                                irc.send_privmsg(" ".join(temp_split_message[3:]), True)
+                            else:
+                                irc.send_privmsg(" ".join(temp_split_message[2:]))
+
+                            self.mainloopbreak = True
+
+                if temp_split_message[0] == '$send' and userlevel >= 400:
+                    if len(temp_split_message) <= 2:
+                        irc.send_whisper("Error: Not enough arguments.", info["username"])
+
+                    if len(temp_split_message) > 2:
+                        if temp_split_message[1] == irc.CHANNEL or \
+                                (temp_split_message[1] == 'all' and userlevel >= 700):
+                            if temp_split_message[2] in ('/me', '.me'):
+                                irc.send_privmsg(" ".join(temp_split_message[3:]), True)
+                            else:
+                                irc.send_privmsg(" ".join(temp_split_message[2:]))
+
+            if temp_split_message[0] == irc.CHANNEL:
+                default_commands.commands.customCommands(self, irc, self.sqlconn, info,
+                                                         " ".join(temp_split_message[1:]), True)
+
+    def end_chunk(self):
+        self.endmarkloop = time.time()
+        self.log.debug("END MARK: Dealt with data chunk in %s milliseconds." %
+                       ((self.endmarkloop - self.startmarkloop) * 1000))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Outbound queue: %s", self.irc.outbound.stats())
+            self.log.debug("Database writer: %s", _database.writer(self.sqlconn).stats())
+            self.log.debug("Command cooldowns: %s",
+                           default_commands.commands.commandtable(self.sqlconn).cooldowns.stats())
+            self.log.debug("Faq matcher: %s", default_commands.faq.faqtable(self.sqlconn).stats())
+            self.log.debug("Regex sandbox: %s", _patterns.sandbox.stats())
 
 
 if __name__ == '__main__':
@@ -457,25 +696,51 @@ if __name__ == '__main__':
 
     # Set logging formatting default
     logging.basicConfig(format='<%(asctime)s> %(filename)s:%(levelname)s:%(lineno)s: %(message)s')
-    log = logging.getLogger("StrongLegsBot")
     log.setLevel(logging_level)
 
+    # Console and log files are written by a background thread, the event loop only queues records
+    loglistener = _logfiles.startlistener()
+
     # logStreamFormat = logging.Formatter('<%(asctime)s> %(filename)s:%(levelname)s:%(lineno)s: %(message)s')
     # logStream = logging.StreamHandler(stream=sys.stdout)
     # logStream.setFormatter(logStreamFormat)
     # logStream.setLevel(logging_level)
     # log.addHandler(logStream)
 
-    # Create instances of each class in StrongLegsBot and initialize IRC conn
-    irc = IRC()
-    irc.init()
-    bot = Bot()
-    bot.init()
-
-    # Shorten function calls and create instance
-    _funcdiagnose = _functions.Diagnostic(irc, bot.sqlconn)
-    _funcdata = _functions.Data(irc, bot.sqlconn)
-
-    bot.main()
-    log.critical("Bot running in channel %s stopped." % irc.CHANNEL)
+    # One or more channels, comma separated: StrongLegsBot.py #channel1,#channel2 [logging level]
+    channels = []
+    for channel in (sys.argv[1] if len(sys.argv) > 1 else "#floppydisk_").split(","):
+        channel = channel.strip().lower()
+        if channel and not channel.startswith("#"):
+            channel = "#" + channel
+        if channel and channel not in channels:
+            channels.append(channel)
+
+    async def run():
+        # Every connection, its channels, timers and API calls share one event loop
+        connections = [Connection(channels[index:index + channels_per_connection])
+                       for index in range(0, len(channels), channels_per_connection)]
+        try:
+            for connection in connections:
+                await connection.init()
+
+            await asyncio.gather(*(connection.main() for connection in connections))
+        finally:
+            # Userlevels changed since the last flush are still only in memory, and queued writes uncommitted
+            for connection in connections:
+                for bot in connection.channels.values():
+                    if bot.funcdata is not None:
+                        bot.funcdata.flush()
+                    if bot.sqlconn is not None:
+                        _database.closewriter(bot.sqlconn)
+            _search.closeindex()
+            _patterns.sandbox.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        log.critical('Process Interrupted by KeyboardInterrupt')
+
+    log.critical("Bot running in channel(s) %s stopped." % ", ".join(channels))
+    loglistener.stop()
     sys.exit()
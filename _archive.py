@@ -0,0 +1,225 @@
+"""
+Copyright 2016 Pawel Bartusiak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Finished days of logs/<channel>/chat and logs/<channel>/raw are rolled into compressed segments:
+#   <date>_log.seg      zlib compressed blocks of whole lines, each about blocksize bytes before compression
+#   <date>_log.idx      JSON sidecar (<date>_rawlog.seg/.idx for the raw logs), "blocks": [[offset, length, first timestamp, last timestamp], ...]
+#                       and "users": {username: [block ids]}
+# open_range() reads them back, decompressing only the blocks that overlap the requested time range.
+
+import calendar
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import time
+import zlib
+
+blocksize = 65536
+
+# Chat lines are '<HH:MM:SS> {userlevel} [username]: message' in UTC, raw lines start with the
+# logging asctime '<YYYY-MM-DD HH:MM:SS,mmm>' in local time
+chatline = re.compile(r'<(\d{2}):(\d{2}):(\d{2})> \{[^}]*\} \[([^\]]+)\]: ')
+rawline = re.compile(r'<(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2}),\d{3}> ')
+rawuser = re.compile(r'\{[^}]*\} \[([^\]]+)\]: ')
+
+kinds = {
+    "chat": ("chat", "{}_log"),
+    "raw": ("raw", "{}_rawlog"),
+}
+
+
+def parseline(kind, day, line):
+    # (timestamp, username) of a line, either may be None
+    if kind == "chat":
+        match = chatline.match(line)
+        if match is None:
+            return None, None
+        hour, minute, second = (int(part) for part in match.group(1, 2, 3))
+        return calendar.timegm((day.year, day.month, day.day, hour, minute, second)), match.group(4)
+
+    match = rawline.match(line)
+    if match is None:
+        return None, None
+    user = rawuser.search(line, match.end())
+    return (time.mktime(tuple(int(part) for part in match.groups()) + (0, 0, -1)),
+            user.group(1) if user is not None else None)
+
+
+def compactfile(kind, path, day):
+    base = path[:-len(".log")]
+    blocks = []
+    users = {}
+
+    with open(path, 'rb') as source, open(base + ".seg.tmp", 'wb') as segment:
+        offset = 0
+        timestamp = calendar.timegm(day.timetuple())
+
+        while True:
+            chunk = source.read(blocksize)
+            if not chunk:
+                break
+            # Blocks end on a line break so every block decompresses to whole lines
+            if not chunk.endswith(b"\n"):
+                chunk += source.readline()
+
+            first = None
+            for line in chunk.decode("utf-8", "replace").splitlines():
+                linetime, username = parseline(kind, day, line)
+                if linetime is not None:
+                    timestamp = linetime
+                if first is None:
+                    first = timestamp
+                if username is not None:
+                    blockids = users.setdefault(username, [])
+                    if not blockids or blockids[-1] != len(blocks):
+                        blockids.append(len(blocks))
+
+            compressed = zlib.compress(chunk, 9)
+            segment.write(compressed)
+            blocks.append([offset, len(compressed), first, timestamp])
+            offset += len(compressed)
+
+    with open(base + ".idx.tmp", 'w', encoding="utf-8") as index:
+        json.dump({"blocks": blocks, "users": users}, index)
+
+    os.replace(base + ".seg.tmp", base + ".seg")
+    os.replace(base + ".idx.tmp", base + ".idx")
+    os.remove(path)
+    return os.path.getsize(base + ".seg")
+
+
+def compact(channel, directory="logs", today=None, active=()):
+    # Compacts every day before today (UTC) of a channel's chat and raw logs, returns (bytes before, bytes after).
+    # Files in active are still open for writing and left alone.
+    today = today if today is not None else datetime.datetime.utcnow().date()
+    active = {os.path.abspath(path) for path in active}
+    before = after = 0
+
+    for kind, (folder, template) in kinds.items():
+        for path in sorted(glob.glob(os.path.join(directory, glob.escape(channel), folder,
+                                                  template.format("*") + ".log"))):
+            try:
+                day = datetime.datetime.strptime(os.path.basename(path).split("_")[0], "%Y-%m-%d").date()
+            except ValueError:
+                continue
+            if day >= today:
+                continue
+            if os.path.abspath(path) in active:
+                logging.warning("Not compacting %s, it is still open", path)
+                continue
+
+            try:
+                size = os.path.getsize(path)
+                after += compactfile(kind, path, day)
+                before += size
+            except OSError as e:
+                logging.error("Couldn't compact %s: %s", path, e)
+
+    if before:
+        logging.info("Compacted logs of %s from %d to %d bytes", channel, before, after)
+    return before, after
+
+
+def open_range(channel, start, end, directory="logs", kind="chat", username=None):
+    # Yields (timestamp, line) of every line logged from start up to (not including) end, both Unix
+    # timestamps. With a username only that user's lines are returned, and only blocks they wrote in
+    # are read. Days not compacted yet are read from their plain log file.
+    folder, template = kinds[kind]
+    day = datetime.datetime.utcfromtimestamp(start).date() - datetime.timedelta(days=1)
+    lastday = datetime.datetime.utcfromtimestamp(end).date() + datetime.timedelta(days=1)
+
+    while day <= lastday:
+        base = os.path.join(directory, channel, folder, template.format(day.isoformat()))
+        if os.path.exists(base + ".idx"):
+            lines = readsegment(base, kind, day, start, end, username)
+        elif os.path.exists(base + ".log"):
+            lines = readplain(base + ".log", kind, day)
+        else:
+            lines = ()
+
+        for timestamp, linename, line in lines:
+            if start <= timestamp < end and (username is None or linename == username):
+                yield timestamp, line
+
+        day += datetime.timedelta(days=1)
+
+
+def readsegment(base, kind, day, start, end, username):
+    with open(base + ".idx", encoding="utf-8") as index:
+        index = json.load(index)
+
+    blockids = range(len(index["blocks"]))
+    if username is not None:
+        blockids = index["users"].get(username, [])
+
+    with open(base + ".seg", 'rb') as segment:
+        for blockid in blockids:
+            offset, length, first, last = index["blocks"][blockid]
+            if last < start or first >= end:
+                continue
+
+            segment.seek(offset)
+            timestamp = first
+            for line in zlib.decompress(segment.read(length)).decode("utf-8", "replace").splitlines():
+                linetime, linename = parseline(kind, day, line)
+                timestamp = linetime if linetime is not None else timestamp
+                yield timestamp, linename, line
+
+
+def readplain(path, kind, day):
+    timestamp = calendar.timegm(day.timetuple())
+    with open(path, encoding="utf-8", errors="replace") as source:
+        for line in source:
+            linetime, linename = parseline(kind, day, line)
+            timestamp = linetime if linetime is not None else timestamp
+            yield timestamp, linename, line.rstrip("\n")
+
+
+class Compactor:
+    # Compacts a channel's logs on start and shortly after every UTC midnight, in the loop's default executor.
+    # The channel's log files (ChatLog, DailyFileHandler) are rotated first so the previous day's are closed.
+    delay = 300
+
+    def __init__(self, channel, loop, directory="logs", logfiles=()):
+        self.channel = channel
+        self.loop = loop
+        self.directory = directory
+        self.logfiles = logfiles
+        self.timer = None
+
+    def start(self):
+        self.run()
+
+    def run(self):
+        now = time.time()
+        active = []
+        for logfile in self.logfiles:
+            logfile.rotate(now)
+            path = logfile.active()
+            if path is not None:
+                active.append(path)
+
+        self.loop.run_in_executor(None, compact, self.channel, self.directory, None, active)
+
+        self.timer = self.loop.call_later(86400 - now % 86400 + self.delay, self.run)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
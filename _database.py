@@ -0,0 +1,290 @@
+"""
+Copyright 2016 Pawel Bartusiak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import queue
+import sqlite3 as sql
+import threading
+import time
+
+
+# DatabaseWriter of every open channel database, keyed by its sqlite3 connection (which can't be weakly referenced)
+writers = {}
+
+
+def connect(path, check_same_thread=True):
+    connection = sql.connect(path, check_same_thread=check_same_thread)
+    # WAL lets readers carry on while a write commits, and with it NORMAL only syncs at checkpoints
+    # instead of on every commit. A power cut can lose the last commits but never corrupts the file.
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def rebuild(cursor, table, create, key, keep="MIN", where=None):
+    # SQLite can't add a primary key to an existing table, so the table is copied into a new one.
+    # Of any rows sharing a key only the first (MIN) or the latest (MAX) is copied.
+    cursor.execute('ALTER TABLE {table} RENAME TO {table}_old'.format(table=table))
+    cursor.execute(create)
+    cursor.execute('INSERT INTO {table} SELECT * FROM {table}_old WHERE rowid IN '
+                   '(SELECT {keep}(rowid) FROM {table}_old {where} GROUP BY {key})'
+                   .format(table=table, keep=keep, key=key, where="WHERE " + where if where else ""))
+    logging.info("Copied %d of %d rows into the new %s table",
+                 cursor.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0],
+                 cursor.execute('SELECT COUNT(*) FROM {}_old'.format(table)).fetchone()[0], table)
+    cursor.execute('DROP TABLE {}_old'.format(table))
+
+
+def createtables(cursor):
+    # The tables as they were created before the schema had a version
+    cursor.execute('CREATE TABLE IF NOT EXISTS birthdays(userid TEXT, username TEXT, displayname TEXT, date TEXT)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS commands(userlevel INTEGER, keyword TEXT, output TEXT, args INTEGER, '
+                   'sendtype TEXT, syntaxerr TEXT)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS config(grouping TEXT, variable TEXT, value TEXT, args TEXT, '
+                   'userlevel INTEGER)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS faq(userlevel INTEGER, name TEXT, regex TEXT, output TEXT, '
+                   'sendtype TEXT)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS regulars(userid INTEGER, username TEXT)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS userLevel(userid INTEGER, userlevel INTEGER, username TEXT)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS filters(filtertype TEXT, enabled TEXT, maxuserlevel INTEGER, '
+                   'first_timeout INTEGER, second_timeout INTEGER, third_timeout INTEGER, ban_after_third TEXT, '
+                   'message TEXT)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS offenses(userid INTEGER, username TEXT, offenses INTEGER)')
+
+
+def addkeys(cursor):
+    # Keyed tables, duplicates left behind by older versions are dropped on the way
+    rebuild(cursor, 'birthdays',
+            'CREATE TABLE birthdays(userid TEXT PRIMARY KEY, username TEXT, displayname TEXT, date TEXT)',
+            'userid', keep="MAX")
+    rebuild(cursor, 'commands',
+            'CREATE TABLE commands(userlevel INTEGER, keyword TEXT PRIMARY KEY, output TEXT, args INTEGER, '
+            'sendtype TEXT, syntaxerr TEXT)',
+            'keyword')
+    rebuild(cursor, 'config',
+            'CREATE TABLE config(grouping TEXT, variable TEXT, value TEXT, args TEXT, userlevel INTEGER, '
+            'PRIMARY KEY (grouping, variable))',
+            'grouping, variable')
+    rebuild(cursor, 'faq',
+            'CREATE TABLE faq(userlevel INTEGER, name TEXT PRIMARY KEY, regex TEXT, output TEXT, sendtype TEXT)',
+            'name')
+    rebuild(cursor, 'filters',
+            'CREATE TABLE filters(filtertype TEXT PRIMARY KEY, enabled TEXT, maxuserlevel INTEGER, '
+            'first_timeout INTEGER, second_timeout INTEGER, third_timeout INTEGER, ban_after_third TEXT, '
+            'message TEXT)',
+            'filtertype')
+
+    # Twitch user ids are numbers, so these become the rowid. Rows without a usable id can't be kept.
+    rebuild(cursor, 'regulars',
+            'CREATE TABLE regulars(userid INTEGER PRIMARY KEY, username TEXT)',
+            'userid', where="typeof(userid) == 'integer'")
+    rebuild(cursor, 'userLevel',
+            'CREATE TABLE userLevel(userid INTEGER PRIMARY KEY, userlevel INTEGER, username TEXT)',
+            'userid', keep="MAX", where="typeof(userid) == 'integer'")
+    rebuild(cursor, 'offenses',
+            'CREATE TABLE offenses(userid INTEGER PRIMARY KEY, username TEXT, offenses INTEGER)',
+            'userid', keep="MAX", where="typeof(userid) == 'integer'")
+
+    # Regulars are added and removed by username
+    cursor.execute('CREATE INDEX regulars_username ON regulars(username)')
+    cursor.execute('CREATE INDEX userLevel_username ON userLevel(username)')
+
+
+def birthdaycolumns(cursor):
+    # Birthdays were only stored as 'DD/MM' or 'DD/MM/YYYY' text. The parts get their own columns so a day's
+    # birthdays are an index lookup, and announced holds the (UTC, ISO) date a birthday was last announced.
+    cursor.execute('ALTER TABLE birthdays ADD COLUMN month INTEGER')
+    cursor.execute('ALTER TABLE birthdays ADD COLUMN day INTEGER')
+    cursor.execute('ALTER TABLE birthdays ADD COLUMN year INTEGER')
+    cursor.execute('ALTER TABLE birthdays ADD COLUMN announced TEXT')
+    cursor.execute("UPDATE birthdays SET day = CAST(substr(date, 1, 2) AS INTEGER), "
+                   "month = CAST(substr(date, 4, 2) AS INTEGER), "
+                   "year = CASE WHEN length(date) >= 10 THEN CAST(substr(date, 7, 4) AS INTEGER) END")
+    cursor.execute('CREATE INDEX birthdays_monthday ON birthdays(month, day)')
+
+
+def commandcooldowns(cursor):
+    # Seconds a custom command stays quiet after answering, in the whole channel and for the user who used it
+    cursor.execute('ALTER TABLE commands ADD COLUMN cooldown INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE commands ADD COLUMN usercooldown INTEGER NOT NULL DEFAULT 0')
+
+
+# Ordered steps, a database at version n has had the first n applied. Only ever append to this list.
+migrations = [
+    createtables,
+    addkeys,
+    birthdaycolumns,
+    commandcooldowns,
+]
+
+
+def version(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_version(version INTEGER)')
+    row = cursor.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] if row[0] is not None else 0
+
+
+def migrate(sqlconn, steps=migrations):
+    # steps defaults to the channel database schema, other databases pass their own list
+    connection, cursor = sqlconn
+    connection.commit()
+
+    while True:
+        # Every step runs in its own transaction, a failed step leaves the database at the previous version.
+        # The version is read after taking the write lock, another process may have migrated in the meantime.
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            current = version(cursor)
+            if current >= len(steps):
+                connection.commit()
+                break
+
+            step = steps[current]
+            logging.info("Migrating database to schema version %d (%s)", current + 1, step.__name__)
+            step(cursor)
+            cursor.execute('INSERT INTO schema_version (version) VALUES (?)', (current + 1,))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+    return len(steps)
+
+
+class DatabaseWriter:
+    # Applies the writes of one channel database from its own thread and connection, so the event loop never
+    # waits for a commit (and the fsync behind it). Writes are queued with execute()/executemany() and
+    # committed in groups: after maxbatch of them, or once the oldest uncommitted one is maxdelay seconds old.
+    # Queued writes aren't visible to the channel's own connection until committed, barrier() waits for that.
+    def __init__(self, path, maxdelay=0.05, maxbatch=200):
+        self.path = path
+        self.maxdelay = maxdelay
+        self.maxbatch = maxbatch
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="DatabaseWriter {}".format(path), daemon=True)
+
+        self.metrics = {"maxdepth": 0, "writes": 0, "errors": 0, "commits": 0,
+                        "totalcommit": 0.0, "maxcommit": 0.0, "maxbatch": 0}
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+        self.metrics["maxdepth"] = max(self.metrics["maxdepth"], self.queue.qsize())
+
+    def execute(self, statement, parameters=()):
+        self.put((statement, parameters, False))
+
+    def executemany(self, statement, parameters):
+        self.put((statement, list(parameters), True))
+
+    def barrier(self, timeout=None):
+        # Blocks until every write queued before it is committed
+        done = threading.Event()
+        self.put(done)
+        return done.wait(timeout)
+
+    def stop(self):
+        # Commits whatever is still queued and ends the thread
+        self.put(None)
+        self.thread.join()
+
+    def stats(self):
+        metrics = self.metrics
+        return dict(metrics, depth=self.queue.qsize(),
+                    avgcommit=metrics["totalcommit"] / metrics["commits"] if metrics["commits"] else 0.0)
+
+    def commit(self, connection, pending):
+        started = time.monotonic()
+        try:
+            connection.commit()
+        except sql.Error as e:
+            logging.exception(e)
+            connection.rollback()
+            self.metrics["errors"] += pending
+            return
+
+        took = time.monotonic() - started
+        self.metrics["commits"] += 1
+        self.metrics["totalcommit"] += took
+        self.metrics["maxcommit"] = max(self.metrics["maxcommit"], took)
+        self.metrics["maxbatch"] = max(self.metrics["maxbatch"], pending)
+
+    def run(self):
+        connection = connect(self.path, check_same_thread=False)
+        pending = 0
+        deadline = None
+
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0) if pending else None)
+            except queue.Empty:
+                item = ()
+
+            if isinstance(item, tuple) and item:
+                statement, parameters, many = item
+                try:
+                    if many:
+                        connection.executemany(statement, parameters)
+                    else:
+                        connection.execute(statement, parameters)
+                except sql.Error as e:
+                    logging.error("Database write failed (%s): %s", e, statement)
+                    self.metrics["errors"] += 1
+                else:
+                    self.metrics["writes"] += 1
+                    pending += 1
+                    if pending == 1:
+                        deadline = time.monotonic() + self.maxdelay
+
+                if not pending or (pending < self.maxbatch and time.monotonic() < deadline):
+                    continue
+
+            if pending:
+                self.commit(connection, pending)
+                pending = 0
+
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+
+        connection.close()
+
+
+def openwriter(sqlconn, path):
+    writer = writers[sqlconn[0]] = DatabaseWriter(path)
+    writer.start()
+    return writer
+
+
+def writer(sqlconn):
+    return writers[sqlconn[0]]
+
+
+def sync(sqlconn):
+    # Waits for the queued writes of a channel, for code that writes on the channel's own connection
+    writer = writers.get(sqlconn[0])
+    if writer is not None:
+        writer.barrier()
+
+
+def closewriter(sqlconn):
+    writer = writers.pop(sqlconn[0], None)
+    if writer is not None:
+        writer.stop()
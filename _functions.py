@@ -14,552 +14,476 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+import collections.abc
 import logging
-import re
-import subprocess
-import sys
-import time
 
-import StrongLegsBot
-import unpackconfig
-
-bot = StrongLegsBot.Bot()
-cfg = unpackconfig.configUnpacker()
+import _database
 
 
 class Diagnostic:
     def __init__(self, irc, sqlconn):
-        self.mainbotfile = "StrongLegsBot.py"
-        self.osplatform = sys.platform
         self.irc = irc
         self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
 
-    # Restarts instance as sockets cannot be reopened
-    def bot_restart(self, possible_exit, logging_level):
-        time.sleep(1)
-        try:
-            # Handles system dependent subprocess calls
-            opener = "open" if self.osplatform == "darwin" else "python"
-            subprocess.call([opener, self.mainbotfile, StrongLegsBot.IRC().CHANNEL, logging_level])
-
-            # Closes SQLite connections if restart failed
-            self.sqlCursorChannel.close()
-            self.sqlConnectionChannel.close()
-
-            raise SystemExit
-
-        except not SystemExit:
-            StrongLegsBot.Bot.mainloopbreak = True
+    # Reconnects the channel's connection in place, nothing but the socket is rebuilt
+    def bot_restart(self, possible_exit):
+        logging.warning("Restarting connection for %s: %s", self.irc.CHANNEL, possible_exit)
+        self.irc.connection.restart(possible_exit)
+
+
+# Twitch tag values escape these characters (see IRCv3 message-tags)
+TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+
+def unescape_tag(value):
+    if "\\" not in value:
+        return value
+
+    unescaped = []
+    pos = 0
+    while True:
+        found = value.find("\\", pos)
+        if found == -1:
+            unescaped.append(value[pos:])
+            break
+
+        unescaped.append(value[pos:found])
+        if found + 1 < len(value):
+            unescaped.append(TAG_ESCAPES.get(value[found + 1], value[found + 1]))
+        pos = found + 2
+
+    return "".join(unescaped)
+
+
+def split_tags(rawtags):
+    # Values are left escaped, ParsedMessage unescapes them when they are read
+    tags = {}
+    if not rawtags:
+        return tags
+
+    for tag in rawtags.split(';'):
+        key, _, value = tag.partition('=')
+        tags[key] = value
+
+    return tags
+
+
+def tokenize(line):
+    # Splits '[@tags] [:prefix] VERB [params...] [:trailing]' in a single left to right scan.
+    # Returns (rawtags, prefix, verb, params), with the trailing parameter (if any) last in params.
+    line = line.rstrip("\r\n")
+    rawtags = ''
+    prefix = ''
+    pos = 0
+
+    if line.startswith('@'):
+        end = line.find(' ')
+        if end == -1:
+            return line[1:], '', '', []
+        rawtags = line[1:end]
+        pos = end + 1
+
+    if line.startswith(':', pos):
+        end = line.find(' ', pos)
+        if end == -1:
+            return rawtags, line[pos + 1:], '', []
+        prefix = line[pos + 1:end]
+        pos = end + 1
+
+    end = line.find(' ', pos)
+    if end == -1:
+        return rawtags, prefix, line[pos:], []
+
+    verb = line[pos:end]
+    pos = end + 1
+
+    if line.startswith(':', pos):
+        return rawtags, prefix, verb, [line[pos + 1:]]
+
+    trailing = line.find(' :', pos)
+    if trailing == -1:
+        return rawtags, prefix, verb, line[pos:].split(' ')
+
+    params = line[pos:trailing].split(' ')
+    params.append(line[trailing + 2:])
+    return rawtags, prefix, verb, params
+
+
+class ParsedMessage(collections.abc.Mapping):
+    # A single received line. Only the tokenized pieces are kept up front; tags, the
+    # handler fields and the display string are decoded the first time they are read.
+    # As a mapping it merges (highest precedence first) values set on the message,
+    # handler fields and unescaped tags, so 'output.format(**message)' keeps working.
+    __slots__ = ("raw", "rawtags", "prefix", "verb", "params", "parsetype", "identifier",
+                 "_parser", "_tags", "_fields", "_format", "_extra", "_badges", "_emotes")
+
+    def __init__(self, parser, raw, rawtags, prefix, verb, params, parsetype, identifier):
+        self.raw = raw
+        self.rawtags = rawtags
+        self.prefix = prefix
+        self.verb = verb
+        self.params = params
+        self.parsetype = parsetype
+        self.identifier = identifier
+
+        self._parser = parser
+        self._tags = None
+        self._fields = None
+        self._format = None
+        self._extra = None
+        self._badges = None
+        self._emotes = None
+
+    @property
+    def username(self):
+        return self.prefix.split('!', 1)[0]
+
+    @property
+    def channel(self):
+        # First '#channel' parameter (NAMES replies put it third), '' for connection level messages
+        for param in self.params[:3]:
+            if param.startswith("#"):
+                return param
+        return ''
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = split_tags(self.rawtags)
+        return self._tags
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            try:
+                self._fields, self._format = self._parser.build(self)
+            except (IndexError, KeyError, ValueError) as e:
+                logging.error("Parse error (%s): %s", self.verb, e)
+                self._fields, self._format = {}, None
+        return self._fields
+
+    @property
+    def display(self):
+        if self.parsetype == "_server" and self.identifier != "nsub":
+            return "channel" in self.fields and self.identifier not in Parse.dontDisplay
+        return self.parsetype in ("privmsg", "_server")
+
+    @property
+    def parsed(self):
+        self.fields
+        if self._format is None:
+            return self.raw
+
+        formatstring, names = self._format
+        return formatstring % tuple(self.get(name, "---") for name in names)
+
+    @property
+    def badges(self):
+        # 'broadcaster/1,subscriber/12' -> {'broadcaster': '1', 'subscriber': '12'}
+        if self._badges is None:
+            badges = {}
+            for badge in self.tags.get("badges", "").split(","):
+                if badge:
+                    name, _, version = badge.partition("/")
+                    badges[name] = version
+            self._badges = badges
+        return self._badges
+
+    @property
+    def emotes(self):
+        # '25:0-4,12-16/1902:6-10' -> {'25': [(0, 4), (12, 16)], '1902': [(6, 10)]}
+        if self._emotes is None:
+            emotes = {}
+            for emote in self.tags.get("emotes", "").split("/"):
+                if emote:
+                    emoteid, _, positions = emote.partition(":")
+                    emotes[emoteid] = [tuple(map(int, position.split("-", 1)))
+                                       for position in positions.split(",") if position]
+            self._emotes = emotes
+        return self._emotes
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+
+        fields = self.fields
+        if key in fields:
+            return fields[key]
+
+        return unescape_tag(self.tags[key])
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __contains__(self, key):
+        return (self._extra is not None and key in self._extra) or key in self.fields or key in self.tags
+
+    def __iter__(self):
+        seen = set()
+        for mapping in (self._extra or {}, self.fields, self.tags):
+            for key in mapping:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "ParsedMessage(%r)" % self.raw
+
+    def __str__(self):
+        return self.parsed
 
 
 class Parse:
-    def __init__(self, irc, sqlconn, data):
-        self.config = cfg.unpackcfg()
-        self.irc = irc
-        self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
-
-        self.data_to_parse = data
-        self.parsetype = None
-
-        self.regex_server = self.config['regex_server']
-        self.regex_whisper = self.config['regex_whisper']
-        self.regex_privmsg = self.config['regex_privmsg']
-        self.regex_newsubscriber = self.config['regex_server_newsubscriber']
-
-        self.dictRegex = {"privmsg": self.regex_privmsg, "whisper": self.regex_whisper,
-                          "server": self.regex_server, "new_subscriber": self.regex_newsubscriber}
-
-        self.dictMatchedRegex = {}
-
-        if re.search(self.dictRegex["privmsg"], self.data_to_parse) is not None:
-            self.parsetype = "privmsg"
-
-        elif re.search(self.dictRegex["whisper"], self.data_to_parse) is not None and self.parsetype is None:
-            self.parsetype = "whisper"
-
-        elif re.search(self.dictRegex["server"], self.data_to_parse) is not None and self.parsetype is None:
-            self.parsetype = "server"
-
-        elif re.search(self.dictRegex["new_subscriber"], self.data_to_parse) is not None and self.parsetype is None:
-            self.parsetype = "new_subscriber"
-
-        else:
-            self.parsetype = None
-
-    def parse(self):
-        try:
-            if self.parsetype == 'server':
-                #############################
-                #    SERVER PARSE GUIDE
-                # Group:    Value:
-                #
-                #      1   Twitch Data Identifier (string)
-                #
-                #  NOTE: Server parse regex normally used to capture twitch data identifier
-                #  in order to pass through a decision structure and parse each data type
-                #  as specified by identifier.
-                #  ex. if identifer == "USERSTATE":
-                #          parsed = re.search(server_userstate)	//see below for corrosponding regex
-                #
-                #############################
-                dictIdentifer = {"CAP * ACK": "CACK", "CLEARCHAT": "CLCH",
-                                 "GLOBALUSERSTATE": "GLUS", "HOSTTARGET": "HOST",
-                                 "NOTICE": "NOTE", "RECONNECT": "RECN",
-                                 "ROOMSTATE": "RMST", "USERNOTICE": "USNT",
-                                 "USERSTATE": "URST"}
-
-                dontDisplay = [dictIdentifer["CAP * ACK"],
-                               dictIdentifer["GLOBALUSERSTATE"],
-                               "PING"]
-
-                identifier = re.search(self.config["regex_server"], self.data_to_parse)
-                info, parsed = self.parse_server(identifier.group(1), dictIdentifer, self.data_to_parse)
-                display = False if "channel" not in info or identifier.group(1) in dontDisplay else True
-
-                return "_server", identifier.group(1), info, display, parsed
-
-            elif self.parsetype == 'whisper':
-                #############################
-                #    WHISPER PARSE GUIDE
-                # Group:    Value:
-                #
-                #      1    Badges (string)
-                #      2    Color (#<hex>)
-                #      3    Display-name (string)
-                #      4    Emotes (####:###-###, ###-###)
-                #      5    Message-ID (integer)
-                #      6    Thread-ID ([userid of sender]_[userid of receiver])
-                #      7    Turbo (0 or 1)
-                #      8    User-ID (integer)
-                #      9    User-Type (string)
-                #     10    Username (string)
-                #     11    Receiver (string)
-                #     12    Message (string)
-                #
-                #############################
-                servermsg = re.search(self.config["regex_whisper"], self.data_to_parse)
-                servermsg = {"badges": servermsg.group(1), "color": servermsg.group(2),
-                             "display-name": servermsg.group(3), "emotes": servermsg.group(4),
-                             "id": servermsg.group(5), "threadid": servermsg.group(6),
-                             "turbo": servermsg.group(7), "user-id": servermsg.group(8),
-                             "user-type": servermsg.group(9), "username": servermsg.group(10),
-                             "receiver": servermsg.group(11), "privmsg": servermsg.group(12)}
-
-                return self.parsetype, self.parsetype, servermsg, False, "[RECV] %s_%s: %s" % (servermsg["id"],
-                                                                                               servermsg["username"],
-                                                                                               servermsg["privmsg"])
-
-            elif self.parsetype == 'privmsg':
-                #############################
-                #    PRIVMSG PARSE GUIDE
-                # Group:    Value:
-                #
-                #      1    Badges (string)
-                #      2    Color (#<hex>)
-                #      3    Display-Name (string)
-                #      4    Emotes (####:###-###, ###-###)
-                #      5    ID (Alpha-numerical)
-                #      6    Mod (0 or 1)
-                #      7    Room-ID (numerical)
-                #      8    Subscriber (0 or 1)
-                #      9    Turbo (0 or 1)
-                #     10    User-ID (integer)
-                #     11    User-Type (string)
-                #     12    Username (string)
-                #     13    Channel (#string)
-                #     14    Privmsg (string)
-                #
-                # New:
-                #
-                #      1    Parameters snippet (string)
-                #      2    Username (string)
-                #      3    Channel (#string)
-                #      4    Privmsg (string)
-                #
-                #############################
-
-                servermsg = {}
-                servermsg_split = self.data_to_parse.strip('@').split(" :", 2)
-
-                parameters = servermsg_split[0].split(';')
-
-                for parameter in parameters:
-                    parameter_split = parameter.split('=')
-                    servermsg[parameter_split[0]] = parameter_split[1]
-
-                ircinfo = servermsg_split[1].split(" %s " % self.parsetype.upper())
-                # username = ircinfo[0].split('!')[0]
-                servermsg["username"] = ircinfo[0].split('!')[0]
-                servermsg["channel"] = ircinfo[1]
-                servermsg["privmsg"] = servermsg_split[2].strip('\r')
-
-                self.sqlCursorChannel.execute('SELECT userlevel FROM userLevel WHERE userid == ?',
-                                              (servermsg["user-id"],))
-                sqlCursorOffload = self.sqlCursorChannel.fetchone()
-                if sqlCursorOffload is None:
-                    sqlCursorOffload = ("---",)
-
-                parsed = "[RECV] %s: {%s} [%s]: %s" % (servermsg["channel"], sqlCursorOffload[0],
-                                                       servermsg["username"], servermsg["privmsg"])
-                return self.parsetype, self.parsetype, servermsg, True, parsed
-
-            elif self.parsetype == "new_subscriber":
-                servermsg = re.search(self.config["regex_server_newsubscriber"], self.data_to_parse)
-                servermsg = {"username": servermsg.group(1), "channel": servermsg.group(2),
-                             "message": servermsg.group(3)}
-                return "_server", "nsub", servermsg, True, "[NSUB] %s [%s]: %s" % (servermsg["channel"],
-                                                                                   servermsg["username"],
-                                                                                   servermsg["message"])
-
+    # Verb -> handler name, every handler returns (fields, (formatstring, fieldnames))
+    dispatch = {
+        "CAP": "parse_cap",
+        "CLEARCHAT": "parse_clearchat",
+        "GLOBALUSERSTATE": "parse_globaluserstate",
+        "HOSTTARGET": "parse_hosttarget",
+        "JOIN": "parse_join",
+        "MODE": "parse_mode",
+        "NOTICE": "parse_notice",
+        "PART": "parse_part",
+        "PING": "parse_ping",
+        "PRIVMSG": "parse_privmsg",
+        "RECONNECT": "parse_reconnect",
+        "ROOMSTATE": "parse_roomstate",
+        "USERNOTICE": "parse_usernotice",
+        "USERSTATE": "parse_userstate",
+        "WHISPER": "parse_whisper",
+    }
+
+    dictIdentifer = {"CAP * ACK": "CACK", "CLEARCHAT": "CLCH",
+                     "GLOBALUSERSTATE": "GLUS", "HOSTTARGET": "HOST",
+                     "NOTICE": "NOTE", "RECONNECT": "RECN",
+                     "ROOMSTATE": "RMST", "USERNOTICE": "USNT",
+                     "USERSTATE": "URST"}
+
+    dontDisplay = ("CAP * ACK", "GLOBALUSERSTATE", "PING")
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def parse(self, data):
+        rawtags, prefix, verb, params = tokenize(data)
+
+        if verb == "PRIVMSG":
+            if prefix.startswith("twitchnotify!"):
+                parsetype, identifier = "_server", "nsub"
             else:
-                info = None
-                return "UNKNOWN", self.parsetype, info, "%s" % self.data_to_parse
-
-        except IndexError as e:
-            logging.error(e)
-
-    def parse_server(self, identifier, dictIdentifer, data):
-        try:
-
-            if identifier == "CAP * ACK":
-                servermsg = data.split(" :")
-                servermsg = {"split_1": servermsg[0], "split_2": servermsg[1]}
-                return servermsg, "[%s] %s" % (dictIdentifer[identifier], servermsg["split_2"])
-
-            elif identifier == "CLEARCHAT":
-                #############################
-                #    CLEARCHAT TIMEOUT/BAN PARSE GUIDE
-                # Group:    Value:
-                # Timeout:
-                #      2    Duration (integer)
-                #      3    Reason (string)
-                #      4    Channel (#string)
-                #      5    Target_username (string)
-                #
-                # Ban:
-                #      1    Reason (string)
-                #      4    Channel (#string)
-                #      5    Target_username (string)
-                #
-                #############################
-
-                servermsg = data.split(identifier + " ")
-                clearchat_chatter = re.search(self.config["regex_server_clearchat_chatter"], data)
-
-                if clearchat_chatter is not None:
-                    if clearchat_chatter.group(2) is not None:
-                        servermsg = {"duration": clearchat_chatter.group(2),
-                                     "reason": clearchat_chatter.group(3).replace("\s", " ")
-                                     if clearchat_chatter.group(3) != " " else "~None~",
-                                     "channel": clearchat_chatter.group(4),
-                                     "target_username": clearchat_chatter.group(5)}
-
-                        return servermsg, "[%s] %s: TIMEOUT:%s TTL:%s Reason:%s" % (dictIdentifer[identifier],
-                                                                                    servermsg["channel"],
-                                                                                    servermsg["target_username"],
-                                                                                    servermsg["duration"],
-                                                                                    servermsg["reason"])
-
-                    if clearchat_chatter.group(2) is None:
-                        servermsg = {
-                            "reason": clearchat_chatter.group(1).replace("\s", " ") if clearchat_chatter.group(1) != " "
-                            else "~None~",
-                            "channel": clearchat_chatter.group(4),
-                            "target_username": clearchat_chatter.group(5)
-                        }
-
-                        return servermsg, "[%s] %s: BAN:%s Reason:%s" % (dictIdentifer[identifier],
-                                                                         servermsg["channel"],
-                                                                         servermsg["target_username"],
-                                                                         servermsg["reason"])
-
-                return servermsg, "[%s] %s" % (dictIdentifer[identifier], servermsg[1])
-
-            elif identifier == "GLOBALUSERSTATE":
-                #############################
-                #    GLOBALUSERSTATE PARSE GUIDE
-                # Group:    Value:
-                #      1    Badges (string)
-                #      2    Color (#<hex>)
-                #      3    Display-name (string)
-                #      4    Emote-sets (####:###-###, ###-###)
-                #      5    Turbo (0 or 1)
-                #      6    User-id (numerical)
-                #      7    User-type (string)
-                #
-                #############################
-
-                servermsg = {}
-                servermsg_split = self.data_to_parse.strip('@').split(" :", 1)
-
-                parameters = servermsg_split[0].split(';')
-
-                for parameter in parameters:
-                    parameter_split = parameter.split('=')
-                    servermsg[parameter_split[0]] = parameter_split[1]
-
-                ircinfo = servermsg_split[1].split(" ")
-                servermsg["host"] = ircinfo[0]
-                servermsg["identifier"] = ircinfo[1].strip("\r")
-
-                return servermsg, "[%s] [%s]" % (dictIdentifer[identifier], parameters)
-
-            elif identifier == "HOSTTARGET":
-                #############################
-                #    HOSTTARGET PARSE GUIDE
-                # Group:    Value:
-                #      1    Hoster channel (#string)
-                #      2    Hostee channel (#string or '-')
-                #      3    Viewer count (integer)
-                #
-                #############################
-                servermsg = re.search(self.config["regex_server_hosttarget"], data)
-                servermsg = {"hoster": servermsg.group(1), "hostee": servermsg.group(2),
-                             "viewers": servermsg.group(3)}
-                return servermsg, "[%s] %s: %s hosted with %s" % (dictIdentifer[identifier],
-                                                                  servermsg["hoster"],
-                                                                  servermsg["hostee"],
-                                                                  servermsg["viewers"])
-
-            elif identifier == "JOIN":
-                #############################
-                #    JOIN PARSE GUIDE
-                # Group:    Value:
-                #      1    Username (string)
-                #      2    Channel (#string)
-                #
-                #############################
-
-                servermsg = {}
-                ircinfo = data.split(" %s " % identifier.upper())
-                servermsg["username"] = ircinfo[0].split('!')[0].strip(':')
-                servermsg["channel"] = ircinfo[1].strip("\r\n")
-                return servermsg, "[%s] %s: %s" % (identifier, servermsg["channel"], servermsg["username"])
-
-            elif identifier == "MODE":
-                #############################
-                #    MODE PARSE GUIDE
-                # Group:    Value:
-                #      1    Channel (#string)
-                #      2    +o or -o
-                #      3    Username (string)
-                #
-                #############################
-
-                servermsg = {}
-                ircinfo = data.split(" ")
-                servermsg["channel"] = ircinfo[2]
-                servermsg["mode"] = ircinfo[3]
-                servermsg["username"] = ircinfo[4]
-                return servermsg, "[%s] %s: (%s) %s" % (identifier, servermsg["channel"],
-                                                        servermsg["mode"], servermsg["username"])
-
-            elif identifier == "NOTICE":
-                #############################
-                #    NOTICE PARSE GUIDE
-                # Group:    Value:
-                #      1    Msg-id (string)
-                #      2    Channel (#string)
-                #      3    Message (string)
-                #
-                #############################
-
-                servermsg = re.search(self.config["regex_server_notice"], data)
-                servermsg = {"id": servermsg.group(1), "channel": servermsg.group(2),
-                             "message": servermsg.group(3)}
-                return servermsg, "[%s] %s: (%s) %s" % (dictIdentifer[identifier], servermsg["channel"],
-                                                        servermsg["id"], servermsg["message"])
-
-            elif identifier == "PART":
-                #############################
-                #    PART PARSE GUIDE
-                # Group:    Value:
-                #      1    Username (string)
-                #      2    Channel (#string)
-                #
-                #############################
-
-                servermsg = {}
-                ircinfo = data.split(" %s " % identifier.upper())
-                servermsg["username"] = ircinfo[0].split('!')[0].strip(':')
-                servermsg["channel"] = ircinfo[1].strip("\r\n")
-                return servermsg, "[%s] %s: %s" % (identifier, servermsg["channel"], servermsg["username"])
-
-            elif identifier == "PING":
-                servermsg = data.split(identifier)
-                servermsg = {"split_1": servermsg[0], "pingstring": servermsg[1]}
-                return servermsg, "[%s] Ping requested with data '%s'" % (identifier, servermsg["pingstring"].strip("\r"))
-
-            elif identifier == "RECONNECT":
-                return self.data_to_parse, "RECN" + self.data_to_parse
-
-            elif identifier == "ROOMSTATE":
-                #############################
-                #    ROOMSTATE PARSE GUIDE
-                # Group:    Value:
-                # Declarative:
-                #      1    Broadcaster-Language (2-char string ex. "en")
-                #      2    Emote-only (0 or 1)
-                #      3    r9kbeta (0 or 1)
-                #      4    Slow-mode (integer)
-                #      5    Subscriber-only (0 or 1)
-                #      6    Channel (#string)
-                #
-                # Update:
-                #      1    Update-type (string)
-                #      2    Update-value (0 or 1)
-                #      3    Channel (#string)
-                #
-                #############################
-
-                servermsg = re.search(self.config["regex_server_roomstate"], data)
-                if servermsg is not None:
-                    servermsg = {"broadcastlang": servermsg.group(1), "emoteonly": servermsg.group(2),
-                                 "r9kbeta": servermsg.group(3), "slowmode": servermsg.group(4),
-                                 "subscriberonly": servermsg.group(5), "channel": servermsg.group(6)}
-
-                    return servermsg, "[%s] %s: [broadcast-lang=%s][subscriber-only=%s]" \
-                                      "[slow-mode=%ss][r9k=%s][emote-only=%s]" % (dictIdentifer[identifier],
-                                                                                  servermsg["channel"],
-                                                                                  servermsg["broadcastlang"],
-                                                                                  servermsg["subscriberonly"],
-                                                                                  servermsg["slowmode"],
-                                                                                  servermsg["r9kbeta"],
-                                                                                  servermsg["emoteonly"])
-                else:
-                    servermsg = re.search(self.config["regex_server_roomstate_update"], data)
-                    servermsg = {"updatetype": servermsg.group(1), "updatevalue": servermsg.group(2),
-                                 "channel": servermsg.group(3)}
-                    return servermsg, "[%s] %s UPDATE: %s=%s" % (dictIdentifer[identifier],
-                                                                 servermsg["channel"],
-                                                                 servermsg["updatetype"],
-                                                                 servermsg["updatevalue"])
-
-            elif identifier == "USERNOTICE":
-                #############################
-                #    USERNOTICE PARSE GUIDE
-                # Group:    Value:
-                #
-                #      1    Badges (string)
-                #      2    Color (#<hex>)
-                #      3    Display-Name (string)
-                #      4    Emotes (####:###-###, ###-###)
-                #      5    Login (string)
-                #      6    Mod (0 or 1)
-                #      7    Msg-ID (string)
-                #      8    Msg-param-months (integer)
-                #      9    Room-ID (integer)
-                #     10    Subscriber (0 or 1)
-                #     11    System-msg (string)
-                #     12    Turbo (0 or 1)
-                #     13    User-ID (integer)
-                #     14    User-type (string)
-                #     15    Channel (#string)
-                # With user message:
-                #     16    Message (string)
-                #
-                #############################
-                try:
-                    servermsg = re.search(self.config["regex_server_usernotice_usermsg"], data)
-
-                    if servermsg is not None:
-                        servermsg = {"badges": servermsg.group(1), "color": servermsg.group(2),
-                                     "display-name": servermsg.group(3), "emotes": servermsg.group(4),
-                                     "username": servermsg.group(5), "mod": servermsg.group(6),
-                                     "msg-id": servermsg.group(7), "msg-param-months": servermsg.group(8),
-                                     "room-id": servermsg.group(9), "subscriber": servermsg.group(10),
-                                     "system-msg": servermsg.group(11), "turbo": servermsg.group(12),
-                                     "user-id": servermsg.group(13), "user-type": servermsg.group(14),
-                                     "channel": servermsg.group(15), "message": servermsg.group(16)}
-
-                        return servermsg, "[%s] %s: (%s) Userid: %s Username: %s consMonth: %s sysMsg: %s : %s" % \
-                                          (dictIdentifer[identifier],
-                                           servermsg["channel"],
-                                           servermsg["msg-id"],
-                                           servermsg["user-id"],
-                                           servermsg["username"],
-                                           servermsg["msg-param-months"],
-                                           servermsg["system-msg"].replace("\s", " "),
-                                           servermsg["message"])
-                    else:
-                        servermsg = re.search(self.config["regex_server_usernotice_nousermsg"], data)
-                        servermsg = {"badges": servermsg.group(1), "color": servermsg.group(2),
-                                     "display-name": servermsg.group(3), "emotes": servermsg.group(4),
-                                     "username": servermsg.group(5), "mod": servermsg.group(6),
-                                     "msg-id": servermsg.group(7), "msg-param-months": servermsg.group(8),
-                                     "room-id": servermsg.group(9), "subscriber": servermsg.group(10),
-                                     "system-msg": servermsg.group(11), "turbo": servermsg.group(12),
-                                     "user-id": servermsg.group(13), "user-type": servermsg.group(14),
-                                     "channel": servermsg.group(15)}
-
-                        return servermsg, "[%s] %s: (%s) Userid: %s Username: %s consMonth: %s sysMsg: %s" % \
-                                          (dictIdentifer[identifier],
-                                           servermsg["channel"],
-                                           servermsg["msg-id"],
-                                           servermsg["user-id"],
-                                           servermsg["username"],
-                                           servermsg["msg-param-months"],
-                                           servermsg["system-msg"].replace("\s", " "))
-
-                except Exception as e:
-                    logging.error("Usernotice parse error: %s", e)
-
-            elif identifier == "USERSTATE":
-                #############################
-                #    USERSTATE PARSE GUIDE
-                # Group:    Value:
-                #      1    Badges (string)
-                #      2    Color (#<hex>)
-                #      3    Display-name (string)
-                #      4    Emote-sets (####:###-###, ###-###)
-                #      5    Mod (0 or 1)
-                #      6    Subscriber (0 or 1)
-                #      7    Turbo (0 or 1)
-                #      8    User-type (string)
-                #      9    Channel (#string)
-                #
-                #############################
-
-                servermsg = {}
-                servermsg_split = self.data_to_parse.strip('@').split(" :", 1)
-
-                parameters = servermsg_split[0].split(';')
-
-                for parameter in parameters:
-                    parameter_split = parameter.split('=')
-                    servermsg[parameter_split[0]] = parameter_split[1]
-
-                ircinfo = servermsg_split[1].split(" ")
-                servermsg["host"] = ircinfo[0]
-                servermsg["identifier"] = ircinfo[1]
-                servermsg["channel"] = ircinfo[2].strip("\r")
-
-                return servermsg, "[%s] %s: [%s]" % (dictIdentifer[identifier],
-                                                     servermsg["channel"],
-                                                     servermsg)
-
-            elif identifier.strip().isdigit():
-                servermsg = data.split(" :")
-                servermsg = {"split_1": servermsg[0], "split_2": servermsg[1]}
-                formatted_identifier = '_' + identifier.strip()
-
-                return servermsg, "[%s] %s :%s" % (formatted_identifier, self.config["settings_username"],
-                                                   servermsg["split_2"])
-
-            else:
-                logging.error("Unrecognized server message, parse failed.")
-                servermsg = data.split(" :")
-                servermsg = {"split_1": servermsg[0], "split_2": servermsg[1]}
-                formatted_identifier = identifier.strip()
-
-                return servermsg, "[%s] %s; %s :%s" % ("UNID", formatted_identifier,
-                                                       self.irc.CHANNEL, servermsg["split_2"])
-
-        except Exception as e:
-            logging.error(e)
+                parsetype, identifier = "privmsg", "privmsg"
+        elif verb == "WHISPER":
+            parsetype, identifier = "whisper", "whisper"
+        elif verb:
+            parsetype, identifier = "_server", "CAP * ACK" if verb == "CAP" else verb
+        else:
+            parsetype, identifier = "UNKNOWN", None
+
+        return ParsedMessage(self, data, rawtags, prefix, verb, params, parsetype, identifier)
+
+    def build(self, message):
+        if message.identifier == "nsub":
+            return self.parse_newsubscriber(message)
+
+        handler = self.dispatch.get(message.verb)
+        if handler is not None:
+            return getattr(self, handler)(message)
+
+        if message.verb.isdigit():
+            return self.parse_numeric(message)
+
+        if message.parsetype == "UNKNOWN":
+            return {}, None
+
+        logging.error("Unrecognized server message, parse failed.")
+        fields = {"split_1": " ".join([message.verb] + message.params[:-1]),
+                  "split_2": message.params[-1] if message.params else '', "identifier": message.verb}
+        return fields, ("[UNID] %s :%s", ("identifier", "split_2"))
+
+    def parse_privmsg(self, message):
+        #############################
+        #    PRIVMSG PARSE GUIDE
+        # Tags:     badges, color, display-name, emotes, id, mod, room-id,
+        #           subscriber, turbo, user-id, user-type (plus any new ones)
+        # Prefix:   username!username@username.tmi.twitch.tv
+        # Params:   channel, message
+        #
+        #############################
+        fields = {"username": message.username, "channel": message.params[0], "privmsg": message.params[1]}
+        return fields, ("[RECV] %s: {%s} [%s]: %s", ("channel", "userlevel", "username", "privmsg"))
+
+    def parse_whisper(self, message):
+        #############################
+        #    WHISPER PARSE GUIDE
+        # Tags:     badges, color, display-name, emotes, message-id,
+        #           thread-id, turbo, user-id, user-type
+        # Prefix:   username!username@username.tmi.twitch.tv
+        # Params:   receiver, message
+        #
+        #############################
+        tags = message.tags
+        fields = {"id": tags.get("message-id"), "threadid": tags.get("thread-id"),
+                  "username": message.username, "receiver": message.params[0], "privmsg": message.params[1]}
+        return fields, ("[RECV] %s_%s: %s", ("id", "username", "privmsg"))
+
+    def parse_newsubscriber(self, message):
+        text = message.params[1]
+        fields = {"username": text.split(" ", 1)[0], "channel": message.params[0], "message": text}
+        return fields, ("[NSUB] %s [%s]: %s", ("channel", "username", "message"))
+
+    def parse_cap(self, message):
+        fields = {"split_1": " ".join([message.verb] + message.params[:-1]), "split_2": message.params[-1]}
+        return fields, ("[CACK] %s", ("split_2",))
+
+    def parse_clearchat(self, message):
+        #############################
+        #    CLEARCHAT TIMEOUT/BAN PARSE GUIDE
+        # Tags:     ban-duration (timeouts only), ban-reason
+        # Params:   channel, target_username (missing when the whole chat is cleared)
+        #
+        #############################
+        fields = {"channel": message.params[0]}
+
+        if len(message.params) < 2:
+            return fields, ("[CLCH] %s: CHAT CLEARED", ("channel",))
+
+        tags = message.tags
+        fields["target_username"] = message.params[1]
+        fields["reason"] = unescape_tag(tags.get("ban-reason", "")) or "~None~"
+
+        if "ban-duration" in tags:
+            fields["duration"] = tags["ban-duration"]
+            return fields, ("[CLCH] %s: TIMEOUT:%s TTL:%s Reason:%s",
+                            ("channel", "target_username", "duration", "reason"))
+
+        return fields, ("[CLCH] %s: BAN:%s Reason:%s", ("channel", "target_username", "reason"))
+
+    def parse_globaluserstate(self, message):
+        #############################
+        #    GLOBALUSERSTATE PARSE GUIDE
+        # Tags:     badges, color, display-name, emote-sets, turbo, user-id, user-type
+        # Prefix:   tmi.twitch.tv
+        #
+        #############################
+        fields = {"host": message.prefix, "identifier": message.verb, "tags": message.rawtags}
+        return fields, ("[GLUS] [%s]", ("tags",))
+
+    def parse_hosttarget(self, message):
+        #############################
+        #    HOSTTARGET PARSE GUIDE
+        # Params:   hoster channel, '<hostee channel or -> [viewer count]'
+        #
+        #############################
+        target = message.params[1].split(" ") if len(message.params) > 1 else ["-"]
+        fields = {"hoster": message.params[0], "hostee": target[0],
+                  "viewers": target[1] if len(target) > 1 else "-"}
+        return fields, ("[HOST] %s: %s hosted with %s", ("hoster", "hostee", "viewers"))
+
+    def parse_join(self, message):
+        fields = {"username": message.username, "channel": message.params[0]}
+        return fields, ("[JOIN] %s: %s", ("channel", "username"))
+
+    def parse_mode(self, message):
+        fields = {"channel": message.params[0], "mode": message.params[1], "username": message.params[2]}
+        return fields, ("[MODE] %s: (%s) %s", ("channel", "mode", "username"))
+
+    def parse_notice(self, message):
+        #############################
+        #    NOTICE PARSE GUIDE
+        # Tags:     msg-id
+        # Params:   channel, message
+        #
+        #############################
+        fields = {"id": message.tags.get("msg-id"), "channel": message.params[0],
+                  "message": message.params[1] if len(message.params) > 1 else ''}
+        return fields, ("[NOTE] %s: (%s) %s", ("channel", "id", "message"))
+
+    def parse_part(self, message):
+        fields = {"username": message.username, "channel": message.params[0]}
+        return fields, ("[PART] %s: %s", ("channel", "username"))
+
+    def parse_ping(self, message):
+        fields = {"pingstring": message.params[-1] if message.params else ''}
+        return fields, ("[PING] Ping requested with data '%s'", ("pingstring",))
+
+    def parse_reconnect(self, message):
+        fields = {"host": message.prefix}
+        return fields, ("[RECN] %s", ("host",))
+
+    def parse_roomstate(self, message):
+        #############################
+        #    ROOMSTATE PARSE GUIDE
+        # Declarative (every setting is present):
+        #   Tags:   broadcaster-lang, emote-only, r9k, slow, subs-only, room-id, ...
+        # Update (a single setting changed):
+        #   Tags:   <setting>, room-id
+        # Params:   channel
+        #
+        #############################
+        tags = message.tags
+        settings = [key for key in tags if key != "room-id"]
+
+        if len(settings) == 1:
+            fields = {"updatetype": settings[0], "updatevalue": tags[settings[0]], "channel": message.params[0]}
+            return fields, ("[RMST] %s UPDATE: %s=%s", ("channel", "updatetype", "updatevalue"))
+
+        fields = {"broadcastlang": tags.get("broadcaster-lang", ""), "emoteonly": tags.get("emote-only", "0"),
+                  "r9kbeta": tags.get("r9k", "0"), "slowmode": tags.get("slow", "0"),
+                  "subscriberonly": tags.get("subs-only", "0"), "channel": message.params[0]}
+
+        return fields, ("[RMST] %s: [broadcast-lang=%s][subscriber-only=%s][slow-mode=%ss][r9k=%s][emote-only=%s]",
+                        ("channel", "broadcastlang", "subscriberonly", "slowmode", "r9kbeta", "emoteonly"))
+
+    def parse_usernotice(self, message):
+        #############################
+        #    USERNOTICE PARSE GUIDE
+        # Tags:     badges, color, display-name, emotes, login, mod, msg-id,
+        #           msg-param-months, room-id, subscriber, system-msg, turbo,
+        #           user-id, user-type (plus any new ones)
+        # Params:   channel, [message]
+        #
+        #############################
+        fields = {"username": message.tags.get("login"), "channel": message.params[0]}
+        names = ("channel", "msg-id", "user-id", "username", "msg-param-months", "system-msg")
+
+        if len(message.params) > 1:
+            fields["message"] = message.params[1]
+            return fields, ("[USNT] %s: (%s) Userid: %s Username: %s consMonth: %s sysMsg: %s : %s",
+                            names + ("message",))
+
+        return fields, ("[USNT] %s: (%s) Userid: %s Username: %s consMonth: %s sysMsg: %s", names)
+
+    def parse_userstate(self, message):
+        #############################
+        #    USERSTATE PARSE GUIDE
+        # Tags:     badges, color, display-name, emote-sets, mod, subscriber, turbo, user-type
+        # Prefix:   tmi.twitch.tv
+        # Params:   channel
+        #
+        #############################
+        fields = {"host": message.prefix, "identifier": message.verb, "channel": message.params[0],
+                  "tags": message.rawtags}
+        return fields, ("[URST] %s: [%s]", ("channel", "tags"))
+
+    def parse_numeric(self, message):
+        fields = {"split_1": " ".join([message.verb] + message.params[:-1]),
+                  "split_2": message.params[-1] if message.params else '',
+                  "identifier": "_" + message.verb, "target": message.params[0] if message.params else ''}
+        return fields, ("[%s] %s :%s", ("identifier", "target", "split_2"))
 
 
 class Data:
+    # Users kept in memory per channel, the least recently seen are dropped first
+    maxusers = 5000
+    # Seconds a changed userlevel waits before it is written to userLevel, together with every other change
+    flushinterval = 5
+
     def __init__(self, irc, sqlconn):
         self.irc = irc
         self.channel = irc.CHANNEL
@@ -567,29 +491,75 @@ class Data:
         self.sqlconn = sqlconn
         self.sqlConnectionChannel, self.sqlCursorChannel = self.sqlconn
 
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS userLevel(userid INTEGER, userlevel INTEGER, username TEXT)')
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS commands(userlevel INTEGER, keyword TEXT, output TEXT, args INTEGER, '
-            'sendtype TEXT, syntaxerr TEXT)')
-        self.sqlCursorChannel.execute('CREATE TABLE IF NOT EXISTS regulars(userid INTEGER, username TEXT)')
-        self.sqlCursorChannel.execute(
-            'CREATE TABLE IF NOT EXISTS faq(userlevel INTEGER, name TEXT, regex TEXT, output TEXT, sendtype TEXT)')
-        self.sqlCursorChannel.execute('CREATE TABLE IF NOT EXISTS filters'
-                                      '(filtertype TEXT, enabled TEXT, maxuserlevel INTEGER, first_timeout INTEGER, '
-                                      'second_timeout INTEGER, third_timeout INTEGER, ban_after_third TEXT,'
-                                      ' message TEXT)')
-        self.sqlCursorChannel.execute('CREATE TABLE IF NOT EXISTS offenses'
-                                      '(userid INTEGER, username TEXT, offenses INTEGER)')
-
-        self.sqlConnectionChannel.commit()
+        # userid -> [userlevel, username, stored], stored is False until the user has a row in userLevel
+        self.users = collections.OrderedDict()
+        # userid -> user entry waiting to be written
+        self.dirty = {}
+        self.flushtimer = None
+        self.regulars = {str(userid) for userid, in self.sqlCursorChannel.execute('SELECT userid FROM regulars')}
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def setregular(self, userid, regular):
+        if regular:
+            self.regulars.add(str(userid))
+        else:
+            self.regulars.discard(str(userid))
+
+    def getuser(self, userid, username):
+        user = self.users.get(userid)
+        if user is not None:
+            self.users.move_to_end(userid)
+            self.hits += 1
+            return user
+
+        self.misses += 1
+        row = self.sqlCursorChannel.execute('SELECT userlevel FROM userLevel WHERE userid == ?', (userid,)).fetchone()
+        user = [row[0], username, True] if row is not None else [None, username, False]
+
+        self.users[userid] = user
+        if len(self.users) > self.maxusers:
+            self.users.popitem(last=False)
+        return user
+
+    def storeuser(self, userid, user, userlevel, username):
+        if user[0] == userlevel and user[1] == username and user[2]:
+            return
+
+        user[0], user[1] = userlevel, username
+        self.dirty[userid] = user
+        if self.flushtimer is None:
+            loop = self.irc.connection.loop
+            self.flushtimer = loop.call_later(self.flushinterval, self.flush) if loop is not None else None
+
+    def flush(self):
+        # Hands every changed user to the database writer at once
+        self.flushtimer = None
+        if not self.dirty:
+            return
+
+        dirty, self.dirty = self.dirty, {}
+        inserts = [(userid, user[0], user[1]) for userid, user in dirty.items() if not user[2]]
+        updates = [(user[0], user[1], userid) for userid, user in dirty.items() if user[2]]
+        writer = _database.writer(self.sqlconn)
+        if inserts:
+            logging.debug("Adding %d users to userLevel for channel %s", len(inserts), self.channel)
+            # A user evicted and seen again before the first insert was committed is inserted twice
+            writer.executemany('INSERT INTO userLevel (userid, userlevel, username) VALUES (?, ?, ?) '
+                               'ON CONFLICT (userid) DO UPDATE SET userlevel = excluded.userlevel, '
+                               'username = excluded.username', inserts)
+        if updates:
+            writer.executemany('UPDATE userLevel SET userlevel = ?, username = ? WHERE userid == ?', updates)
+
+        for user in dirty.values():
+            user[2] = True
+        self.flushes += 1
 
     def handleUserLevel(self, handleuserlevel, whisper=False):
         userid, username, usertype, subscriber, turbo = handleuserlevel
         try:
-            self.sqlCursorChannel.execute('SELECT userid FROM regulars WHERE userid == ?', (userid,))
-
-            isRegular = self.sqlCursorChannel.fetchone()
             userlevel = 0
             dictUserType = {'mod': 250, 'global_mod': 350,
                             'admin': 500, 'staff': 600}
@@ -599,58 +569,35 @@ class Data:
                     userlevel = 700
 
                 elif usertype == '':
-                    logging.debug('Checking non-special user')
                     if int(turbo) == 1:
                         userlevel = 50
                     if int(subscriber) == 1:
                         userlevel = 100
-                    if isRegular is not None:
+                    if str(userid) in self.regulars:
                         userlevel = 150
                     if username == self.channel.strip("#"):
                         userlevel = 400
-                    logging.debug('Done checking non-special user')
 
-                elif usertype in list(dictUserType.keys()):
-                    logging.debug('Checking special user')
+                elif usertype in dictUserType:
                     userlevel = dictUserType[usertype]
-                    logging.debug('Done checking special user')
 
                 else:
                     userlevel = -1
 
-                self.sqlCursorChannel.execute('SELECT userlevel FROM userLevel WHERE userid == ?', (userid,))
-                sqlCursorOffload = self.sqlCursorChannel.fetchone()
-
-                if not sqlCursorOffload:
-                    logging.debug("Adding user to userLevel for channel %s", self.channel)
-                    self.sqlCursorChannel.execute(
-                        'INSERT INTO userLevel (userid, userlevel, username) VALUES (?, ?, ?)',
-                        (userid, userlevel, username))
-
-                elif userlevel != sqlCursorOffload[0]:
-                    logging.debug("Userlevel mismatch in %s", self.channel)
-                    self.sqlCursorChannel.execute('UPDATE userLevel SET userlevel = ? WHERE userid == ?',
-                                                  (userlevel, userid))
-
-                else:
-                    pass
-
-                self.sqlConnectionChannel.commit()
+                # Only a changed userlevel (or a new user) is written, and only once flush() runs
+                if str(userid).isdigit():
+                    self.storeuser(userid, self.getuser(userid, username), userlevel, username)
 
             else:
                 if username == 'floppydisk_':
                     userlevel = 700
 
                 elif usertype == '':
-                    logging.debug('Checking non-special user')
                     if int(turbo) == 1:
                         userlevel = 50
-                    logging.debug('Done checking non-special user')
 
-                elif usertype in list(dictUserType.keys()):
-                    logging.debug('Checking special user')
+                elif usertype in dictUserType:
                     userlevel = dictUserType[usertype]
-                    logging.debug('Done checking special user')
 
                 else:
                     userlevel = -1
@@ -0,0 +1,167 @@
+"""
+Copyright 2016 Pawel Bartusiak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import calendar
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+
+def dayfile(directory, template, now):
+    # (path, timestamp of the next UTC midnight) of the file a day's lines go to
+    day = time.gmtime(now)
+    midnight = calendar.timegm((day.tm_year, day.tm_mon, day.tm_mday, 0, 0, 0)) + 86400
+    return os.path.join(directory, template.format(time.strftime("%Y-%m-%d", day))), midnight
+
+
+class ChatLog:
+    # The chat log of one channel, logs/<channel>/chat/<date>_log.log. The file stays open for the whole UTC
+    # day and is swapped by the first write after midnight. Lines are buffered and written to disk at most
+    # flushinterval seconds after they were logged.
+    def __init__(self, directory, loop, flushinterval=1.0, buffersize=65536):
+        self.directory = directory
+        self.loop = loop
+        self.flushinterval = flushinterval
+        self.buffersize = buffersize
+
+        self.file = None
+        self.path = None
+        self.rollover = 0
+        self.flushtimer = None
+
+        self.opens = 0
+        self.flushes = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, now):
+        self.close()
+        self.path, self.rollover = dayfile(self.directory, "{}_log.log", now)
+        self.file = open(self.path, 'a', encoding="utf-8", buffering=self.buffersize)
+        self.opens += 1
+
+    def write(self, line):
+        now = time.time()
+        if self.file is None or now >= self.rollover:
+            self.open(now)
+
+        self.file.write(line)
+        if self.flushtimer is None:
+            self.flushtimer = self.loop.call_later(self.flushinterval, self.flush)
+
+    def flush(self):
+        self.flushtimer = None
+        if self.file is not None:
+            self.file.flush()
+            self.flushes += 1
+
+    def rotate(self, now):
+        # Closes a previous day's file that no line has been written after, so it can be compacted
+        if self.file is not None and now >= self.rollover:
+            self.close()
+
+    def active(self):
+        # Path of the open file, None if there is none
+        return self.path if self.file is not None else None
+
+    def close(self):
+        if self.flushtimer is not None:
+            self.flushtimer.cancel()
+            self.flushtimer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class DailyFileHandler(logging.FileHandler):
+    # FileHandler writing to the file template names for the current UTC day, e.g. '{}_rawlog.log'
+    def __init__(self, directory, template):
+        self.directory = directory
+        self.template = template
+        os.makedirs(directory, exist_ok=True)
+
+        path, self.rollover = dayfile(directory, template, time.time())
+        logging.FileHandler.__init__(self, path, encoding="utf-8", delay=True)
+
+    def emit(self, record):
+        if record.created >= self.rollover:
+            path, self.rollover = dayfile(self.directory, self.template, record.created)
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(path)
+
+        logging.FileHandler.emit(self, record)
+
+    def rotate(self, now):
+        # Same as ChatLog.rotate, the listener thread may be emitting so this takes the handler's lock
+        with self.lock:
+            if self.stream is not None and now >= self.rollover:
+                self.stream.close()
+                self.stream = None
+
+    def active(self):
+        with self.lock:
+            return self.baseFilename if self.stream is not None else None
+
+
+class LogRouter:
+    # Stands in for logger propagation inside the listener thread: a record goes to the handlers registered
+    # for its logger and for every parent of it, up to the root logger ('').
+    def __init__(self):
+        self.handlers = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, handler):
+        with self.lock:
+            self.handlers[name] = self.handlers.get(name, ()) + (handler,)
+
+    def remove(self, name, handler):
+        with self.lock:
+            self.handlers[name] = tuple(existing for existing in self.handlers.get(name, ())
+                                        if existing is not handler)
+
+    def handle(self, record):
+        name = record.name if record.name != "root" else ""
+        while True:
+            for handler in self.handlers.get(name, ()):
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            if not name:
+                return
+            name = name.rpartition(".")[0]
+
+
+# Handlers run by the listener thread, register them here instead of on a logger once startlistener() ran
+router = LogRouter()
+
+
+def startlistener():
+    # The root logger's handlers move to a background thread and the root logger gets a QueueHandler instead,
+    # so logging never waits on a console or disk. Records are formatted before they are queued (only if
+    # their level is enabled), everything else happens in the listener.
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        router.add("", handler)
+
+    root.addHandler(logging.handlers.QueueHandler(queue.SimpleQueue()))
+    listener = logging.handlers.QueueListener(root.handlers[0].queue, router)
+    listener.start()
+    return listener
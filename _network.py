@@ -0,0 +1,276 @@
+"""
+Copyright 2016 Pawel Bartusiak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import codecs
+import collections
+import time
+
+
+class LineFramer:
+    # Splits the stream from Twitch into '\r\n' terminated lines. Reads are collected in one
+    # reusable buffer, only the unfinished tail of a read is moved back to the front, and
+    # complete lines are decoded on their own so multibyte characters never get split.
+    def __init__(self, minreadsize=4096, maxreadsize=65536):
+        self.minreadsize = minreadsize
+        self.maxreadsize = maxreadsize
+        self.readsize = minreadsize
+
+        self.buffer = bytearray(maxreadsize * 2)
+        self.view = memoryview(self.buffer)
+        self.end = 0
+        self.scanned = 0
+
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed(self, data):
+        # Returns the complete lines once data (e.g. a read from an asyncio StreamReader) is added
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.adapt(len(data))
+        return self.commit(len(data))
+
+    def adapt(self, received):
+        # Grow the read size while reads come back full, shrink it again once chat calms down
+        if received >= self.readsize:
+            self.readsize = min(self.readsize * 2, self.maxreadsize)
+        elif received < self.readsize // 4:
+            self.readsize = max(self.readsize // 2, self.minreadsize)
+
+    def reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+
+        # Only happens for a single line longer than the buffer
+        self.view.release()
+        self.buffer.extend(bytes(self.end + size - len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+    def commit(self, received):
+        self.end += received
+        lines = []
+        start = 0
+        # A '\r' at the very end of the previous read may be completed by this one
+        pos = max(self.scanned - 1, 0)
+
+        while True:
+            found = self.buffer.find(b"\r\n", pos, self.end)
+            if found == -1:
+                break
+
+            lines.append(self.decoder.decode(self.view[start:found], True))
+            start = pos = found + 2
+
+        if start:
+            remaining = self.end - start
+            self.buffer[:remaining] = bytes(self.view[start:self.end])
+            self.end = remaining
+
+        self.scanned = self.end
+        return lines
+
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.period)
+        self.updated = now
+
+    def delay(self, now):
+        # Seconds until one token is available
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) * self.period / self.capacity
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class OutboundQueue:
+    # Paces everything the bot says in chat to stay inside Twitch's limits:
+    #   chat        20 messages per 30 seconds (100 while the bot is a moderator/broadcaster)
+    #   whispers    3 per second and 100 per minute
+    # Moderation actions share the chat limit but always go out before queued replies,
+    # and while slow mode is on (and the bot isn't a moderator) chat messages are spaced out.
+    # Twitch counts both chat limits and whispers per account, so a connection passes the
+    # same buckets to the queue of every channel it joined.
+    lanes = ("moderation", "chat", "whisper")
+
+    def __init__(self, chatbucket=None, whisperbuckets=None, modbucket=None):
+        self.queues = {lane: collections.deque() for lane in self.lanes}
+        self.chatbucket = chatbucket if chatbucket is not None else TokenBucket(20, 30)
+        self.modbucket = modbucket if modbucket is not None else TokenBucket(100, 30)
+        self.whisperbuckets = whisperbuckets if whisperbuckets is not None else (TokenBucket(3, 1),
+                                                                                 TokenBucket(100, 60))
+        self.moderator = False
+        self.slowmode = 0
+        self.lastchat = 0.0
+
+        self.wakeup = None
+        self.task = None
+        self.metrics = {lane: {"depth": 0, "maxdepth": 0, "sent": 0, "totalwait": 0.0, "maxwait": 0.0}
+                        for lane in self.lanes}
+
+    def setmoderator(self, moderator):
+        self.moderator = moderator
+
+    def bucket(self):
+        return self.modbucket if self.moderator else self.chatbucket
+
+    def setslowmode(self, seconds):
+        self.slowmode = int(seconds) if str(seconds).isdigit() else 0
+
+    def start(self, writer, loop=None):
+        loop = loop if loop is not None else asyncio.get_event_loop()
+        if self.task is not None:
+            self.task.cancel()
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self.run(writer))
+        return self.task
+
+    def put(self, data, lane="chat"):
+        queue = self.queues[lane]
+        queue.append((data, time.monotonic()))
+
+        metrics = self.metrics[lane]
+        metrics["depth"] = len(queue)
+        metrics["maxdepth"] = max(metrics["maxdepth"], len(queue))
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def delay(self, lane, now):
+        if lane == "whisper":
+            return max(bucket.delay(now) for bucket in self.whisperbuckets)
+
+        delay = self.bucket().delay(now)
+        if lane == "chat" and self.slowmode and not self.moderator:
+            delay = max(delay, self.lastchat + self.slowmode - now)
+        return delay
+
+    def flush(self, writer):
+        # Writes every message the limits currently allow, returns the seconds until the
+        # next queued message may be sent (None when nothing is queued)
+        while True:
+            now = time.monotonic()
+            nextdelay = None
+            sent = False
+
+            for lane in self.lanes:
+                queue = self.queues[lane]
+                if not queue:
+                    continue
+
+                delay = self.delay(lane, now)
+                if delay > 0:
+                    nextdelay = delay if nextdelay is None else min(nextdelay, delay)
+                    continue
+
+                data, queued = queue.popleft()
+                writer.write(data)
+
+                if lane == "whisper":
+                    for bucket in self.whisperbuckets:
+                        bucket.take(now)
+                else:
+                    self.bucket().take(now)
+                    self.lastchat = now
+
+                metrics = self.metrics[lane]
+                metrics["depth"] = len(queue)
+                metrics["sent"] += 1
+                metrics["totalwait"] += now - queued
+                metrics["maxwait"] = max(metrics["maxwait"], now - queued)
+                sent = True
+                break
+
+            if not sent:
+                return nextdelay
+
+    async def run(self, writer):
+        while True:
+            self.wakeup.clear()
+            delay = self.flush(writer)
+            try:
+                await writer.drain()
+            except OSError:
+                # Connection lost, the queue is started again on the new connection
+                return
+
+            try:
+                if delay is None:
+                    await self.wakeup.wait()
+                else:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def cancel(self):
+        # Stops sending, queued messages are kept until the queue is started again
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stop(self, writer):
+        # Writes whatever the limits still allow, anything left in the queue is dropped
+        self.flush(writer)
+        self.cancel()
+
+    def stats(self):
+        stats = {}
+        for lane, metrics in self.metrics.items():
+            stats[lane] = dict(metrics, avgwait=metrics["totalwait"] / metrics["sent"] if metrics["sent"] else 0.0)
+        return stats
+
+
+class OutboundWriter:
+    # Collects every line written during one pass of the event loop (replies, PONGs, queued
+    # chat messages) and hands them to the transport as one write, i.e. one send() syscall.
+    def __init__(self, writer, loop=None):
+        self.writer = writer
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.buffer = bytearray()
+        self.scheduled = False
+
+        self.lines = 0
+        self.flushes = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.lines += 1
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        if not self.buffer:
+            return
+
+        data, self.buffer = self.buffer, bytearray()
+        self.writer.write(data)
+        self.flushes += 1
+
+    async def drain(self):
+        self.flush()
+        await self.writer.drain()
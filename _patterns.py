@@ -0,0 +1,426 @@
+"""
+Copyright 2016 Pawel Bartusiak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import re
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Optional linear time engine, patterns it can run don't need the sandbox worker
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+def requiredliteral(pattern, flags=0):
+    # The longest run of plain text every match of pattern has to contain, '' if there is none.
+    # Raises re.error for patterns that don't compile.
+    runs = []
+
+    def walk(items):
+        run = ""
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                run += chr(av)
+                continue
+
+            runs.append(run)
+            run = ""
+            # Groups and repeats that have to match at least once contain required text as well,
+            # alternatives, optional parts and lookarounds don't
+            if op is sre_parse.SUBPATTERN:
+                walk(av[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+        runs.append(run)
+
+    walk(sre_parse.parse(pattern, flags))
+    return max(runs, key=len)
+
+
+# Characters the backtracking check tries, the literals and range ends of the pattern itself are added to them
+samplechars = "".join(chr(code) for code in range(128)) + "\u00a0\u00e9\u0416\u4e2d\U0001f600"
+
+repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+# Neither is backtracked into, only on Python 3.11+
+atomicgroup = getattr(sre_parse, "ATOMIC_GROUP", None)
+possessiverepeat = getattr(sre_parse, "POSSESSIVE_REPEAT", None)
+singles = (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN)
+zerowidth = (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT)
+
+categories = {
+    sre_parse.CATEGORY_DIGIT: (str.isdigit, False),
+    sre_parse.CATEGORY_NOT_DIGIT: (str.isdigit, True),
+    sre_parse.CATEGORY_SPACE: (str.isspace, False),
+    sre_parse.CATEGORY_NOT_SPACE: (str.isspace, True),
+    sre_parse.CATEGORY_WORD: (lambda char: char.isalnum() or char == "_", False),
+    sre_parse.CATEGORY_NOT_WORD: (lambda char: char.isalnum() or char == "_", True),
+}
+
+
+def subpatterns(op, av):
+    # The nested item lists of a parsed item
+    if op is sre_parse.SUBPATTERN:
+        return [av[-1]]
+    if op in repeats or op is possessiverepeat:
+        return [av[2]]
+    if op is atomicgroup:
+        return [av]
+    if op is sre_parse.BRANCH:
+        return av[1]
+    if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return [av[1]]
+    if op is sre_parse.GROUPREF_EXISTS:
+        return [branch for branch in av[1:] if branch is not None]
+    return []
+
+
+def catastrophic(pattern, flags=0):
+    # True if a failing search of pattern can take exponential time: inside a repeat, a part with a choice (a repeat,
+    # an optional part or alternatives starting alike) can also be matched by what follows it, like (a+)+,
+    # (\w+\s?)* or (a|aa)+. Every way of splitting a text between the two is then tried. A repeat set apart by a
+    # delimiter, like (?:[a-z]+\.)+, isn't flagged. Raises re.error for patterns that don't compile.
+    parsed = sre_parse.parse(pattern, flags)
+    state = getattr(parsed, "state", None) or parsed.pattern
+    ignorecase = state.flags & re.IGNORECASE
+    dotall = state.flags & re.DOTALL
+    ascii = state.flags & re.ASCII
+
+    alphabet = set(samplechars)
+
+    def collect(items):
+        for op, av in items:
+            if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL):
+                alphabet.add(chr(av))
+            elif op is sre_parse.IN:
+                for inop, inav in av:
+                    if inop is sre_parse.LITERAL:
+                        alphabet.add(chr(inav))
+                    elif inop is sre_parse.RANGE:
+                        alphabet.update((chr(inav[0]), chr(inav[1])))
+            for items in subpatterns(op, av):
+                collect(items)
+
+    collect(parsed)
+    if ascii:
+        alphabet = {char for char in alphabet if char < "\x80"}
+
+    def variants(char):
+        return {char, char.lower(), char.upper()} if ignorecase else {char}
+
+    def incategory(category, char):
+        test, negated = categories.get(category, (None, False))
+        if test is None:
+            return True
+        return (test(char) and (char < "\x80" or not ascii)) != negated
+
+    def single(op, av, char):
+        if op is sre_parse.LITERAL:
+            return chr(av) in variants(char)
+        if op is sre_parse.NOT_LITERAL:
+            return chr(av) not in variants(char)
+        if op is sre_parse.ANY:
+            return bool(dotall) or char != "\n"
+
+        negate = hit = False
+        for inop, inav in av:
+            if inop is sre_parse.NEGATE:
+                negate = True
+            elif inop is sre_parse.LITERAL:
+                hit = hit or chr(inav) in variants(char)
+            elif inop is sre_parse.RANGE:
+                hit = hit or any(inav[0] <= ord(variant) <= inav[1] for variant in variants(char))
+            elif inop is sre_parse.CATEGORY:
+                hit = hit or incategory(inav, char)
+            else:
+                hit = True
+        return hit != negate
+
+    def first(items):
+        # (characters a match of items can start with, whether items can match nothing)
+        chars = set()
+        for op, av in items:
+            itemchars, nullable = firstitem(op, av)
+            chars |= itemchars
+            if not nullable:
+                return chars, False
+        return chars, True
+
+    def firstitem(op, av):
+        if op in singles:
+            return {char for char in alphabet if single(op, av, char)}, False
+        if op in zerowidth:
+            return set(), True
+        if op in repeats or op in (sre_parse.SUBPATTERN, sre_parse.BRANCH, atomicgroup, possessiverepeat):
+            chars, nullable = set(), op is sre_parse.BRANCH and not av[1]
+            for items in subpatterns(op, av):
+                itemchars, itemnullable = first(items)
+                chars |= itemchars
+                nullable = nullable or itemnullable
+            if op in repeats or op is possessiverepeat:
+                nullable = nullable or av[0] == 0
+            return chars, nullable
+        # Backreferences, conditionals: could be anything
+        return set(alphabet), True
+
+    def check(items, follow, repeated):
+        # follow holds the characters that can come after items, repeated is whether items are inside a repeat
+        for index, (op, av) in enumerate(items):
+            restchars, restnullable = first(items[index + 1:])
+            after = restchars | follow if restnullable else restchars
+
+            if op in repeats:
+                low, high, item = av
+                bodychars, bodynullable = first(item)
+                if repeated and low != high and bodychars & after:
+                    return True
+                inner = bodychars | after if high > 1 else after
+                if check(item, inner, repeated or high == sre_parse.MAXREPEAT):
+                    return True
+
+            elif op is sre_parse.BRANCH:
+                branches = [first(branch) for branch in av[1]]
+                if repeated:
+                    starts = set()
+                    for chars, nullable in branches:
+                        # Two alternatives starting alike, or one that can be skipped for what follows
+                        if (starts & chars & after) or (nullable and set().union(*(c for c, n in branches)) & after):
+                            return True
+                        starts |= chars
+                if any(check(branch, after, repeated) for branch in av[1]):
+                    return True
+
+            elif op is sre_parse.SUBPATTERN:
+                if check(av[-1], after, repeated):
+                    return True
+
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                if check(av[1], set(), False):
+                    return True
+
+        return False
+
+    return check(parsed, set(), False)
+
+
+class AhoCorasick:
+    # Finds which of a set of strings occur in a text, all of them in a single pass over the text
+    def __init__(self, strings):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for string in strings:
+            state = 0
+            for char in string:
+                following = self.goto[state].get(char)
+                if following is None:
+                    following = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = following
+            if string and string not in self.output[state]:
+                self.output[state] += (string,)
+
+        # A state's fail link is the longest suffix of its text that is also a prefix of some string, states are
+        # linked breadth first so a fail target's own output is complete before it is copied
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, following in self.goto[state].items():
+                pending.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(char, 0)
+                self.output[following] += self.output[self.fail[following]]
+
+    def search(self, text):
+        found = set()
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+def sandboxworker(connection):
+    # Runs in the sandbox process: answers (pattern, flags, text) with (matched, CPU seconds)
+    connection.send("ready")
+    while True:
+        try:
+            pattern, flags, text = connection.recv()
+        except EOFError:
+            return
+
+        started = time.process_time()
+        matched = re.search(pattern, text, flags) is not None
+        connection.send((matched, time.process_time() - started))
+
+
+class RegexSandbox:
+    # Runs regexes given by moderators or the config without risking the event loop on one that backtracks
+    # catastrophically. Searches go to a worker process, waited on from a thread of the sandbox so the event loop
+    # carries on meanwhile, and are given up on after timeout seconds: the worker is killed, a new one is started
+    # from that thread and the search counts as no match. A pattern that timed out maxtimeouts times isn't run
+    # anymore. Patterns re2 can run are run in-process instead when it's installed.
+    # The CPU time every pattern took is kept in costs, (pattern, flags) -> [searches, total, max, timeouts].
+    timeout = 0.1
+    starttimeout = 30
+    maxtimeouts = 3
+
+    def __init__(self):
+        self.process = None
+        self.connection = None
+        # One thread, so searches reach the worker one at a time
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, "RegexSandbox")
+        self.linear = {}
+        self.costs = {}
+        self.restarts = 0
+
+    def start(self):
+        # Blocks until the worker is ready, meant for startup so the first message doesn't wait on it
+        if self.process is None:
+            self.spawn()
+
+    def spawn(self):
+        methods = multiprocessing.get_all_start_methods()
+        # The bot has threads of its own, forking it as a whole isn't safe
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=sandboxworker, args=(child,), name="RegexSandbox", daemon=True)
+        self.process.start()
+        child.close()
+
+        try:
+            if self.connection.poll(self.starttimeout):
+                self.connection.recv()
+                return
+        except EOFError:
+            pass
+        self.kill()
+        raise RuntimeError("Regex sandbox didn't start")
+
+    def kill(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+            self.process = None
+
+    def stop(self):
+        # Lets a search in progress finish first
+        self.executor.shutdown(wait=True)
+        self.kill()
+
+    def compilelinear(self, regex):
+        # re2 only gets IGNORECASE passed on, patterns using any other flag are left to the worker
+        if re2 is None or regex.flags & ~(re.IGNORECASE | re.UNICODE):
+            return None
+        try:
+            return re2.compile(("(?i)" if regex.flags & re.IGNORECASE else "") + regex.pattern)
+        except re2.error:
+            return None
+
+    def run(self, pattern, flags, text):
+        # Runs in the sandbox thread: (matched, CPU seconds), None if the worker ran out of time and was replaced
+        try:
+            return self.ask(pattern, flags, text)
+        except (OSError, EOFError):
+            # The worker died some other way (killed, out of memory), one more try with a new one
+            logging.warning("Regex sandbox worker stopped unexpectedly, starting a new one")
+            self.kill()
+            self.restarts += 1
+            return self.ask(pattern, flags, text)
+
+    def ask(self, pattern, flags, text):
+        if self.process is None:
+            self.spawn()
+        self.connection.send((pattern, flags, text))
+        if self.connection.poll(self.timeout):
+            return self.connection.recv()
+
+        self.kill()
+        self.restarts += 1
+        # Have the next worker ready before the next search
+        try:
+            self.spawn()
+        except RuntimeError:
+            logging.exception("Regex sandbox didn't restart, trying again with the next search")
+        return None
+
+    async def search(self, regex, text):
+        # True/False for whether the compiled regex matches anywhere in text, None if it couldn't be run in time
+        key = (regex.pattern, regex.flags)
+        cost = self.costs.get(key)
+        if cost is None:
+            cost = self.costs[key] = [0, 0.0, 0.0, 0]
+            self.linear[key] = self.compilelinear(regex)
+        if cost[3] >= self.maxtimeouts:
+            return None
+
+        linear = self.linear[key]
+        if linear is not None:
+            started = time.process_time()
+            matched = linear.search(text) is not None
+            took = time.process_time() - started
+        else:
+            loop = asyncio.get_event_loop()
+            try:
+                result = await loop.run_in_executor(self.executor, self.run, regex.pattern, regex.flags, text)
+            except (RuntimeError, OSError, EOFError):
+                logging.exception("Regex sandbox failed to run %r", regex.pattern)
+                return None
+
+            if result is None:
+                cost[3] += 1
+                logging.warning("Regex %r ran over %s seconds on a %d character message and was stopped",
+                                regex.pattern, self.timeout, len(text))
+                if cost[3] >= self.maxtimeouts:
+                    logging.error("Regex %r timed out %d times and won't be run anymore", regex.pattern, cost[3])
+                return None
+            matched, took = result
+
+        cost[0] += 1
+        cost[1] += took
+        cost[2] = max(cost[2], took)
+        return matched
+
+    def stats(self, top=5):
+        # The patterns that took the most CPU time in total
+        expensive = sorted(((key[0], cost) for key, cost in self.costs.items()),
+                           key=lambda item: item[1][1], reverse=True)[:top]
+        return {"restarts": self.restarts, "expensive": expensive}
+
+
+# Process-wide sandbox, searched from the event loop
+sandbox = RegexSandbox()
@@ -0,0 +1,154 @@
+"""
+Copyright 2016 Pawel Bartusiak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import concurrent.futures
+import functools
+import logging
+
+import _database
+
+
+def createtables(cursor):
+    # Every chat message of every channel, with an FTS5 index over the message text kept in step by a trigger
+    cursor.execute('CREATE TABLE messages(id INTEGER PRIMARY KEY, channel TEXT, ts REAL, userid INTEGER, '
+                   'username TEXT, message TEXT)')
+    cursor.execute('CREATE INDEX messages_user ON messages(channel, username, ts)')
+    cursor.execute('CREATE INDEX messages_ts ON messages(channel, ts)')
+    cursor.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(message, content='messages', content_rowid='id')")
+    cursor.execute('CREATE TRIGGER messages_insert AFTER INSERT ON messages BEGIN '
+                   'INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message); END')
+    cursor.execute('CREATE TRIGGER messages_delete AFTER DELETE ON messages BEGIN '
+                   "INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.id, old.message); END")
+
+
+migrations = [
+    createtables,
+]
+
+
+class ChatIndex:
+    # Full-text index of a channel's chat in a database of its own, a database per channel so the processes of
+    # different channels never wait on each other's writes. Messages are collected by add()
+    # and handed to a DatabaseWriter in batches, every flushinterval seconds or every maxbatch messages. Searches run
+    # in a thread of the index with a read-only connection of their own, see find().
+    flushinterval = 1
+    maxbatch = 500
+
+    def __init__(self, path, loop):
+        self.loop = loop
+        self.sqlConnection = _database.connect(path)
+        self.sqlCursor = self.sqlConnection.cursor()
+        self.sqlconn = (self.sqlConnection, self.sqlCursor)
+        _database.migrate(self.sqlconn, migrations)
+
+        self.writer = _database.openwriter(self.sqlconn, path)
+        self.pending = []
+        self.flushtimer = None
+
+        self.path = path
+        self.reader = concurrent.futures.ThreadPoolExecutor(1, "ChatIndex")
+        # Opened by the reader thread, the only one using it
+        self.readConnection = None
+
+    def add(self, channel, timestamp, userid, username, message):
+        self.pending.append((channel, timestamp, userid, username, message))
+        if len(self.pending) >= self.maxbatch:
+            self.flush()
+        elif self.flushtimer is None:
+            self.flushtimer = self.loop.call_later(self.flushinterval, self.flush)
+
+    def flush(self):
+        if self.flushtimer is not None:
+            self.flushtimer.cancel()
+            self.flushtimer = None
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, []
+        self.writer.executemany('INSERT INTO messages (channel, ts, userid, username, message) '
+                                'VALUES (?, ?, ?, ?, ?)', pending)
+
+    def find(self, channel, **criteria):
+        # Future of search(channel, **criteria), run in the reader thread once every message added so far is
+        # committed, so neither the wait nor the query holds up the loop
+        self.flush()
+        return self.loop.run_in_executor(self.reader, functools.partial(self.searchcommitted, channel, **criteria))
+
+    def searchcommitted(self, channel, **criteria):
+        self.writer.barrier()
+        if self.readConnection is None:
+            self.readConnection = _database.connect(self.path)
+            self.readConnection.execute('PRAGMA query_only = ON')
+        return self.search(channel, **criteria)
+
+    def search(self, channel, username=None, phrase=None, start=None, end=None, limit=10, offset=0):
+        # [(ts, username, message), ...] newest first, matching every criterion given. Only called in the reader
+        # thread, see find()
+        conditions = ["m.channel = ?"]
+        parameters = [channel]
+        source = "messages m"
+
+        if phrase:
+            source = "messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+            conditions.append("messages_fts MATCH ?")
+            # Searched for as one phrase, FTS5 query syntax in it is taken literally
+            parameters.append('"{}"'.format(phrase.replace('"', '""')))
+        if username:
+            conditions.append("m.username = ?")
+            parameters.append(username.lower())
+        if start is not None:
+            conditions.append("m.ts >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("m.ts < ?")
+            parameters.append(end)
+
+        try:
+            return self.readConnection.execute(
+                "SELECT m.ts, m.username, m.message FROM {source} WHERE {conditions} "
+                "ORDER BY m.ts DESC LIMIT ? OFFSET ?".format(source=source, conditions=" AND ".join(conditions)),
+                parameters + [limit, offset]).fetchall()
+        except _database.sql.OperationalError as e:
+            logging.error("Chat search failed: %s", e)
+            return []
+
+    def closereader(self):
+        if self.readConnection is not None:
+            self.readConnection.close()
+            self.readConnection = None
+
+    def close(self):
+        self.flush()
+        self.reader.submit(self.closereader)
+        self.reader.shutdown(wait=True)
+        _database.closewriter(self.sqlconn)
+        self.sqlConnection.close()
+
+
+# ChatIndex of every channel open in this process, keyed by the path of its database
+indexes = {}
+
+
+def openindex(path, loop):
+    index = indexes.get(path)
+    if index is None:
+        index = indexes[path] = ChatIndex(path, loop)
+    return index
+
+
+def closeindex():
+    while indexes:
+        indexes.popitem()[1].close()
@@ -19,6 +19,7 @@ from . import commands
 from . import config
 from . import constants
 from . import faq
+from . import logs
 from . import regulars
 
 
@@ -28,6 +29,7 @@ dispatch_naming = {
     'config': '$config',
     'faq': '$faq',
     'filters': '$filters',
+    'logs': '$logs',
     'regulars': '$regulars',
 }
 
@@ -36,6 +38,7 @@ dispatch_map = {
     dispatch_naming['commands']: commands.commands,
     dispatch_naming['config']: config.config,
     dispatch_naming['faq']: faq.faq,
+    dispatch_naming['logs']: logs.logs,
     dispatch_naming['regulars']: regulars.regulars,
 }
 
@@ -47,12 +50,16 @@ help_defaults = {
         '': '{command} help/add/edit/delete',
         'help': '{command} help <command> <args...>',
         'page': '{command} page <page#>',
-        'add': '{command} add [optional: \'-ul=###\' or \'-sm=whisper/privmsg\'] '
-               '<keyword> <output> (userlevel defaults to 0)',
+        'add': '{command} add [optional: \'-ul=###\', \'-sm=whisper/privmsg\', \'-cd=<seconds>\' or '
+               '\'-ucd=<seconds>\'] <keyword> <output> (userlevel defaults to 0, cooldowns to none)',
         'edit': '{command} edit <keyword> \'-ul=<userlevel>\' and/or \'-sm=whisper/privmsg\' and/or '
-                '\'-output="<output>"\'',
+                '\'-cd=<seconds>\' and/or \'-ucd=<seconds>\' and/or \'-output="<output>"\'',
         'delete': '{command} delete <keyword>'
     },
+    dispatch_naming['logs']: {
+        '': '{command} user <username>/phrase <words>/range [username] [\'-since=<n>m/h/d\'] '
+            '[\'-until=<n>m/h/d\'] [\'-page=<n>\']',
+    },
     dispatch_naming['regulars']: {
         '': '{command} add/delete',
         'add': '{command} add <username>',
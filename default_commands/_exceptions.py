@@ -71,3 +71,12 @@ class DCBirthdaysFormatError(DCError):
     pass
 
 # endregion
+
+# region Commands Exceptions
+
+
+class DCTemplateError(DCError):
+    """Exception for command outputs with placeholders that can't be filled in."""
+    pass
+
+# endregion
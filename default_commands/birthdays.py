@@ -15,11 +15,11 @@ limitations under the License.
 """
 
 import datetime
-import logging
 import re
 import time
 
-from .constants import ConfigDefaults, boolean
+import _database
+from .constants import ConfigDefaults
 import default_commands
 from default_commands._exceptions import *
 
@@ -37,24 +37,18 @@ class birthdays:
         self.whisper = whisper
         self.message = info["privmsg"]
 
-        self.sqlVariableString = "SELECT value FROM config WHERE grouping=? AND variable=?"
 
         self.configdefaults = ConfigDefaults(sqlconn)
 
-        self.enabled = boolean(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("birthdays", "enabled")).fetchone()[0])
+        self.enabled = self.configdefaults.cache.get("birthdays", "enabled")
 
-        self.commandkeyword = self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("birthdays", "keyword")).fetchone()[0]
-        default_commands.dispatch_naming["birthdays"] = self.commandkeyword
+        self.commandkeyword = self.configdefaults.cache.get("birthdays", "keyword")
 
         if not self.enabled:
             return
 
-        self.min_userlevel = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("birthdays", "min_userlevel")).fetchone()[0])
-        self.min_userlevel_edit = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("birthdays", "min_userlevel_edit")).fetchone()[0])
+        self.min_userlevel = self.configdefaults.cache.get("birthdays", "min_userlevel")
+        self.min_userlevel_edit = self.configdefaults.cache.get("birthdays", "min_userlevel_edit")
 
     def chat_access(self):
         try:
@@ -79,13 +73,13 @@ class birthdays:
         except DCBirthdaysFormatError:
             self.irc.send_whisper("Error: Usage '{help}'".format(
                 help=default_commands.help_defaults[default_commands.dispatch_naming['birthdays']]['']
-                    .format(command=default_commands.dispatch_naming['birthdays'])
+                    .format(command=self.commandkeyword)
             ), self.info["username"])
             return
 
         except DCUserlevelIncorrectError:
             self.irc.send_whisper("Error: You are not allowed to use {command}."
-                                  .format(command=default_commands.dispatch_naming['birthdays']),
+                                  .format(command=self.commandkeyword),
                                   self.info["username"])
             return
 
@@ -111,12 +105,12 @@ class birthdays:
                 if sqlCursorOffload is None:
                     self.irc.send_whisper(("Added birthdate '%s' successfully." % birthdate), self.info["username"])
 
-                    self.sqlCursorChannel.execute("INSERT INTO birthdays (userid, username, displayname, date) "
-                                                  "VALUES (?, ?, ?, ?)",
-                                                  (self.info["user-id"], self.info["username"],
-                                                   self.info["display-name"], birthdate))
-
-                    self.sqlConnectionChannel.commit()
+                    _database.writer(self.sqlconn).execute(
+                        "INSERT INTO birthdays (userid, username, displayname, date, month, day, year) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (self.info["user-id"], self.info["username"], self.info["display-name"], birthdate,
+                         int(split_birthdate[1]), int(split_birthdate[0]),
+                         int(split_birthdate[2]) if len(split_birthdate) == 3 else None))
 
                 else:
                     raise DCDatabaseEntryExists
@@ -138,7 +132,7 @@ class birthdays:
 
         except DCUserlevelIncorrectError:
             self.irc.send_whisper('Error: You are not allowed to use {command}.'
-                                  .format(command=default_commands.dispatch_naming['commands']),
+                                  .format(command=self.commandkeyword),
                                   self.info["username"])
 
             return
@@ -152,7 +146,7 @@ class birthdays:
         except IndexError:
             self.irc.send_whisper("Error: Usage '{help}'".format(
                 help=default_commands.help_defaults[default_commands.dispatch_naming['birthdays']]['']
-                    .format(command=default_commands.dispatch_naming['birthdays'])
+                    .format(command=self.commandkeyword)
             ), self.info["username"])
             return
 
@@ -164,10 +158,7 @@ class birthdays:
             return
 
     def refresh(self):
-        currentdatetime = time.gmtime(time.time())
-        currentdatetimelist = [int(currentdatetime[index]) for index in range(0, 6)]
-        birthdayusers = getbirthdayusers(self.sqlconn, self.configdefaults, currentdatetimelist)
-        self.bot.birthdayusers = birthdayusers
+        self.bot.birthdays.refresh()
         temp_string = "Refreshed birthday user list for channel {channel}".format(channel=self.irc.CHANNEL)
 
         if self.whisper:
@@ -177,7 +168,7 @@ class birthdays:
         return
 
     def users(self):
-        temp_string = "Users with birthdays today! (GMT): {list}".format(list=", ".join(self.bot.birthdayusers.keys()))
+        temp_string = "Users with birthdays today! (GMT): {list}".format(list=", ".join(self.bot.birthdays.users.keys()))
 
         if self.whisper:
             self.irc.send_whisper(temp_string, self.info["username"])
@@ -186,48 +177,103 @@ class birthdays:
         return
 
 
-def getbirthdayusers(sqlconn, configdefaults, currentdatetimelist):
-    if boolean(configdefaults.sqlExecute("SELECT value FROM config WHERE grouping=? AND variable=?",
-                                         ("birthdays", "enabled")).fetchone()[0]):
-
-        sqlConnectionChannel, sqlCursorChannel = sqlconn
-        birthdayusers = {}
-        sqlCursorChannel.execute("SELECT * FROM birthdays WHERE date LIKE ?",
-                                 ('{}%'.format("%02d/%02d" % (currentdatetimelist[2],
-                                                              currentdatetimelist[1])),))
-        sqlCursorOffload = sqlCursorChannel.fetchall()
+def ordinal(n):
+    return "%d%s" % (n, "tsnrhtdd"[(n // 10 % 10 != 1) * (n % 10 < 4) * n % 10::4])
 
-        if sqlCursorOffload:
-            for entry in sqlCursorOffload:
-                username = entry[1]
-                displayname = entry[2]
-                temp_age = ""
-                temp_split_date = entry[3].split("/")
-                if len(temp_split_date) == 3:
-                    def ordinal(n):
-                        return "%d%s" % (n, "tsnrhtdd"[(n // 10 % 10 != 1) *
-                                                       (n % 10 < 4) * n % 10::4])
 
-                    temp_birthyear = int(temp_split_date[2])
-                    temp_age = (currentdatetimelist[0] - temp_birthyear)
-                    temp_age = ordinal(temp_age)
+class BirthdaySchedule:
+    # Today's (UTC) birthday users of one channel as username -> (displayname, age, userid). The set is looked
+    # up once at start, the next day's shortly before midnight, and swapped in at midnight by loop timers,
+    # so chat never waits on it. Announcements are stored in birthdays.announced and survive a restart.
+    prefetch = 60
 
-                birthdayusers[username] = (displayname, temp_age)
+    def __init__(self, irc, sqlconn, configdefaults):
+        self.irc = irc
+        self.sqlconn = sqlconn
+        self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
+        self.configdefaults = configdefaults
+
+        self.today = None
+        self.users = {}
+        self.announced = set()
+        self.tomorrow = None
+        self.timer = None
+
+    def load(self, day):
+        # (users, announced) for a datetime.date
+        if not self.configdefaults.cache.get("birthdays", "enabled"):
+            return {}, set()
+
+        users = {}
+        announced = set()
+        for userid, username, displayname, year, lastannounced in self.sqlConnectionChannel.execute(
+                "SELECT userid, username, displayname, year, announced FROM birthdays WHERE month = ? AND day = ?",
+                (day.month, day.day)):
+            users[username] = (displayname, ordinal(day.year - year) if year else "", userid)
+            if lastannounced == day.isoformat():
+                announced.add(username)
+
+        return users, announced
 
+    def refresh(self):
+        # Birthdays added moments ago may still be queued in the database writer
+        _database.sync(self.sqlconn)
+        self.today = datetime.datetime.utcnow().date()
+        self.users, self.announced = self.load(self.today)
+        self.irc.log.info("[_BOTCOM] :| [CVAR] %s: Birthday users: %s", self.irc.CHANNEL, list(self.users.keys()))
+
+    def start(self):
+        self.refresh()
+        self.schedule()
+
+    def schedule(self):
+        now = datetime.datetime.utcnow()
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        untilmidnight = (midnight - now).total_seconds()
+
+        loop = self.irc.connection.loop
+        if self.tomorrow is None and untilmidnight > self.prefetch:
+            self.timer = loop.call_later(untilmidnight - self.prefetch, self.prefetchtomorrow)
         else:
-            pass
-
-        return birthdayusers
-
-    return {}
-
-
-def joinevent(irc, configdefaults, birthdayusers, username):
-    if username in list(birthdayusers.keys()) and \
-            boolean(configdefaults.sqlExecute("SELECT value FROM config WHERE grouping=? AND variable=?",
-                                              ("birthdays", "enabled")).fetchone()[0]):
-        irc.send_privmsg("Birthday Boy/Girl %s has joined the chat!"
-                         " Wish them a happy %s birthday!"
-                         % (birthdayusers[username][0],
-                            birthdayusers[username][1]),
-                         True)
+            self.timer = loop.call_later(untilmidnight, self.rollover)
+
+    def prefetchtomorrow(self):
+        day = datetime.datetime.utcnow().date() + datetime.timedelta(days=1)
+        self.tomorrow = (day,) + self.load(day)
+        self.schedule()
+
+    def rollover(self):
+        today = datetime.datetime.utcnow().date()
+        if self.tomorrow is not None and self.tomorrow[0] == today:
+            self.today, self.users, self.announced = self.tomorrow
+            self.irc.log.info("[_BOTCOM] :| [CVAR] %s: Birthday users: %s", self.irc.CHANNEL,
+                              list(self.users.keys()))
+        elif today != self.today:
+            self.refresh()
+        self.tomorrow = None
+        self.schedule()
+
+    def announce(self, username):
+        # The user's (displayname, age) the first time they join today, None otherwise
+        if username not in self.users or username in self.announced:
+            return None
+
+        self.announced.add(username)
+        displayname, age, userid = self.users[username]
+        _database.writer(self.sqlconn).execute("UPDATE birthdays SET announced = ? WHERE userid = ?",
+                                               (self.today.isoformat(), userid))
+        return displayname, age
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+def joinevent(irc, configdefaults, schedule, username):
+    if username in schedule.users and configdefaults.cache.get("birthdays", "enabled"):
+        birthday = schedule.announce(username)
+        if birthday is not None:
+            irc.send_privmsg("Birthday Boy/Girl %s has joined the chat!"
+                             " Wish them a happy %s birthday!" % birthday,
+                             True)
@@ -14,13 +14,179 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
 import logging
 import re
+import sqlite3
+import string
+import time
 
-from .constants import ConfigDefaults, boolean
+import _database
+from .constants import ConfigDefaults, configcache
 import default_commands
 from default_commands._exceptions import *
 
+# Flags $commands add and edit accept before the output
+commandflags = ("-ul=", "-sm=", "-cd=", "-ucd=")
+
+
+class Template:
+    # A command output parsed once into (literal, field, format spec) parts. Outputs may use the tags and fields of
+    # the message that triggered them, {help} and up to 3 arguments; anything else is rejected when compiling.
+    fields = {"username", "channel", "privmsg", "userlevel", "badges", "color", "display-name", "emotes", "id",
+              "mod", "room-id", "subscriber", "turbo", "user-id", "user-type", "help", "arg1", "arg2", "arg3"}
+
+    def __init__(self, output):
+        self.output = output
+        self.parts = []
+        self.placeholders = set()
+
+        try:
+            parsed = list(string.Formatter().parse(output))
+        except ValueError as e:
+            raise DCTemplateError(str(e))
+
+        unknown = []
+        for literal, field, spec, conversion in parsed:
+            if field is not None:
+                if field not in self.fields or conversion or "{" in spec:
+                    unknown.append("{%s}" % field)
+                self.placeholders.add(field)
+            self.parts.append((literal, field, spec))
+        if unknown:
+            raise DCTemplateError(", ".join(unknown))
+
+        # {arg2} alone still takes 2 arguments
+        self.args = max([int(field[3:]) for field in self.placeholders if field.startswith("arg")] or [0])
+        self.me = output.startswith('/me') or output.startswith('.me')
+
+    def render(self, values):
+        return "".join(literal + (format(values[field], spec) if field is not None else "")
+                       for literal, field, spec in self.parts)
+
+
+def compiletemplate(keyword, output):
+    # Template of a stored row, None (and logged) for outputs saved before they were checked
+    try:
+        return Template(output)
+    except DCTemplateError as e:
+        logging.warning("Command '%s' has an output that can't be used: %s", keyword, e)
+        return None
+
+
+class Cooldowns:
+    # Monotonic deadlines of the cooldowns running in one channel, keyed by keyword for channel wide cooldowns
+    # and by (keyword, username) for per user ones. Past maxentries the expired entries are dropped, then the
+    # oldest, so a flood of different users can't grow it without bound.
+    maxentries = 10000
+
+    def __init__(self):
+        self.deadlines = collections.OrderedDict()
+        self.metrics = {"suppressed": 0, "started": 0, "evicted": 0}
+
+    def active(self, keyword, username):
+        now = time.monotonic()
+        for key in (keyword, (keyword, username)):
+            deadline = self.deadlines.get(key)
+            if deadline is not None and deadline > now:
+                self.metrics["suppressed"] += 1
+                return True
+        return False
+
+    def start(self, keyword, username, cooldown, usercooldown):
+        now = time.monotonic()
+        if cooldown > 0:
+            self.set(keyword, now + cooldown)
+        if usercooldown > 0:
+            self.set((keyword, username), now + usercooldown)
+
+    def set(self, key, deadline):
+        self.deadlines.pop(key, None)
+        self.deadlines[key] = deadline
+        self.metrics["started"] += 1
+        if len(self.deadlines) > self.maxentries:
+            self.prune()
+
+    def prune(self):
+        # Shrinks to 3/4 of maxentries so the next prune is maxentries/4 cooldowns away
+        now = time.monotonic()
+        for key in [key for key, deadline in self.deadlines.items() if deadline <= now]:
+            del self.deadlines[key]
+        while len(self.deadlines) > self.maxentries * 3 // 4:
+            self.deadlines.popitem(last=False)
+            self.metrics["evicted"] += 1
+
+    def stats(self):
+        return dict(self.metrics, active=len(self.deadlines))
+
+
+# CommandTable of every open channel database, keyed by its sqlite3 connection (which can't be weakly referenced)
+tables = {}
+
+
+class CommandTable:
+    # The custom commands of one channel held in memory as keyword -> row, rows as stored in the commands
+    # table: (userlevel, keyword, output, args, sendtype, syntaxerr, cooldown, usercooldown). add/update/delete
+    # write through.
+    def __init__(self, sqlconn):
+        self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
+        self.writer = _database.writer(sqlconn)
+        self.commands = None
+        self.templates = {}
+        self.cooldowns = Cooldowns()
+
+    def load(self):
+        self.commands = {row[1]: row for row in self.sqlConnectionChannel.execute(
+            'SELECT userlevel, keyword, output, args, sendtype, syntaxerr, cooldown, usercooldown FROM commands')}
+        self.templates = {keyword: compiletemplate(keyword, row[2]) for keyword, row in self.commands.items()}
+        return self.commands
+
+    def rows(self):
+        return (self.commands if self.commands is not None else self.load()).values()
+
+    def get(self, keyword):
+        return (self.commands if self.commands is not None else self.load()).get(keyword)
+
+    def template(self, keyword):
+        self.get(keyword)
+        return self.templates.get(keyword)
+
+    def add(self, row):
+        # Raises sqlite3.IntegrityError if the keyword already exists, the table itself is the authority
+        # since the INSERT is only committed later by the database writer
+        if self.get(row[1]) is not None:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: commands.keyword")
+        self.writer.execute(
+            'INSERT INTO commands (userlevel, keyword, output, args, sendtype, syntaxerr, cooldown, usercooldown) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+        self.commands[row[1]] = (int(row[0]),) + tuple(row[1:])
+        self.templates[row[1]] = compiletemplate(row[1], row[2])
+
+    def update(self, row):
+        self.writer.execute(
+            'UPDATE commands SET userlevel = ?, output = ?, args = ?, sendtype = ?, syntaxerr = ?, cooldown = ?, '
+            'usercooldown = ? WHERE keyword = ?', (row[0], row[2], row[3], row[4], row[5], row[6], row[7], row[1]))
+        self.get(row[1])
+        self.commands[row[1]] = (int(row[0]),) + tuple(row[1:])
+        self.templates[row[1]] = compiletemplate(row[1], row[2])
+
+    def delete(self, keyword):
+        self.writer.execute('DELETE FROM commands WHERE keyword == ?', (keyword,))
+        self.get(keyword)
+        self.commands.pop(keyword, None)
+        self.templates.pop(keyword, None)
+
+
+def commandtable(sqlconn):
+    table = tables.get(sqlconn[0])
+    if table is None:
+        table = tables[sqlconn[0]] = CommandTable(sqlconn)
+    return table
+
+
+def droptable(sqlconn):
+    tables.pop(sqlconn[0], None)
+
 
 class commands:
     def __init__(self, bot, irc, sqlconn, info, userlevel=0, whisper=False):
@@ -34,24 +200,19 @@ class commands:
         self.message = info["privmsg"]
         self.userlevel = userlevel
         self.whisper = whisper
-        self.sqlVariableString = "SELECT value FROM config WHERE grouping=? AND variable=?"
 
         self.configdefaults = ConfigDefaults(sqlconn)
+        self.table = commandtable(sqlconn)
 
-        self.enabled = boolean(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("commands", "enabled")).fetchone()[0])
+        self.enabled = self.configdefaults.cache.get("commands", "enabled")
 
-        self.commandkeyword = self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("commands", "keyword")).fetchone()[0]
-        default_commands.dispatch_naming["commands"] = self.commandkeyword
+        self.commandkeyword = self.configdefaults.cache.get("commands", "keyword")
 
         if not self.enabled:
             return
 
-        self.min_userlevel = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("commands", "min_userlevel")).fetchone()[0])
-        self.min_userlevel_edit = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("commands", "min_userlevel_edit")).fetchone()[0])
+        self.min_userlevel = self.configdefaults.cache.get("commands", "min_userlevel")
+        self.min_userlevel_edit = self.configdefaults.cache.get("commands", "min_userlevel_edit")
 
     def chat_access(self):
         temp_split = self.message.split(' ')
@@ -69,23 +230,17 @@ class commands:
                         return
                 else:
                     self.irc.send_privmsg('Error: You are not allowed to use any variations of {command}.'
-                                          .format(command=default_commands.dispatch_naming['commands']))
+                                          .format(command=self.commandkeyword))
                     return
             else:
                 self.disp_commands()
 
     def disp_commands(self):
-        self.sqlCursorChannel.execute('SELECT userlevel FROM commands')
-
-        sqlCursorOffload = self.sqlCursorChannel.fetchall()
-
-        if not sqlCursorOffload:
+        if not self.table.rows():
             self.irc.send_privmsg(': Error: Channel %s has no custom commands.' % self.irc.CHANNEL, True)
             return
 
-        self.sqlCursorChannel.execute('SELECT * FROM commands WHERE userlevel <= ?', (self.userlevel,))
-
-        sqlCursorOffload = self.sqlCursorChannel.fetchall()
+        sqlCursorOffload = [entry for entry in self.table.rows() if entry[0] <= self.userlevel]
 
         command_dict = {}
         command_string = ''
@@ -113,15 +268,20 @@ class commands:
     def page(self):
         pass
 
+    def cooldown(self, parameter):
+        # Seconds of a '-cd=' or '-ucd=' flag, None once chat was told why it can't be used
+        value = parameter.split("=", 1)[1]
+        if not value.isdigit() or int(value) > 86400:
+            self.irc.send_privmsg("Error: Invalid cooldown, must be 0 <= seconds <= 86400.")
+            return None
+        return int(value)
+
     def help(self):
         parameters = self.message.split("help", 1)
         if len(parameters[1]) <= 0:
-            command_keyword = default_commands.dispatch_naming['commands']
-            if command_keyword not in default_commands.help_defaults:
-                self.irc.send_privmsg("Error: '%s' is not a valid command variation." % command_keyword)
-                return
-
-            command_help = default_commands.help_defaults[command_keyword][''].format(command=command_keyword)
+            command_keyword = self.commandkeyword
+            command_help = default_commands.help_defaults[default_commands.dispatch_naming['commands']]['']
+            command_help = command_help.format(command=command_keyword)
             self.irc.send_privmsg(('%s help -> ' + command_help) % command_keyword, True)
             return
 
@@ -131,9 +291,10 @@ class commands:
         command_variant = split_params[1].strip() if len(split_params) == 2 else ''
 
         try:
-            if command_keyword in default_commands.dispatch_map:
-                command_help = default_commands.help_defaults[command_keyword][command_variant] \
-                    .format(command=command_keyword)
+            command = self.configdefaults.cache.command(command_keyword)
+            if command is not None:
+                command_help = default_commands.help_defaults[default_commands.dispatch_naming[command]]
+                command_help = command_help[command_variant].format(command=command_keyword)
                 self.irc.send_privmsg(('%s %s -> ' + command_help) % (command_keyword, command_variant), True)
             else:
                 self.irc.send_privmsg("Error: '%s' is not a valid command." % command_keyword)
@@ -156,9 +317,16 @@ class commands:
             command_sendmode = "privmsg"
             userlevel_specified = False
             sendmode_specified = False
+            command_cooldowns = {}
 
             for split_pos in range(len(split_params)):
-                if userlevel_specified and sendmode_specified:
+                if userlevel_specified and sendmode_specified and len(command_cooldowns) == 2:
+                    break
+                # Flags follow the keyword, -output= and anything after it is left to the output
+                if split_pos > 0 and not split_params[split_pos].startswith(commandflags):
+                    break
+                # Flags lead the parameters, the output may contain words that look like one
+                if not split_params[split_pos].startswith(commandflags):
                     break
 
                 if userlevel_specified:
@@ -202,27 +370,30 @@ class commands:
                 else:
                     command_sendmode = "privmsg"
 
+                flag = split_params[split_pos].split("=", 1)[0]
+                if flag in ("-cd", "-ucd") and flag not in command_cooldowns:
+                    command_offset += 1
+                    command_cooldowns[flag] = self.cooldown(split_params[split_pos])
+                    if command_cooldowns[flag] is None:
+                        return
+
             command_keyword = split_params[command_offset]
 
-            if command_keyword in default_commands.dispatch_map:
+            if self.configdefaults.cache.command(command_keyword) is not None:
                 self.irc.send_privmsg("Error: Command keyword must not shadow a default command.")
                 return
 
             command_output = " ".join(split_params[(command_offset + 1):])
 
-            self.sqlCursorChannel.execute('SELECT keyword FROM commands WHERE keyword == ?',
-                                          (command_keyword,))
-            sqlCursorOffload = self.sqlCursorChannel.fetchone()
-            if sqlCursorOffload is not None:
+            if self.table.get(command_keyword) is not None:
                 self.irc.send_privmsg("Error: Command with keyword '%s' already exists." % command_keyword)
                 return
 
-            command_args = 0
-            for x in range(3):
-                for word in command_output.split(" "):
-                    if "{arg%d}" % (x + 1) in word:
-                        command_args += 1
-                        break
+            try:
+                command_args = Template(command_output).args
+            except DCTemplateError as e:
+                self.irc.send_privmsg("Error: Invalid placeholders in output: %s" % e)
+                return
 
             syntaxerr = "Error: Unexpected error occurred."
 
@@ -231,12 +402,12 @@ class commands:
                 for x in range(command_args):
                     syntaxerr += " <arg%d>" % (x + 1)
 
-            self.sqlCursorChannel.execute(
-                'INSERT INTO commands (userlevel, keyword, output, args, sendtype, syntaxerr) '
-                'VALUES (?, ?, ?, ?, ?, ?)', (command_userlevel, command_keyword, command_output,
-                                              command_args, command_sendmode, syntaxerr)
-            )
-            self.sqlConnectionChannel.commit()
+            try:
+                self.table.add((command_userlevel, command_keyword, command_output, command_args, command_sendmode,
+                                syntaxerr, command_cooldowns.get("-cd", 0), command_cooldowns.get("-ucd", 0)))
+            except sqlite3.IntegrityError:
+                self.irc.send_privmsg("Error: Command with keyword '%s' already exists." % command_keyword)
+                return
 
             self.irc.send_privmsg("Added '%s' successfully." % command_keyword)
             return
@@ -274,18 +445,16 @@ class commands:
             output_specified = False
             userlevel_specified = False
             sendmode_specified = False
+            command_cooldowns = {}
 
             command_keyword = split_params[0]
             if len(split_params) <= 1:
                 self.irc.send_privmsg("Error: Edit command must have at least 1 edit parameter "
                                       "(type \"{command} help {command} edit\" for information."
-                                      .format(command=default_commands.dispatch_naming["commands"]))
+                                      .format(command=self.commandkeyword))
                 return
 
-            self.sqlCursorChannel.execute('SELECT * FROM commands WHERE keyword == ?',
-                                          (command_keyword,))
-
-            sqlCursorOffload = self.sqlCursorChannel.fetchone()
+            sqlCursorOffload = self.table.get(command_keyword)
 
             if sqlCursorOffload is None:
                 self.irc.send_privmsg("Error: Command with keyword '%s' does not exist" % command_keyword)
@@ -314,7 +483,7 @@ class commands:
                     return
 
             for split_pos in range(len(split_params)):
-                if userlevel_specified and sendmode_specified:
+                if userlevel_specified and sendmode_specified and len(command_cooldowns) == 2:
                     break
 
                 if userlevel_specified:
@@ -359,18 +528,24 @@ class commands:
                 else:
                     command_sendmode = "privmsg"
 
+                flag = split_params[split_pos].split("=", 1)[0]
+                if flag in ("-cd", "-ucd") and flag not in command_cooldowns:
+                    command_offset += 1
+                    command_cooldowns[flag] = self.cooldown(split_params[split_pos])
+                    if command_cooldowns[flag] is None:
+                        return
+
             if not output_specified and sqlCursorOffload is not None:
                 command_output = sqlCursorOffload[2]
                 command_args = sqlCursorOffload[3]
                 command_syntaxerr = sqlCursorOffload[5]
 
             elif output_specified:
-                command_args = 0
-                for x in range(3):
-                    for word in command_output.split(" "):
-                        if "{arg%d}" % (x + 1) in word:
-                            command_args += 1
-                            break
+                try:
+                    command_args = Template(command_output).args
+                except DCTemplateError as e:
+                    self.irc.send_privmsg("Error: Invalid placeholders in output: %s" % e)
+                    return
 
                 if command_args > 0:
                     command_syntaxerr = "Syntax Error: %s" % command_keyword
@@ -390,12 +565,9 @@ class commands:
             if not sendmode_specified and sqlCursorOffload is not None:
                 command_sendmode = sqlCursorOffload[4]
 
-            self.sqlCursorChannel.execute(
-                'UPDATE commands SET userlevel = ?, output = ?, args = ?, sendtype = ?, syntaxerr = ? '
-                'WHERE keyword = ?', (command_userlevel, command_output, command_args, command_sendmode,
-                                      command_syntaxerr, command_keyword)
-            )
-            self.sqlConnectionChannel.commit()
+            self.table.update((command_userlevel, command_keyword, command_output, command_args,
+                               command_sendmode, command_syntaxerr, command_cooldowns.get("-cd", sqlCursorOffload[6]),
+                               command_cooldowns.get("-ucd", sqlCursorOffload[7])))
 
             self.irc.send_privmsg("Edited '%s' successfully." % command_keyword)
             return
@@ -419,19 +591,11 @@ class commands:
             split_params = parameters.split(" ")
             command_keyword = split_params[0]
 
-            self.sqlCursorChannel.execute('SELECT keyword FROM commands WHERE keyword == ?',
-                                          (command_keyword,))
-            sqlCursorOffload = self.sqlCursorChannel.fetchone()
-
-            if sqlCursorOffload is None:
+            if self.table.get(command_keyword) is None:
                 self.irc.send_privmsg("Error: Command with keyword '%s' does not exist" % command_keyword)
                 return
             else:
-                self.sqlCursorChannel.execute(
-                    'DELETE FROM commands WHERE keyword == ?',
-                    (command_keyword,)
-                )
-                self.sqlConnectionChannel.commit()
+                self.table.delete(command_keyword)
 
             self.irc.send_privmsg("Deleted '%s' successfully." % command_keyword)
             return
@@ -446,23 +610,36 @@ class commands:
 
 
 def customCommands(bot, irc, sqlconn, info, message=False, whisper=False):
+    if message is False:
+        message = info["privmsg"]
+
+    # Most chat isn't a command, a first word that isn't a keyword returns before any SQL
+    split_message = message.split(" ")
+    handler = configcache(sqlconn).handler(split_message[0])
+    table = commandtable(sqlconn)
+    command = table.get(split_message[0]) if handler is None else None
+    if handler is None and command is None:
+        return
+
+    # Spam of a command on cooldown is dropped before anything else is done for it
+    cooldowns = table.cooldowns
+    if command is not None and cooldowns.active(command[1], info["username"]):
+        return
+
     # Deal with variables/sql
     sqlConnectionChannel, sqlCursorChannel = sqlconn
 
-    if message is False:
-        message = info["privmsg"]
-    else:
-        message = message
+    # Values only needed for this command are layered over the parsed message instead of written into it
+    overlay = {}
+    info = collections.ChainMap(overlay, info)
 
-    if whisper and message is not False:
-        info["privmsg"] = message
+    if whisper:
+        overlay["privmsg"] = message
 
     userlevel = info["userlevel"]
-    info["help"] = list(info.keys())
-    split_message = message.split(" ")
-    info["arg1"] = "nil" if (len(split_message) - 1) < 1 else split_message[1]
-    info["arg2"] = "nil" if (len(split_message) - 1) < 2 else split_message[2]
-    info["arg3"] = "nil" if (len(split_message) - 1) < 3 else split_message[3]
+    overlay["arg1"] = "nil" if (len(split_message) - 1) < 1 else split_message[1]
+    overlay["arg2"] = "nil" if (len(split_message) - 1) < 2 else split_message[2]
+    overlay["arg3"] = "nil" if (len(split_message) - 1) < 3 else split_message[3]
 
     if whisper:
         sqlCursorChannel.execute('SELECT userlevel FROM userLevel WHERE username == ?', (info['username'],))
@@ -472,69 +649,52 @@ def customCommands(bot, irc, sqlconn, info, message=False, whisper=False):
         else:
             userlevel = 0
 
-    temp_message_split = message.split(" ", 1)
-    if temp_message_split[0] in list(default_commands.dispatch_map.keys()):
-        default_commands.dispatch_map[temp_message_split[0]](bot, irc, sqlconn, info,
-                                                             userlevel=userlevel, whisper=whisper).chat_access()
+    if handler is not None:
+        handler(bot, irc, sqlconn, info, userlevel=userlevel, whisper=whisper).chat_access()
         return
 
-    sqlCursorChannel.execute('SELECT * FROM commands WHERE userlevel <= ?',
-                             (userlevel,))
-    sqlCursorOffload = sqlCursorChannel.fetchall()
-
-    # For every command in DB
-    for command in sqlCursorOffload:
-        try:
-            # Checks if user is indeed requesting that command and is above or equal to the required userlevel
-            if split_message[0] == command[1] and userlevel >= command[0]:
-                logging.debug("Command usage request acknowledged")
-                # Check is amount of args given is equal to the required amount
-                if (len(split_message) - 1) == command[3]:
-                    # Tidies command varible
-                    command_output = command[2]
-                    command_sendtype = command[4]
-                    me = False
-
-                    if command_output.startswith('/me') or command_output.startswith('.me'):
-                        me = True
-
-                    # Checks for 1, 2 or 3 args
-                    if command[3] == 1:
-                        info["arg1"] = " ".join(split_message[1:])
-                        command_output = str(command[2]).format(arg1=info['arg1'])
-                    elif command[3] == 2:
-                        info["arg2"] = " ".join(split_message[2:])
-                        command_output = str(command[2]).format(arg1=info['arg1'],
-                                                                arg2=info['arg2'])
-                    elif command[3] == 3:
-                        info["arg3"] = " ".join(split_message[3:])
-                        command_output = str(command[2]).format(arg1=info['arg1'],
-                                                                arg2=info['arg2'],
-                                                                arg3=info['arg3'])
-
-                    if command_sendtype == 'whisper' or whisper:
-                        irc.send_whisper(command_output.format(**info), info['username'])
-                        return
-                    else:
-                        irc.send_privmsg(command_output.format(**info), me)
-                        return
+    template = table.template(split_message[0])
+    if template is None:
+        return
 
-                # Checks if args are required and given are above or below required
-                elif command[3] > 0 and ((len(split_message) - 1) < command[3]
-                                         or (len(split_message) - 1) > command[3]):
-                    if not whisper:
-                        irc.send_privmsg(command[5])
-                    else:
-                        irc.send_whisper(command[5], info['username'])
+    try:
+        # Checks if user is above or equal to the required userlevel
+        if userlevel >= command[0]:
+            logging.debug("Command usage request acknowledged")
+            # Check is amount of args given is equal to the required amount
+            # The stored count, not template.args: rows saved before outputs were compiled counted arguments
+            # differently and their syntaxerr text was written for that count
+            if (len(split_message) - 1) == command[3]:
+                # The last argument takes the rest of the message
+                if command[3]:
+                    overlay["arg%d" % command[3]] = " ".join(split_message[command[3]:])
+
+                if "help" in template.placeholders:
+                    overlay["help"] = list(info.keys())
+
+                cooldowns.start(command[1], info['username'], command[6], command[7])
+                if command[4] == 'whisper' or whisper:
+                    irc.send_whisper(template.render(info), info['username'])
+                    return
+                else:
+                    irc.send_privmsg(template.render(info), template.me)
+                    return
 
-                return
+            # Checks if args are required and given are above or below required
+            # A wrong number of arguments doesn't start the cooldowns, the corrected command can follow right away
+            elif command[3] > 0:
+                if not whisper:
+                    irc.send_privmsg(command[5])
+                else:
+                    irc.send_whisper(command[5], info['username'])
 
-        except KeyError as err_key:
-            if not whisper:
-                irc.send_privmsg(err_key)
-            else:
-                irc.send_whisper(err_key, info["username"])
             return
 
-    return
+    except KeyError as err_key:
+        if not whisper:
+            irc.send_privmsg(err_key)
+        else:
+            irc.send_whisper(err_key, info["username"])
+        return
 
+    return
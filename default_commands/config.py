@@ -17,7 +17,6 @@ limitations under the License.
 import logging
 
 from .constants import ConfigDefaults
-import default_commands
 from default_commands._exceptions import *
 
 
@@ -31,31 +30,27 @@ class config:
         self.message = info["privmsg"]
         self.userlevel = userlevel
         self.whisper = whisper
-        self.sqlVariableString = "SELECT value FROM config WHERE grouping=? AND variable=?"
 
         self.configdefaults = ConfigDefaults(sqlconn)
+        self.cache = self.configdefaults.cache
 
-        self.min_userlevel_edit = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("config", "min_userlevel_edit")).fetchone()[0])
-
-        self.sqlCursorChannel.execute("SELECT grouping FROM config")
+        self.min_userlevel_edit = self.cache.get("config", "min_userlevel_edit")
 
     def chat_access(self):
-        temp_sqloffload = self.sqlCursorChannel.fetchall()
         try:
             temp_split = self.message.split(' ')
             if len(temp_split) > 1:
                 if self.userlevel >= self.min_userlevel_edit:
                     if temp_split[1] in list(self.local_dispatch_map.keys()):
                         self.local_dispatch_map[temp_split[1]]()
-                    elif (temp_split[1],) in list(temp_sqloffload):
+                    elif temp_split[1] in self.cache.groupings():
                         self.defaultdisplay()
                     else:
                         self.irc.send_privmsg("Error: '%s' is not a valid command variation." % temp_split[1])
                         return
                 else:
                     self.irc.send_privmsg('Error: You are not allowed to use any variations of {command}.'
-                                          .format(command=default_commands.dispatch_naming['commands']))
+                                          .format(command=self.cache.keyword('config')))
                     return
             else:
                 raise DCIncorrectAmountArgsError
@@ -106,23 +101,12 @@ class config:
 
             parameters = parameters[1].strip()
 
-            self.sqlCursorChannel.execute("SELECT * FROM config WHERE grouping = ?",
-                                          (split_params[0],))
-
-            checkforGrouping = self.sqlCursorChannel.fetchone()
-
-            self.sqlCursorChannel.execute("SELECT * FROM config "
-                                          "WHERE grouping = ?",
-                                          (split_params[0],))
+            variables = self.cache.variables(split_params[0])
 
             if len(split_params) >= 2:
-                self.sqlCursorChannel.execute("SELECT * FROM config "
-                                              "WHERE grouping = ? AND variable = ?",
-                                              (split_params[0], split_params[1]))
+                variables = {split_params[1]: variables[split_params[1]]} if split_params[1] in variables else {}
 
-            sqlCursorOffload = self.sqlCursorChannel.fetchall()
-
-            if not checkforGrouping or not sqlCursorOffload:
+            if not variables:
                 raise DCDatabaseEntryDoesNotExist
 
         except DCUserlevelIncorrectError:
@@ -147,12 +131,10 @@ class config:
         else:
             if len(split_params) >= 2:
                 self.irc.send_privmsg("Option '%s' under '%s' is set to '%s'" %
-                                      (split_params[1], split_params[0], sqlCursorOffload[0][2]))
+                                      (split_params[1], split_params[0], variables[split_params[1]][0]))
             else:
-                allvariables = []
-                [allvariables.append(entry[1]) for entry in sqlCursorOffload]
                 self.irc.send_privmsg("Variables under '%s': %s" %
-                                      (split_params[0], ", ".join(sorted(allvariables))))
+                                      (split_params[0], ", ".join(sorted(variables))))
 
     def defaultedit(self):
         parameters = self.message.split("set", 1)
@@ -163,18 +145,10 @@ class config:
 
             parameters = parameters[1].strip()
 
-            self.sqlCursorChannel.execute("SELECT * FROM config WHERE grouping = ?",
-                                          (split_params[0],))
-
-            checkforGrouping = self.sqlCursorChannel.fetchone()
-
-            self.sqlCursorChannel.execute("SELECT value, args, userlevel FROM config "
-                                          "WHERE grouping = ? AND variable = ?",
-                                          (split_params[0], split_params[1]))
+            # (value, args, userlevel) of the variable
+            sqlCursorOffload = self.cache.entry(split_params[0], split_params[1])
 
-            sqlCursorOffload = self.sqlCursorChannel.fetchone()
-
-            if not checkforGrouping or not sqlCursorOffload:
+            if not sqlCursorOffload:
                 raise DCDatabaseEntryDoesNotExist
 
             if self.userlevel < sqlCursorOffload[2]:
@@ -227,11 +201,7 @@ class config:
             return
 
         else:
-            self.sqlCursorChannel.execute("UPDATE config SET value = ?"
-                                          " WHERE grouping = ? AND variable = ?",
-                                          (" ".join(split_params[2:]), split_params[0], split_params[1]))
-
-            self.sqlConnectionChannel.commit()
+            self.cache.set(split_params[0], split_params[1], " ".join(split_params[2:]))
 
             self.irc.send_privmsg("Option '%s' under '%s' set to '%s'" % (split_params[1], split_params[0],
                                                                           " ".join(split_params[2:])))
@@ -246,18 +216,10 @@ class config:
 
             parameters = parameters[1].strip()
 
-            self.sqlCursorChannel.execute("SELECT * FROM config WHERE grouping = ?",
-                                          (split_params[0],))
-
-            checkforGrouping = self.sqlCursorChannel.fetchone()
-
-            self.sqlCursorChannel.execute("SELECT value, args, userlevel FROM config "
-                                          "WHERE grouping = ? AND variable = ?",
-                                          (split_params[0], split_params[1]))
-
-            sqlCursorOffload = self.sqlCursorChannel.fetchone()
+            # (value, args, userlevel) of the variable
+            sqlCursorOffload = self.cache.entry(split_params[0], split_params[1])
 
-            if not checkforGrouping or not sqlCursorOffload:
+            if not sqlCursorOffload:
                 raise DCDatabaseEntryDoesNotExist
 
         except DCDatabaseEntryDoesNotExist:
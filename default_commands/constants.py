@@ -14,10 +14,109 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import _database
+import default_commands
+
+# ConfigCache of every open channel database, keyed by its sqlite3 connection (which can't be weakly referenced)
+caches = {}
+
+
+class ConfigCache:
+    # The whole config table of one channel held in memory as grouping -> variable -> (value, args, userlevel).
+    # It is loaded on first use, updated by set() and reloaded after ConfigDefaults rewrote the table.
+    # The keywords the channel's default commands answer to are kept here as well, default_commands.dispatch_naming
+    # only holds the defaults since one process can run several channels.
+    def __init__(self, sqlconn):
+        self.sqlconn = sqlconn
+        self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
+        self.entries = None
+        self.keywords = None
+        self.loads = 0
+
+    def load(self):
+        entries = {}
+        for grouping, variable, value, args, userlevel in self.sqlConnectionChannel.execute(
+                "SELECT grouping, variable, value, args, userlevel FROM config"):
+            entries.setdefault(grouping, {})[variable] = (value, args, userlevel)
+
+        self.entries = entries
+        self.keywords = None
+        self.loads += 1
+        return entries
+
+    def invalidate(self):
+        self.entries = None
+        self.keywords = None
+
+    def keyword(self, command):
+        # The keyword a default command ('commands', 'faq', ...) answers to in this channel
+        return self.get(command, "keyword", default_commands.dispatch_naming[command])
+
+    def command(self, keyword):
+        # The default command a keyword of this channel belongs to, None for anything else
+        if self.keywords is None:
+            keywords = {self.keyword(command): command for command in default_commands.dispatch_naming}
+            self.keywords = keywords
+        return self.keywords.get(keyword)
+
+    def handler(self, keyword):
+        # The class handling a keyword of this channel, None if it isn't a default command
+        command = self.command(keyword)
+        return default_commands.dispatch_map.get(default_commands.dispatch_naming[command]) if command else None
+
+    def groupings(self):
+        entries = self.entries if self.entries is not None else self.load()
+        return entries.keys()
+
+    def variables(self, grouping):
+        entries = self.entries if self.entries is not None else self.load()
+        return entries.get(grouping, {})
+
+    def entry(self, grouping, variable):
+        # (value, args, userlevel) as stored, None if the variable doesn't exist
+        return self.variables(grouping).get(variable)
+
+    def get(self, grouping, variable, default=None):
+        # The value converted to the type named by its args column ('boolean', 'integer,700-0', 'string')
+        entry = self.entry(grouping, variable)
+        if entry is None:
+            return default
+
+        value, args, userlevel = entry
+        datatype = args.split(",")[0] if args else "string"
+        if datatype == "boolean":
+            return boolean(value)
+        if datatype == "integer":
+            return int(value)
+        return value
+
+    def set(self, grouping, variable, value):
+        # Write-through, the table and the cached entry are changed together
+        _database.writer(self.sqlconn).execute("UPDATE config SET value = ? WHERE grouping = ? AND variable = ?",
+                                               (value, grouping, variable))
+
+        entry = self.entry(grouping, variable)
+        if entry is not None:
+            self.entries[grouping][variable] = (value,) + entry[1:]
+        if variable == "keyword":
+            self.keywords = None
+
+
+def configcache(sqlconn):
+    cache = caches.get(sqlconn[0])
+    if cache is None:
+        cache = caches[sqlconn[0]] = ConfigCache(sqlconn)
+    return cache
+
+
+def dropcache(sqlconn):
+    caches.pop(sqlconn[0], None)
+
 
 class ConfigDefaults:
     def __init__(self, sqlconn):
         self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
+        self.cache = configcache(sqlconn)
 
         self.columns = {
             "grouping": 0,
@@ -33,27 +132,49 @@ class ConfigDefaults:
             "config": self.config,
             "faq": self.faq,
             "filters": self.filters,
+            "logs": self.logs,
             "regulars": self.regulars,
         }
 
-        self.sqlInsertString = "INSERT INTO config (grouping, variable, value, args, userlevel) VALUES (?, ?, ?, ?, ?)"
+        self.sqlInsertString = ("INSERT OR IGNORE INTO config (grouping, variable, value, args, userlevel) "
+                                "VALUES (?, ?, ?, ?, ?)")
+        self.sqlUpsertString = ("INSERT INTO config (grouping, variable, value, args, userlevel) "
+                                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (grouping, variable) DO UPDATE SET "
+                                "value=excluded.value, args=excluded.args, userlevel=excluded.userlevel")
         self.sqlUpdateString = "UPDATE config SET value=?, args=?, userlevel=? WHERE grouping=? AND variable=?"
-        self.sqlDeleteString = "DELETE FROM config WHERE grouping=? AND variable=?"
+        self.sqlDeleteString = "DELETE FROM config WHERE grouping=? AND variable NOT IN ({})"
         self.sqlExecute = self.sqlCursorChannel.execute
 
+        # Set by all_() so every group is written in the same transaction
+        self.bulk = False
+        self.changed = False
+
     def all_(self, defaultto=0):
-        self.bot(defaultto)
-        self.birthdays(defaultto)
-        self.commands(defaultto)
-        self.config(defaultto)
-        self.faq(defaultto)
-        self.filters(defaultto)
-        self.regulars(defaultto)
+        # A value queued by ConfigCache.set would otherwise be committed over the defaults written here
+        _database.sync((self.sqlConnectionChannel, self.sqlCursorChannel))
+
+        self.bulk = True
+        self.changed = False
+        try:
+            self.bot(defaultto)
+            self.birthdays(defaultto)
+            self.commands(defaultto)
+            self.config(defaultto)
+            self.faq(defaultto)
+            self.filters(defaultto)
+            self.logs(defaultto)
+            self.regulars(defaultto)
+        finally:
+            self.bulk = False
+
+        if self.changed:
+            self.sqlConnectionChannel.commit()
+            self.cache.invalidate()
         return
 
     def updatesql(self, grouping, variables, defaultto, variable):
-        self.sqlExecute("SELECT grouping, variable FROM config WHERE grouping = ?", (grouping,))
-        sqlCursorOffload = self.sqlCursorChannel.fetchall()
+        if not self.bulk:
+            _database.sync((self.sqlConnectionChannel, self.sqlCursorChannel))
 
         # Default-to Modes
         #
@@ -64,49 +185,34 @@ class ConfigDefaults:
         #  3 - Overwrite
 
         if defaultto == -1:
-            for entry in sqlCursorOffload:
-                if not [varset[1] == entry[1] for varset in variables]:
-                    self.sqlCursorChannel.execute(self.sqlDeleteString, (entry[0], entry[1]))
-                else:
-                    pass
-
-            self.sqlConnectionChannel.commit()
-            return
+            self.sqlExecute(self.sqlDeleteString.format(", ".join("?" * len(variables))),
+                            [grouping] + [varset[1] for varset in variables])
 
-        if defaultto == 0:
+        elif defaultto == 0:
             return
 
-        if defaultto == 1:
-            for varset in variables:
-                if True in [entry[1] == varset[1] for entry in sqlCursorOffload]:
-                    self.sqlCursorChannel.execute(self.sqlUpdateString, (varset[2], varset[3], varset[4],
-                                                                         varset[0], varset[1]))
-                else:
-                    self.sqlCursorChannel.execute(self.sqlInsertString, varset)
+        elif defaultto == 1:
+            self.sqlCursorChannel.executemany(self.sqlUpsertString, variables)
 
-            self.sqlConnectionChannel.commit()
-            return
+        elif defaultto == 2:
+            # Only variables missing from the (cached) table are written, after a restart usually none
+            variables = [varset for varset in variables if self.cache.entry(varset[0], varset[1]) is None]
+            if not variables:
+                return
+            self.sqlCursorChannel.executemany(self.sqlInsertString, variables)
 
-        if defaultto == 2:
+        elif defaultto == 3:
             for varset in variables:
-                if True in [entry[1] == varset[1] for entry in sqlCursorOffload]:
-                    pass
-                else:
-                    self.sqlCursorChannel.execute(self.sqlInsertString, varset)
+                if varset[1] == variable:
+                    self.sqlExecute(self.sqlUpdateString, (varset[2], varset[3], varset[4], varset[0], varset[1]))
 
-            self.sqlConnectionChannel.commit()
+        else:
             return
 
-        if defaultto == 3:
-            for varset in variables:
-                if True in [entry[1] == variable for entry in sqlCursorOffload] and varset[1] == variable:
-                    self.sqlCursorChannel.execute(self.sqlUpdateString, (varset[2], varset[3], varset[4],
-                                                                         varset[0], varset[1]))
-                else:
-                    pass
-
+        self.changed = True
+        if not self.bulk:
             self.sqlConnectionChannel.commit()
-            return
+            self.cache.invalidate()
 
     def bot(self, defaultto, variable=None):
         variables = [
@@ -154,6 +260,7 @@ class ConfigDefaults:
             ("faq", "keyword", "$faq", "string", 400),
             ("faq", "min_userlevel", 0, "integer,700-0", 400),
             ("faq", "min_userlevel_edit", 400, "integer,700-0", 400),
+            ("faq", "cooldown", 30, "integer,3600-0", 400),
         ]
 
         self.updatesql("faq", variables, defaultto, variable)
@@ -204,6 +311,18 @@ class ConfigDefaults:
 
         return
 
+    def logs(self, defaultto, variable=None):
+        variables = [
+            ("logs", "enabled", True, "boolean", 400),
+            ("logs", "keyword", "$logs", "string", 400),
+            ("logs", "min_userlevel", 250, "integer,700-0", 400),
+            ("logs", "page_size", 5, "integer,20-1", 400),
+        ]
+
+        self.updatesql("logs", variables, defaultto, variable)
+
+        return
+
     def regulars(self, defaultto, variable=None):
         variables = [
             ("regulars", "enabled", True, "boolean", 400),
@@ -14,13 +14,146 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+import logging
 import re
+import sqlite3
 
-from .constants import ConfigDefaults, boolean
-import default_commands
+import _database
+import _patterns
+from .commands import Cooldowns, Template, commandtable
+from .constants import ConfigDefaults, configcache
 from default_commands._exceptions import *
 
 
+# FaqTable of every open channel database, keyed by its sqlite3 connection (which can't be weakly referenced)
+tables = {}
+# matchFaq tasks still running
+answering = set()
+
+
+class FaqTable:
+    # The faq entries of one channel held in memory as name -> row, rows as stored in the faq table:
+    # (userlevel, name, regex, output, sendtype). Regexes ignore case. A message is only tried against the regexes
+    # whose required text occurs in it, an Aho-Corasick automaton finds those for all entries in one pass over
+    # the lowercased message. Regexes without any required text are tried on every message.
+    def __init__(self, sqlconn):
+        self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
+        self.writer = _database.writer(sqlconn)
+        self.cooldowns = Cooldowns()
+        self.faqs = None
+        self.compiled = {}
+
+        self.literals = {}
+        self.always = []
+        self.order = {}
+        self.automaton = None
+
+        self.metrics = {"messages": 0, "candidates": 0, "matches": 0}
+
+    def load(self):
+        self.faqs = collections.OrderedDict()
+        self.compiled = {}
+        for row in self.sqlConnectionChannel.execute(
+                'SELECT userlevel, name, regex, output, sendtype FROM faq ORDER BY rowid'):
+            self.faqs[row[1]] = row
+            self.compile(row)
+        self.build()
+        return self.faqs
+
+    def compile(self, row):
+        # (regex, output template, required text) of a row, entries saved before they were checked may not compile
+        try:
+            if _patterns.catastrophic(row[2], re.IGNORECASE):
+                logging.warning("Faq '%s' regex can backtrack for a long time, it runs under the sandbox time limit",
+                                row[1])
+            self.compiled[row[1]] = (re.compile(row[2], re.IGNORECASE), Template(row[3]),
+                                     _patterns.requiredliteral(row[2], re.IGNORECASE).lower())
+        except (re.error, DCTemplateError) as e:
+            logging.warning("Faq '%s' can't be used: %s", row[1], e)
+            self.compiled.pop(row[1], None)
+
+    def build(self):
+        self.literals = {}
+        self.always = []
+        self.order = {name: position for position, name in enumerate(self.faqs)}
+        for name in self.faqs:
+            if name not in self.compiled:
+                continue
+            literal = self.compiled[name][2]
+            if literal:
+                self.literals.setdefault(literal, []).append(name)
+            else:
+                self.always.append(name)
+        self.automaton = _patterns.AhoCorasick(self.literals)
+
+    def rows(self):
+        return (self.faqs if self.faqs is not None else self.load()).values()
+
+    def get(self, name):
+        return (self.faqs if self.faqs is not None else self.load()).get(name)
+
+    def add(self, row):
+        # Raises sqlite3.IntegrityError if the name already exists, see CommandTable.add
+        if self.get(row[1]) is not None:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: faq.name")
+        self.writer.execute('INSERT INTO faq (userlevel, name, regex, output, sendtype) VALUES (?, ?, ?, ?, ?)', row)
+        self.faqs[row[1]] = (int(row[0]),) + tuple(row[1:])
+        self.compile(self.faqs[row[1]])
+        self.build()
+
+    def delete(self, name):
+        self.writer.execute('DELETE FROM faq WHERE name == ?', (name,))
+        self.get(name)
+        self.faqs.pop(name, None)
+        self.compiled.pop(name, None)
+        self.build()
+
+    def candidates(self, message, userlevel, username):
+        # Names of the entries message could match, in the order they were added. Entries above the user's
+        # userlevel or on cooldown are left out so their regex doesn't run.
+        if self.faqs is None:
+            self.load()
+        self.metrics["messages"] += 1
+
+        candidates = list(self.always)
+        for literal in self.automaton.search(message.lower()):
+            candidates.extend(self.literals[literal])
+        candidates = [name for name in candidates
+                      if self.faqs[name][0] <= userlevel and not self.cooldowns.active(name, username)]
+        candidates.sort(key=self.order.get)
+        self.metrics["candidates"] += len(candidates)
+        return candidates
+
+    async def match(self, message, candidates):
+        # (row, output template) of the first candidate whose regex matches message, None if there is none. The
+        # regexes run in the sandbox, one that runs out of time counts as not matching.
+        for name in candidates:
+            compiled = self.compiled.get(name)
+            if compiled is None:
+                # Deleted while an earlier candidate ran
+                continue
+            if await _patterns.sandbox.search(compiled[0], message):
+                self.metrics["matches"] += 1
+                return self.faqs[name], compiled[1]
+        return None
+
+    def stats(self):
+        return dict(self.metrics, faqs=len(self.compiled), always=len(self.always),
+                    suppressed=self.cooldowns.metrics["suppressed"])
+
+
+def faqtable(sqlconn):
+    table = tables.get(sqlconn[0])
+    if table is None:
+        table = tables[sqlconn[0]] = FaqTable(sqlconn)
+    return table
+
+
+def droptable(sqlconn):
+    tables.pop(sqlconn[0], None)
+
+
 class faq:
     def __init__(self, bot, irc, sqlconn, info, userlevel=0, whisper=False):
         self.local_dispatch_map = {'add': self.add, 'edit': self.edit,
@@ -33,24 +166,19 @@ class faq:
         self.message = info["privmsg"]
         self.userlevel = userlevel
         self.whisper = whisper
-        self.sqlVariableString = "SELECT value FROM config WHERE grouping=? AND variable=?"
 
         self.configdefaults = ConfigDefaults(sqlconn)
+        self.table = faqtable(sqlconn)
 
-        self.enabled = boolean(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("faq", "enabled")).fetchone()[0])
+        self.enabled = self.configdefaults.cache.get("faq", "enabled")
 
-        self.commandkeyword = self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("faq", "keyword")).fetchone()[0]
-        default_commands.dispatch_naming["faq"] = self.commandkeyword
+        self.commandkeyword = self.configdefaults.cache.get("faq", "keyword")
 
         if not self.enabled:
             return
 
-        self.min_userlevel = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("faq", "min_userlevel")).fetchone()[0])
-        self.min_userlevel_edit = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("faq", "min_userlevel_edit")).fetchone()[0])
+        self.min_userlevel = self.configdefaults.cache.get("faq", "min_userlevel")
+        self.min_userlevel_edit = self.configdefaults.cache.get("faq", "min_userlevel_edit")
 
     def chat_access(self):
         temp_split = self.message.split(' ')
@@ -65,7 +193,7 @@ class faq:
                     return
             else:
                 self.irc.send_privmsg('Error: You are not allowed to use any variations of {command}.'
-                                      .format(command=default_commands.dispatch_naming['faq']))
+                                      .format(command=self.commandkeyword))
                 return
         else:
             pass
@@ -73,10 +201,15 @@ class faq:
     def help(self):
         pass
 
+    def usage(self):
+        self.irc.send_privmsg("Error: Usage '{command} add [-ul=<userlevel>] [-sm=<privmsg/whisper>] <name> "
+                              "\\'<regex>'\\ <output>'".format(command=self.commandkeyword))
+
     def add(self):
         parameters = self.message.split("add", 1)
         if len(parameters[1]) <= 0:
-            raise DCIncorrectAmountArgsError
+            self.usage()
+            return
 
         parameters = parameters[1].strip()
         split_params = parameters.split(" ")
@@ -132,12 +265,13 @@ class faq:
             else:
                 command_sendmode = "privmsg"
 
-        command_name = split_params[command_offset]
+        if len(split_params) <= command_offset + 1:
+            self.usage()
+            return
 
-        self.sqlCursorChannel.execute('SELECT name FROM faq WHERE name == ?', (command_name,))
-        sqlCursorOffload = self.sqlCursorChannel.fetchone()
+        command_name = split_params[command_offset]
 
-        if sqlCursorOffload is not None:
+        if self.table.get(command_name) is not None:
             self.irc.send_privmsg("Error: Faq with name '%s' already exists." % command_name)
             return
 
@@ -175,6 +309,31 @@ class faq:
 
         command_output = temp_parameters
 
+        try:
+            re.compile(command_regex, re.IGNORECASE)
+        except re.error as e:
+            self.irc.send_privmsg("Error: Invalid regular expression: %s" % e)
+            return
+
+        if _patterns.catastrophic(command_regex, re.IGNORECASE):
+            self.irc.send_privmsg("Error: Regular expression can match the same text in many ways, like (a+)+ or "
+                                  "(a|aa)+, which can take forever on some messages.")
+            return
+
+        try:
+            if Template(command_output).args:
+                self.irc.send_privmsg("Error: Faq outputs can't use arguments.")
+                return
+        except DCTemplateError as e:
+            self.irc.send_privmsg("Error: Invalid placeholders in output: %s" % e)
+            return
+
+        try:
+            self.table.add((command_userlevel, command_name, command_regex, command_output, command_sendmode))
+        except sqlite3.IntegrityError:
+            self.irc.send_privmsg("Error: Faq with name '%s' already exists." % command_name)
+            return
+
         self.irc.send_privmsg("Success: Name: '%s' | Regexp: '%s' | Output: '%s'" %
                               (command_name, command_regex, command_output))
         return
@@ -183,4 +342,60 @@ class faq:
         pass
 
     def delete(self):
-        pass
+        parameters = self.message.split("delete", 1)[1].strip()
+        if not parameters:
+            self.irc.send_privmsg("Error: Incorrect amount of arguments given.")
+            return
+
+        faq_name = parameters.split(" ")[0]
+        if self.table.get(faq_name) is None:
+            self.irc.send_privmsg("Error: Faq with name '%s' does not exist" % faq_name)
+            return
+
+        self.table.delete(faq_name)
+        self.irc.send_privmsg("Deleted '%s' successfully." % faq_name)
+
+
+def matchFaq(bot, irc, sqlconn, info):
+    # Answers a chat message with the first faq entry that matches it, the user's userlevel allows and that isn't
+    # on cooldown. Commands are left to customCommands.
+    cache = configcache(sqlconn)
+    if not cache.get("faq", "enabled"):
+        return
+
+    message = info["privmsg"]
+    keyword = message.split(" ", 1)[0]
+    if cache.command(keyword) is not None or commandtable(sqlconn).get(keyword) is not None:
+        return
+
+    table = faqtable(sqlconn)
+    candidates = table.candidates(message, info["userlevel"], info["username"])
+    if candidates:
+        task = irc.connection.loop.create_task(answerFaq(irc, table, cache, info, candidates))
+        # The loop only keeps weak references to tasks
+        answering.add(task)
+        task.add_done_callback(answering.discard)
+
+
+async def answerFaq(irc, table, cache, info, candidates):
+    try:
+        found = await table.match(info["privmsg"], candidates)
+        if found is None:
+            return
+        row, template = found
+        # Another message may have answered it while the regexes ran
+        if table.cooldowns.active(row[1], info["username"]):
+            return
+        table.cooldowns.start(row[1], info["username"], cache.get("faq", "cooldown"), 0)
+        try:
+            output = template.render(info)
+        except KeyError as e:
+            logging.warning("Faq '%s' output needs %s", row[1], e)
+            return
+
+        if row[4] == "whisper":
+            irc.send_whisper(output, info["username"])
+        else:
+            irc.send_privmsg(output, template.me)
+    except Exception:
+        logging.exception("Answering a message with a faq entry failed")
@@ -0,0 +1,173 @@
+"""
+Copyright 2016 Pawel Bartusiak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import itertools
+import logging
+import re
+import time
+
+import _archive
+from .constants import ConfigDefaults
+import default_commands
+from default_commands._exceptions import *
+
+
+class logs:
+    # Searches the chat history of the channel, answers are whispered a page at a time:
+    #   $logs user <username> [options]
+    #   $logs phrase <words...> [options]
+    #   $logs range [username] [options]    (read from the log archive instead of the search index)
+    # Options: '-since=<n>m/h/d' and '-until=<n>m/h/d' (ago), '-page=<n>'
+    units = {"m": 60, "h": 3600, "d": 86400}
+
+    def __init__(self, bot, irc, sqlconn, info, userlevel=0, whisper=False):
+        self.local_dispatch_map = {'user': self.user, 'phrase': self.phrase, 'range': self.range}
+        self.bot = bot
+        self.irc = irc
+        self.info = info
+        self.message = info["privmsg"]
+        self.userlevel = userlevel
+        self.whisper = whisper
+
+        self.configdefaults = ConfigDefaults(sqlconn)
+
+        self.enabled = self.configdefaults.cache.get("logs", "enabled")
+
+        self.commandkeyword = self.configdefaults.cache.get("logs", "keyword")
+
+        if not self.enabled:
+            return
+
+        self.min_userlevel = self.configdefaults.cache.get("logs", "min_userlevel")
+        self.pagesize = self.configdefaults.cache.get("logs", "page_size")
+
+        self.start = None
+        self.end = None
+        self.page = 1
+
+    def chat_access(self):
+        try:
+            if not self.enabled:
+                return
+            if self.userlevel < self.min_userlevel:
+                raise DCUserlevelIncorrectError
+
+            temp_split = self.message.split(" ")
+            if len(temp_split) < 2 or temp_split[1] not in self.local_dispatch_map:
+                raise DCSyntaxError
+
+            arguments = [argument for argument in temp_split[2:] if argument and not self.option(argument)]
+            self.local_dispatch_map[temp_split[1]](arguments)
+
+        except DCUserlevelIncorrectError:
+            self.irc.send_whisper("Error: You are not allowed to use {command}."
+                                  .format(command=self.commandkeyword), self.info["username"])
+
+        except (DCSyntaxError, DCIncorrectAmountArgsError, ValueError):
+            self.irc.send_whisper("Error: Usage '{help}'".format(
+                help=default_commands.help_defaults[default_commands.dispatch_naming['logs']]['']
+                    .format(command=self.commandkeyword)
+            ), self.info["username"])
+
+    def option(self, argument):
+        # Reads '-since=', '-until=' and '-page=', returns False for anything else
+        match = re.match(r'^-(since|until|page)=(\d+)([mhd]?)$', argument)
+        if match is None:
+            return False
+
+        name, number, unit = match.groups()
+        if name == "page":
+            self.page = max(int(number), 1)
+        elif not unit:
+            raise ValueError(argument)
+        elif name == "since":
+            self.start = time.time() - int(number) * self.units[unit]
+        else:
+            self.end = time.time() - int(number) * self.units[unit]
+        return True
+
+    def user(self, arguments):
+        if len(arguments) != 1:
+            raise DCIncorrectAmountArgsError
+        self.reply(username=arguments[0].lstrip("@"))
+
+    def phrase(self, arguments):
+        if not arguments:
+            raise DCIncorrectAmountArgsError
+        self.reply(phrase=" ".join(arguments))
+
+    def range(self, arguments):
+        if len(arguments) > 1 or self.start is None:
+            raise DCIncorrectAmountArgsError
+
+        # Reading and decompressing the archive happens in the loop's executor, the page is whispered once it's read
+        username = arguments[0].lstrip("@").lower() if arguments else None
+        future = self.irc.connection.loop.run_in_executor(
+            None, readrange, self.irc.CHANNEL, self.start, self.end if self.end is not None else time.time(),
+            self.bot.compactor.directory, username, (self.page - 1) * self.pagesize, self.pagesize + 1)
+        future.add_done_callback(self.rangedone)
+
+    def rangedone(self, future):
+        if future.exception() is not None:
+            logging.error("Reading the log archive failed: %s", future.exception())
+            self.irc.send_whisper("Error: The log archive couldn't be read.", self.info["username"])
+            return
+        self.whisperpage(future.result())
+
+    def reply(self, username=None, phrase=None):
+        index = self.bot.chatindex
+        if index is None:
+            self.irc.send_whisper("Error: Chat search isn't available.", self.info["username"])
+            return
+
+        # Searched in the index's reader thread once the messages added so far are committed, the page is whispered
+        # once the search is done
+        future = index.find(self.irc.CHANNEL, username=username, phrase=phrase, start=self.start, end=self.end,
+                            # One more than a page is fetched to know whether there is a next page
+                            limit=self.pagesize + 1, offset=(self.page - 1) * self.pagesize)
+        future.add_done_callback(self.searchdone)
+
+    def searchdone(self, future):
+        if future.exception() is not None:
+            logging.error("Chat search failed: %s", future.exception())
+            self.irc.send_whisper("Error: Chat search failed.", self.info["username"])
+            return
+        self.whisperpage(future.result())
+
+    def whisperpage(self, results):
+        # results are (timestamp, username, message), one more than a page if there is a next page
+        if not results:
+            self.irc.send_whisper("No messages found.", self.info["username"])
+            return
+
+        more = len(results) > self.pagesize
+        self.irc.send_whisper("Page {page}{more}:".format(
+            page=self.page, more=", more with -page={}".format(self.page + 1) if more else ""),
+            self.info["username"])
+        for timestamp, resultuser, message in results[:self.pagesize]:
+            self.irc.send_whisper("[{time}] {user}: {message}".format(
+                time=time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp)), user=resultuser, message=message),
+                self.info["username"])
+
+
+def readrange(channel, start, end, directory, username, offset, limit):
+    # (timestamp, username, message) of the archived chat lines from start to end, skipping offset lines
+    results = []
+    for timestamp, line in itertools.islice(_archive.open_range(channel, start, end, directory, username=username),
+                                            offset, offset + limit):
+        match = _archive.chatline.match(line)
+        results.append((timestamp, match.group(4), line[match.end():]) if match else (timestamp, "", line))
+    return results
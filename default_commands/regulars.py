@@ -16,8 +16,8 @@ limitations under the License.
 
 import logging
 
-from .constants import ConfigDefaults, boolean
-import default_commands
+import _database
+from .constants import ConfigDefaults
 
 
 class regulars:
@@ -27,28 +27,23 @@ class regulars:
         self.bot = bot
         self.irc = irc
         self.sqlConnectionChannel, self.sqlCursorChannel = sqlconn
+        self.writer = _database.writer(sqlconn)
         self.info = info
         self.message = info["privmsg"]
         self.userlevel = userlevel
         self.whisper = whisper
-        self.sqlVariableString = "SELECT value FROM config WHERE grouping=? AND variable=?"
 
         self.configdefaults = ConfigDefaults(sqlconn)
 
-        self.enabled = boolean(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("regulars", "enabled")).fetchone()[0])
+        self.enabled = self.configdefaults.cache.get("regulars", "enabled")
 
-        self.commandkeyword = self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("regulars", "keyword")).fetchone()[0]
-        default_commands.dispatch_naming["regulars"] = self.commandkeyword
+        self.commandkeyword = self.configdefaults.cache.get("regulars", "keyword")
 
         if not self.enabled:
             return
 
-        self.min_userlevel = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("regulars", "min_userlevel")).fetchone()[0])
-        self.min_userlevel_edit = int(self.configdefaults.sqlExecute(
-            self.sqlVariableString, ("regulars", "min_userlevel_edit")).fetchone()[0])
+        self.min_userlevel = self.configdefaults.cache.get("regulars", "min_userlevel")
+        self.min_userlevel_edit = self.configdefaults.cache.get("regulars", "min_userlevel_edit")
 
     def chat_access(self):
         temp_split = self.message.split(' ')
@@ -61,7 +56,7 @@ class regulars:
                     return
             else:
                 self.irc.send_privmsg('Error: You are not allowed to use any variations of {command}.'
-                                      .format(command=default_commands.dispatch_naming['regulars']))
+                                      .format(command=self.commandkeyword))
                 return
 
     def add(self):
@@ -75,22 +70,27 @@ class regulars:
         split_params = parameters.split(" ")
         command_reg_to_add = split_params[0].lower()
 
-        self.sqlCursorChannel.execute('SELECT * FROM regulars WHERE username = ?', (command_reg_to_add,))
-        sqlCursorOffLoad = self.sqlCursorChannel.fetchone()
-        if sqlCursorOffLoad is not None:
-            self.irc.send_privmsg('Error: User already in regulars list.', True)
-            return
+        # Users seen in the last few seconds may not have been written to userLevel yet. The writer is waited for in
+        # the loop's executor, the rest happens once it's done.
+        self.bot.funcdata.flush()
+        future = self.irc.connection.loop.run_in_executor(None, self.writer.barrier)
+        future.add_done_callback(lambda future: self.addsynced(command_reg_to_add))
 
+    def addsynced(self, command_reg_to_add):
         self.sqlCursorChannel.execute('SELECT userid FROM userlevel WHERE username = ?', (command_reg_to_add,))
         sqlCursorOffLoad = self.sqlCursorChannel.fetchone()
         if sqlCursorOffLoad is None:
             self.irc.send_privmsg('Error: User is not present in database. (must send message once in the chat)', True)
             return
 
-        self.sqlCursorChannel.execute('INSERT INTO regulars (userid, username) VALUES (?, ?)',
-                                      (sqlCursorOffLoad[0], command_reg_to_add))
+        # The regulars funcdata keeps in memory, an add still queued in the writer is already in there
+        if str(sqlCursorOffLoad[0]) in self.bot.funcdata.regulars:
+            self.irc.send_privmsg('Error: User already in regulars list.', True)
+            return
 
-        self.sqlConnectionChannel.commit()
+        self.writer.execute('INSERT INTO regulars (userid, username) VALUES (?, ?)',
+                            (sqlCursorOffLoad[0], command_reg_to_add))
+        self.bot.funcdata.setregular(sqlCursorOffLoad[0], True)
 
         self.irc.send_privmsg('Added username to regulars list.', True)
         return
@@ -112,10 +112,8 @@ class regulars:
             self.irc.send_privmsg("Error: User doesn't exist in regular list.", True)
             return
 
-        self.sqlCursorChannel.execute('DELETE FROM regulars WHERE username = ?',
-                                      (command_reg_to_del, ))
-
-        self.sqlConnectionChannel.commit()
+        self.writer.execute('DELETE FROM regulars WHERE username = ?', (command_reg_to_del, ))
+        self.bot.funcdata.setregular(sqlCursorOffLoad[0], False)
 
         self.irc.send_privmsg('Deleted username from regulars list.', True)
         return
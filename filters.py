@@ -15,14 +15,15 @@ limitations under the License.
 """
 
 import logging
-import re
 
+import _database
+import _patterns
 import unpackconfig
 
 
 class filters:
     def __init__(self, irc, sqlconn, info, userlevel=0):
-        self.cfg = unpackconfig.configUnpacker().unpackcfg()
+        self.regex = unpackconfig.registry.snapshot().regex
         self.irc = irc
         self.sqlconn = sqlconn
         self.sqlConnectionChannel, self.sqlCursorChannel = self.sqlconn
@@ -38,15 +39,22 @@ class filters:
         if self.sqlCursorOffload is not None:
             self.UserOffenseCount = int(self.sqlCursorOffload[2])
         else:
-            self.sqlCursorChannel.execute('INSERT INTO offenses (userid, username, offenses) VALUES (?, ?, ?)',
-                                          (self.info["user-id"], self.info["username"], 0))
-            self.sqlConnectionChannel.commit()
+            # A message arriving before the row is committed would insert it again, hence OR IGNORE
+            _database.writer(self.sqlconn).execute(
+                'INSERT OR IGNORE INTO offenses (userid, username, offenses) VALUES (?, ?, ?)',
+                (self.info["user-id"], self.info["username"], 0))
             self.UserOffenseCount = 0
 
     def spamprotection(self):
         pass
 
-    def linkprotection(self):
+    async def linkprotection(self):
+        # Awaits the link regex in the regex sandbox, True if the user was timed out or banned
+        regex = self.regex.get('regex_filter_links')
+        if regex is None:
+            # Missing from the config or not compiling, which unpackconfig logged when loading it
+            return False
+
         self.sqlCursorChannel.execute('SELECT * FROM filters WHERE filtertype == ?', ("link",))
         self.sqlCursorOffload = self.sqlCursorChannel.fetchone()
 
@@ -68,12 +76,11 @@ class filters:
 
         if enabled:
             if int(self.info['userlevel']) <= int(self.sqlCursorOffload[3]):
-                if re.search(self.cfg['regex_filter_links'], self.info['privmsg']) is not None:
+                if await _patterns.sandbox.search(regex, self.info['privmsg']):
                     logging.info("Link discovered in %s from user %s", self.info["channel"], self.info["username"])
                     self.UserOffenseCount += 1
-                    self.sqlCursorChannel.execute('UPDATE offenses SET offenses = ? WHERE userid = ?',
-                                                  (self.UserOffenseCount, self.info["user-id"]))
-                    self.sqlConnectionChannel.commit()
+                    _database.writer(self.sqlconn).execute('UPDATE offenses SET offenses = ? WHERE userid = ?',
+                                                           (self.UserOffenseCount, self.info["user-id"]))
 
                     if 0 < self.UserOffenseCount <= 3:
                         reason = "(TIMEOUT) Automatically timed out for posting a link by StrongLegsBot"
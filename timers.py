@@ -14,28 +14,20 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import os
-import sqlite3 as sql
-import threading
-
-import StrongLegsBot
-
-StrongLegsBot.IRC().init()
-
-sqlConnectionChannel = sql.connect(os.path.dirname(os.path.abspath(__file__)) + '\SLB.sqlDatabase\{}DB.db'
-                                   .format(StrongLegsBot.IRC().CHANNEL.strip("#")))
-sqlCursorChannel = sqlConnectionChannel.cursor()
+import asyncio
 
 
 class timer:
-    def __init__(self):
+    def __init__(self, irc, loop=None):
+        # Timers run on the bot's event loop instead of one thread per timer
+        self.irc = irc
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
         self.active_timers = {}
         self.test_timer = None
 
     def privmsg_timer(self, timer_delay, timer_privmsg):
-        StrongLegsBot.IRC().send_privmsg(timer_privmsg)
-        self.test_timer = threading.Timer(timer_delay, self.privmsg_timer, [timer_delay, timer_privmsg])
-        self.test_timer.start()
+        self.irc.send_privmsg(timer_privmsg)
+        self.test_timer = self.loop.call_later(timer_delay, self.privmsg_timer, timer_delay, timer_privmsg)
 
     def cancel_timer(self):
         self.test_timer.cancel()
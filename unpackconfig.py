@@ -16,6 +16,13 @@ limitations under the License.
 
 import configparser
 import logging
+import os
+import re
+import threading
+import time
+import types
+
+import _patterns
 
 cfg = configparser.ConfigParser(allow_no_value=True)
 
@@ -41,5 +48,69 @@ class configUnpacker:
         return self.dictConfigValues
 
 
+class configSnapshot:
+    __slots__ = ("config", "regex", "mtime")
+
+    def __init__(self, config, regex, mtime):
+        # Read-only views so a snapshot can be shared between every parser in the process
+        self.config = types.MappingProxyType(config)
+        self.regex = types.MappingProxyType(regex)
+        self.mtime = mtime
+
+
+class regexRegistry:
+    # Process-wide holder of cfg/config.ini and its precompiled 'regex_*' patterns.
+    # The file is only re-read when its mtime changes, and the mtime itself is
+    # only checked once every 'checkinterval' seconds.
+    def __init__(self, path='cfg/config.ini', checkinterval=1.0):
+        self.path = path
+        self.checkinterval = checkinterval
+        self.lastcheck = 0.0
+        self.current = None
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        current = self.current
+        now = time.monotonic()
+        if current is not None and now - self.lastcheck < self.checkinterval:
+            return current
+
+        with self.lock:
+            self.lastcheck = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+
+            if self.current is None or mtime != self.current.mtime:
+                self.current = self.load(mtime)
+
+            return self.current
+
+    def load(self, mtime):
+        config = dict(configUnpacker().unpackcfg())
+        regex = {}
+        for option, value in config.items():
+            if not option.startswith("regex_") or not value:
+                continue
+            try:
+                compiled = re.compile(value)
+            except re.error as regexerror:
+                logging.error('CONFIG ERROR: %s could not be compiled: %s' % (option, str(regexerror)))
+                continue
+
+            # Still used, the sandbox stops it when it runs too long, but it will likely miss matches then
+            if _patterns.catastrophic(value):
+                logging.warning('CONFIG WARNING: %s can match the same text in many ways (like (a+)+) and may hit '
+                                'the regex time limit' % option)
+            regex[option] = compiled
+
+        logging.debug('Loaded %d regular expressions from %s', len(regex), self.path)
+        return configSnapshot(config, regex, mtime)
+
+
+registry = regexRegistry()
+
+
 if __name__ == "__main__":
     pass